@@ -1,3 +1,10 @@
 # This file is executed on every boot (including wake-boot from deepsleep)
 import sys
 sys.path[1] = '/flash/lib'
+
+# Finish an interrupted OTA swap, count trial boots, roll back a bad release
+try:
+    import ota_boot
+    ota_boot.run()
+except Exception as e:
+    print("[OTA] boot check failed:", e)
@@ -9,6 +9,11 @@ VERSION_FILE = "/flash/version.txt"
 
 # ============ MODBUS SLAVE ADDRESSES ============ #
 SLAVE_ADDRESSES = [01, 02, 03, 04, 05, 06]
+# Optional: split meters across RS-485 lines, one worker thread each (meter_bus.py)
+# BUSES = [
+#     {"uart": 2, "tx": 19, "rx": 18, "addresses": [1, 2, 3]},
+#     {"uart": 1, "tx": 32, "rx": 33, "addresses": [4, 5, 6]},
+# ]
 
 # ============ MQTT CONFIGURATION ============ #
 MQTT_BROKER_HOST = "152.42.139.67"
@@ -39,6 +44,51 @@ MQTT_SUB_TOPICS = [
 
 timer = 180
 
+# ============ ADAPTIVE POLLING ============ #
+# Meters near their target are polled down to POLL_MIN_S apart, idle
+# meters back off up to POLL_MAX_S; 'timer' is the normal interval
+POLL_MIN_S = 15
+POLL_MAX_S = 900
+# Highest flow (L/s) a meter can plausibly see; caps the poll interval while credit remains
+MAX_FLOW_LPS = 0.7
+POLL_BUDGET_PER_MIN = 60
+PUBLISH_BUDGET_PER_HOUR = 240
+# Predictive close: shut the valve up to PREDICT_LEAD_S seconds (and at
+# most PREDICT_MAX_EARLY_L litres) before a steady flow reaches the target
+PREDICT_LEAD_S = 5
+PREDICT_MAX_EARLY_L = 2
+# Dead meters: probe backoff (doubles up to the max) and failed reads
+# before a meter is reported "offline"
+HEALTH_BACKOFF_BASE_S = 60
+HEALTH_BACKOFF_MAX_S = 1800
+HEALTH_OFFLINE_AFTER = 3
+
+# ============ UPLINK REPORTING ============ #
+# "per_meter": one publish per meter | "aggregate": one publish per cycle
+REPORT_MODE = "per_meter"
+# Delta reporting: publish a meter only when its reading moves by at least
+# REPORT_DEADBAND_L litres or its target/valve changes, plus a full
+# keyframe every REPORT_KEYFRAME_S seconds
+REPORT_DELTA = False
+REPORT_DEADBAND_L = 1
+REPORT_KEYFRAME_S = 3600
+# Reports kept on flash while MQTT is down (256 byte slots) and
+# how many are replayed per cycle after reconnecting
+OUTBOX_SLOTS = 128
+OUTBOX_BATCH = 10
+# Seconds between "telemetry" messages (counters, timers, heap; 0 = off)
+TELEMETRY_INTERVAL_S = 3600
+# Flash log: LOG_FILES rotated files of LOG_FILE_BYTES each, and how often
+# one message may repeat per minute before it is summarised
+LOG_FILES = 3
+LOG_FILE_BYTES = 8192
+LOG_RATE_PER_MIN = 6
+
 # ============ COMMAND QUEUE (THREAD SAFE) ============ #
 # MQTT thread puts commands here. Main thread executes them.
-CMD_QUEUE = []
+# Maximum pending commands (see meter_cmdqueue.py)
+CMD_QUEUE_SIZE = 16
+# "threads" or "async" (uasyncio tasks; falls back to threads without uasyncio)
+RUNTIME = "threads"
+# Boots a new OTA release gets to reach "System Running" before it is rolled back
+OTA_TRIAL_BOOTS = 3
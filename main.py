@@ -1,27 +1,51 @@
 from meter_gsm import gsmInitialization, gsmCheckStatus
 import meter_mqtts 
+import meter_ledger
+import meter_scheduler
+import meter_bus
+import meter_metrics
+import meter_log
+import meter_outbox
+import meter_health
+from meter_bus import uart_for
+from meter_cmdqueue import commands, WAKE_POLL_MS
 from meter import (
-    read_meter_parameters_upload, monitor_target, 
-    valve_test, 
-    open_valve, close_valve, 
-    save_target_reading, load_target_reading,
-    uart
+    monitor_target, get_valid_volume,
+    open_valve, close_valve, upload_readings, VALVE_OPEN, VALVE_CLOSED,
+    save_target_reading, load_target_reading, flush_targets
 )
-from ota_update import *
+import ota_boot
+import ota_loader
 from machine import UART, Pin
-from utime import sleep, time, localtime
+from utime import sleep, time, localtime, ticks_ms, ticks_diff
 import _thread
 import globals
 import machine
 import gc
 import json
 import os
+import sys
 
 # ============ CONFIGURATION ============ #
 SLAVE_ADDRESSES = globals.SLAVE_ADDRESSES
 MQTT_PUB_TOPIC = globals.MQTT_PUB_TOPIC
 MQTT_SUB_TOPICS = globals.MQTT_SUB_TOPICS
-LOG_FILE = "system_error.log"
+# "threads" (MQTT, supervisor and monitor threads) or "async" (uasyncio tasks)
+RUNTIME = getattr(globals, "RUNTIME", "threads")
+
+if RUNTIME == "async":
+    # A RUNTIME change arrives with globals.py, outside the OTA rollback,
+    # so anything short of a usable uasyncio must fall back, not crash
+    try:
+        import meter_async
+        asyncio = meter_async.asyncio
+        if not meter_async.available():
+            RUNTIME = "threads"
+    except Exception as e:
+        print("uasyncio not usable ({})".format(e))
+        RUNTIME = "threads"
+    if RUNTIME == "threads":
+        print("uasyncio not available, using threads")
 
 # Status LED (Pin 13)
 led = Pin(13, Pin.OUT)
@@ -31,37 +55,54 @@ last_alive_tick = time()
 
 # ============ UTILITIES ============ #
 def sys_log(msg, level="INFO"):
-    """Logs messages to console and file (only errors)."""
-    try:
-        t = localtime()
-        timestamp = "{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(t[1], t[2], t[3], t[4], t[5])
-        formatted_msg = "[{}] [{}] {}".format(timestamp, level, msg)
-        print(formatted_msg)
+    """Logs to console; ERROR/WARN/BOOT lines are batched to the rotating flash log."""
+    meter_log.log(msg, level)
 
-        if level == "ERROR" or level == "BOOT":
-            with open(LOG_FILE, 'a') as f:
-                f.write(formatted_msg + '\n')
-    except Exception:
-        print(msg) 
+def reboot(reason, delay=0):
+    """Deliberate reset: records the reason and flushes the log first."""
+    meter_metrics.note_reset(reason)
+    meter_log.flush()
+    sleep(delay)
+    machine.reset()
 
 def safe_gc():
     """Forces garbage collection to prevent fragmentation crashes."""
+    start = ticks_ms()
     gc.collect()
-    if gc.mem_free() < 10240:
+    meter_metrics.observe("gc_ms", ticks_diff(ticks_ms(), start))
+    free = gc.mem_free()
+    meter_metrics.observe("heap_free", free)
+    if free < 10240:
         sys_log("Low RAM. Rebooting.", "ERROR")
-        sleep(2)
-        machine.reset()
+        reboot("low_ram", 2)
 
-def check_scheduled_restart():
-    """Checks for OTA updates at Midnight instead of rebooting."""
+def release_modules(*names):
+    """Drops lazily imported modules so their code and globals can be collected."""
+    for name in names:
+        if name in sys.modules:
+            del sys.modules[name]
+    gc.collect()
+
+def ota_due():
     t = localtime()
     # If year > 2024 (time synced) and it is Midnight (00:0X)
-    if t[0] > 2024 and t[3] == 0 and 0 <= t[4] < 2: 
-        try:
-            update_global_file(globals.MQTT_CLIENT_ID, retries=3)
-            run_ota()
-        except:
-            pass
+    return t[0] > 2024 and t[3] == 0 and 0 <= t[4] < 2
+
+def nightly_ota():
+    """globals.py and firmware update; resets the device if a release was swapped in."""
+    try:
+        # Only needed here: loaded for the check, released after it
+        import ota_update
+        ota_update.update_global_file(globals.MQTT_CLIENT_ID, retries=3)
+        ota_update.run_ota()
+    except:
+        pass
+    release_modules("ota_update", "ota_http")
+
+def check_scheduled_restart():
+    """Checks for OTA updates at Midnight instead of rebooting."""
+    if ota_due():
+        nightly_ota()
         sleep(60) # Avoid repeating in same minute
 
 # ============ Establish Init Connectio ============ #
@@ -73,18 +114,18 @@ def check_for_initConnection():
     
     """
     print("[Init] Checking device state...")
-    for addr in SLAVE_ADDRESSES:
+    for addr in meter_bus.all_addresses():
         try:
             saved_target = load_target_reading(addr)
             
             # --- AUTO-INITIALIZATION --- #
             if saved_target is None:
                 print("[Init] No saved state for Addr {}. Reading meter...".format(addr))
-                current_vol = get_valid_volume(uart, addr)
+                current_vol = get_valid_volume(uart_for(addr), addr)
                 
                 if current_vol is not None:
                     # Initialize: Set Target = Current (No debt)
-                    save_target_reading(addr, current_vol)
+                    save_target_reading(addr, current_vol, flush=False)
                     print("[Init] Device initialized. Volume: {} L".format(current_vol))
                 else:
                     print("[Init] ❌ Failed to read meter at Addr {}. Cannot init.".format(addr))
@@ -93,83 +134,153 @@ def check_for_initConnection():
         except Exception as e:
             print("[Recovery] Error on Addr {}: {}".format(addr, e))
 
+    flush_targets(force=True)
+
 # ============ COMMAND PROCESSOR (THREAD SAFE) ============ #
 def process_command_queue():
     """
     Executes commands from the MQTT thread.
     This runs inside the Main Thread to ensure UART safety.
     """
-    while len(globals.CMD_QUEUE) > 0:
+    while True:
+        publish_rejections()
+        item = commands.get()
+        if item is None:
+            break
         try:
-            item = globals.CMD_QUEUE.pop(0)
             cmd = item['type']
             addr = item['addr'] # This is the hex address (e.g. 6)
-            dev_id = item['device_id']
             
             print("Processing CMD: {} for Addr {}".format(cmd, addr))
             
-            if cmd == "success":
-                # Handle Token Load
-                litres = item['litres']
-                if litres and litres > 0:
-                    current = load_target_reading(addr)
-                    if current is None: current = 0
-                    new_target = current + litres
-                    save_target_reading(addr, new_target)
-                    print("Updated Target: {}".format(new_target))
-                    
-                    # Check valve status immediately after update
-                    monitor_target(uart, [addr])
-                    
-                    meter_mqtts.mqttPublish(meter_mqtts.mqtt, MQTT_PUB_TOPIC, json.dumps({
-                        "type": "device_report", "device": dev_id, "status": "load_success"
-                    }))
-
-            elif cmd == "valve_open":
-                open_valve(uart, addr)
-                meter_mqtts.mqttPublish(meter_mqtts.mqtt, MQTT_PUB_TOPIC, json.dumps({
-                    "type": "device_report", "device": dev_id, "status": "valve_open"
-                }))
-
-            elif cmd == "valve_close":
-                close_valve(uart, addr)
-                meter_mqtts.mqttPublish(meter_mqtts.mqtt, MQTT_PUB_TOPIC, json.dumps({
-                    "type": "device_report", "device": dev_id, "status": "valve_closed"
-                }))
+            # Not while a bus worker is between reading and enforcing this meter
+            with meter_bus.address_lock(addr):
+                if cmd == "success":
+                    # Handle Token Load
+                    if load_credit(item) is not None:
+                        # Check valve status immediately after update
+                        monitor_target(uart_for(addr), [addr])
+                        publish_ack(item, "load_success")
+
+                elif cmd == "valve_open":
+                    open_valve(uart_for(addr), addr)
+                    publish_ack(item, "valve_open")
+
+                elif cmd == "valve_close":
+                    close_valve(uart_for(addr), addr)
+                    publish_ack(item, "valve_closed")
+
+                elif cmd == "log_tail":
+                    meter_log.upload_tail(meter_mqtts.mqttPublish, meter_mqtts.mqtt, MQTT_PUB_TOPIC, item.get('bytes'))
                 
         except Exception as e:
             print("Queue Error: {}".format(e))
-        
-        # Small sleep between commands to let UART settle
-        sleep(1)
+
+def load_credit(item):
+    """Applies a token load to the target. Returns the new target, or None if there is nothing to load."""
+    litres = item['litres']
+    if not litres or litres <= 0:
+        return None
+    # Log first, then apply: a power cut in between is replayed at boot
+    seq = meter_ledger.append_credit(item['addr'], litres, item['device_id'])
+    new_target = meter_ledger.apply_credit(item['addr'], litres, seq)
+    meter_ledger.compact()
+    print("Updated Target: {}".format(new_target))
+    return new_target
+
+def publish_ack(item, status):
+    meter_mqtts.mqttPublish(meter_mqtts.mqtt, MQTT_PUB_TOPIC, json.dumps({
+        "type": "device_report", "device": item['device_id'], "status": status,
+        "latency_ms": command_latency_ms(item)
+    }))
+
+def publish_rejections():
+    """Reports loads the full command queue turned away, so the backend sends them again."""
+    if not commands.rejected:
+        return
+    for item in commands.take_rejected():
+        print("CMD success for Addr {} rejected, queue full".format(item['addr']))
+        meter_mqtts.publishOrQueue(meter_mqtts.mqtt, MQTT_PUB_TOPIC, json.dumps({
+            "type": "device_report", "device": item['device_id'], "status": "load_rejected",
+            "litres": item['litres']
+        }))
+
+def service_commands():
+    """Runs queued commands between meters of a sweep (preemption point)."""
+    global last_alive_tick
+    if len(commands):
+        last_alive_tick = time()
+        process_command_queue()
+
+def command_latency_ms(item):
+    """Time from MQTT receipt (datacb) to now, i.e. after actuation."""
+    latency = ticks_diff(ticks_ms(), item['rx_ms'])
+    meter_metrics.observe("cmd_ms", latency)
+    print("CMD {} Addr {} actuated in {} ms".format(item['type'], item['addr'], latency))
+    return latency
+
+def publish_telemetry():
+    """Sends the boot phases once, then the periodic telemetry message when due (MQTT up)."""
+    if not meter_mqtts.mqttConnected(meter_mqtts.mqtt):
+        return
+    meter_metrics.publish_boot(meter_mqtts.mqttPublish, meter_mqtts.mqtt, MQTT_PUB_TOPIC)
+    now = time()
+    if not meter_metrics.due(now):
+        return
+    for name, value in commands.stats().items():
+        meter_metrics.gauge("cmd_" + name, value)
+    for name, value in meter_outbox.stats().items():
+        meter_metrics.gauge("outbox_" + name, value)
+    for name, value in meter_health.stats().items():
+        meter_metrics.gauge("meter_" + name, value)
+    for name, value in meter_ledger.stats().items():
+        meter_metrics.gauge(name, value)
+    meter_metrics.publish(meter_mqtts.mqttPublish, meter_mqtts.mqtt, MQTT_PUB_TOPIC, now)
 
 # ============ SUPERVISOR THREAD (WDT MANAGER) ============ #
-def supervisor_thread():
-    """
-    Feeds the Hardware Watchdog.
-    Reboots if Main Thread hangs for > 20 minutes.
-    """
+def start_watchdog():
     try:
         machine.WDT(True) # Enable LoBo Fixed WDT (approx 15s)
         sys_log("WDT Enabled")
     except:
         sys_log("WDT Init Fail")
 
+def supervisor_tick():
+    """Feeds the WDT unless the monitor has not reported alive for 20 minutes."""
+    # Check if Main Thread has reported alive recently
+    if (time() - last_alive_tick) < 1200: # 20 Minutes Limit
+        machine.resetWDT() # Feed the dog
+    else:
+        print("System HUNG > 20 mins. Allowing WDT Reboot...")
+        # We intentionally STOP feeding. Hardware resets in ~15s.
+    
+    # Blink LED to show life
+    led.value(not led.value())
+
+def supervisor_thread():
+    """
+    Feeds the Hardware Watchdog.
+    Reboots if Main Thread hangs for > 20 minutes.
+    """
+    start_watchdog()
     while True:
-        # Check if Main Thread has reported alive recently
-        if (time() - last_alive_tick) < 1200: # 20 Minutes Limit
-            machine.resetWDT() # Feed the dog
-        else:
-            print("System HUNG > 20 mins. Allowing WDT Reboot...")
-            # We intentionally STOP feeding. Hardware resets in ~15s.
-        
-        # Blink LED to show life
-        led.value(not led.value())
-        
+        supervisor_tick()
         # Must sleep LESS than hardware timeout (15s)
         sleep(5) 
 
 # ============ MONITOR THREAD (MAIN WORKER) ============ #
+def housekeeping(scheduled_ota=True):
+    """Start of every monitor pass: alive tick, GC, midnight OTA, GSM check."""
+    global last_alive_tick
+    last_alive_tick = time()
+    safe_gc()
+    meter_log.maybe_flush(last_alive_tick)
+    if scheduled_ota:
+        check_scheduled_restart()
+    if gsmCheckStatus() != 1:
+        sys_log("GSM Lost. Rebooting.", "WARN")
+        reboot("gsm_lost")
+
 def monitor_loop():
     global last_alive_tick
     
@@ -178,48 +289,165 @@ def monitor_loop():
     
     while True:
         try:
-            # 1. Report Alive
-            last_alive_tick = time()
-            safe_gc()
-            check_scheduled_restart()
+            # 1. Report Alive, midnight OTA, connection check
+            housekeeping()
 
             # 2. Process pending MQTT commands (Safe UART access)
             process_command_queue()
+            flush_targets()
 
-            # 3. Check Connection
-            if gsmCheckStatus() != 1:
-                sys_log("GSM Lost. Rebooting.")
-                machine.reset()
-
-            # 4. Upload Data (Only if MQTT is connected)
+            # 3. Read, enforce and upload. Valves are enforced even when MQTT
+            # is down; reports then go to the flash outbox for later replay.
             # Use 'meter_mqtts.mqtt' directly to avoid stale reference
-            if meter_mqtts.mqtt is not None and meter_mqtts.mqtt.status()[0] == 2:
-                try:
-                    last_alive_tick = time()
-                    read_meter_parameters_upload(
-                        uart, 
-                        SLAVE_ADDRESSES, 
-                        meter_mqtts.mqttPublish, 
-                        meter_mqtts.mqtt, 
-                        MQTT_PUB_TOPIC
-                    )
-                except Exception as e:
-                    print("Upload Err:", e)
-
-            # Sleep logic is simple now because Supervisor handles WDT
-            print("Sleeping {}s...".format(globals.timer))
+            # Only meters the scheduler says are due are polled this pass
+            try:
+                last_alive_tick = time()
+                meter_mqtts.drainOutbox(meter_mqtts.mqtt, MQTT_PUB_TOPIC)
+                start = ticks_ms()
+                meter_bus.sweep(
+                    meter_scheduler.due(meter_bus.all_addresses(), time()), 
+                    meter_mqtts.publishOrQueue, 
+                    meter_mqtts.mqtt, 
+                    MQTT_PUB_TOPIC,
+                    preempt=service_commands
+                )
+                meter_metrics.observe("sweep_ms", ticks_diff(ticks_ms(), start))
+                publish_telemetry()
+            except Exception as e:
+                print("Upload Err:", e)
+
+            # Wait for the next due meter, but run commands the moment datacb queues them
+            wait_s = meter_scheduler.seconds_until_next(meter_bus.all_addresses(), time())
+            print("Sleeping {}s...".format(wait_s))
             last_alive_tick = time() 
-            sleep(globals.timer)
+            deadline = time() + wait_s
+            while time() < deadline:
+                if commands.wait(deadline - time()):
+                    service_commands()
             last_alive_tick = time() # Update immediately on wake
 
         except Exception as e:
-            sys_log("Loop Crash: " + str(e))
-            sleep(5)
-            machine.reset()
+            sys_log("Loop Crash: " + str(e), "ERROR")
+            reboot("loop_crash", 5)
+
+# ============ ASYNC RUNTIME (RUNTIME = "async") ============ #
+# Same work as the threads above as cooperative tasks on one loop. Modbus
+# replies are awaited instead of busy-waited, so a command is actuated
+# between two transactions of a sweep rather than after the meter.
+async def run_in_thread(name, func):
+    """Runs a blocking func on its own thread and waits for it without blocking the loop."""
+    done = []
+    def body():
+        try:
+            func()
+        finally:
+            done.append(True)
+    _thread.start_new_thread(name, body, ())
+    while not done:
+        await asyncio.sleep(1)
+
+async def supervisor_task():
+    start_watchdog()
+    while True:
+        supervisor_tick()
+        await asyncio.sleep(5)
+
+async def command_task(wake):
+    """Consumes the command queue (filled by datacb on the MQTT thread)."""
+    global last_alive_tick
+    while True:
+        publish_rejections()
+        item = commands.get()
+        if item is None:
+            await meter_async.sleep_ms(WAKE_POLL_MS)
+            continue
+        last_alive_tick = time()
+        try:
+            cmd = item['type']
+            addr = item['addr']
+            print("Processing CMD: {} for Addr {}".format(cmd, addr))
+
+            # Not while the sweep is between reading and enforcing this meter
+            async with meter_async.address_lock(addr):
+                if cmd == "success":
+                    if load_credit(item) is not None:
+                        await meter_async.monitor(uart_for(addr), addr)
+                        publish_ack(item, "load_success")
+
+                elif cmd == "valve_open":
+                    await meter_async.write_valve(uart_for(addr), addr, VALVE_OPEN)
+                    publish_ack(item, "valve_open")
+
+                elif cmd == "valve_close":
+                    await meter_async.write_valve(uart_for(addr), addr, VALVE_CLOSED)
+                    publish_ack(item, "valve_closed")
+
+                elif cmd == "log_tail":
+                    meter_log.upload_tail(meter_mqtts.mqttPublish, meter_mqtts.mqtt, MQTT_PUB_TOPIC, item.get('bytes'))
+
+        except Exception as e:
+            print("Queue Error: {}".format(e))
+        # A credit changes when the meter is next due
+        wake.set()
+
+async def uplink_task(uplink):
+    """Publishes sweep readings (or queues them in the outbox)."""
+    while True:
+        readings = await uplink.get()
+        try:
+            meter_mqtts.drainOutbox(meter_mqtts.mqtt, MQTT_PUB_TOPIC)
+            upload_readings(readings, meter_mqtts.publishOrQueue, meter_mqtts.mqtt, MQTT_PUB_TOPIC)
+            publish_telemetry()
+        except Exception as e:
+            print("Upload Err:", e)
+
+async def monitor_task(wake, uplink):
+    global last_alive_tick
+    while True:
+        try:
+            # The midnight OTA blocks for minutes (downloads, sleep(60));
+            # it runs on a thread so supervisor_task keeps feeding the WDT
+            housekeeping(scheduled_ota=False)
+            if ota_due():
+                await run_in_thread("NightlyOTA", nightly_ota)
+                await asyncio.sleep(60) # Avoid repeating in same minute
+            flush_targets()
+
+            try:
+                start = ticks_ms()
+                readings = await meter_async.sweep(
+                    meter_scheduler.due(meter_bus.all_addresses(), time()))
+                meter_metrics.observe("sweep_ms", ticks_diff(ticks_ms(), start))
+                flush_targets(force=True)
+                uplink.put_nowait(readings)
+            except Exception as e:
+                print("Sweep Err:", e)
+
+            wait_s = meter_scheduler.seconds_until_next(meter_bus.all_addresses(), time())
+            print("Sleeping {}s...".format(wait_s))
+            last_alive_tick = time()
+            wake.clear()
+            await meter_async.wait_event(wake, wait_s * 1000)
+            last_alive_tick = time()
+
+        except Exception as e:
+            sys_log("Loop Crash: " + str(e), "ERROR")
+            reboot("loop_crash", 5)
+
+async def async_main():
+    wake = asyncio.Event()
+    uplink = meter_async.Queue()
+    asyncio.create_task(supervisor_task())
+    asyncio.create_task(command_task(wake))
+    asyncio.create_task(uplink_task(uplink))
+    await monitor_task(wake, uplink)
 
 # ============ MAIN EXECUTION ============ #
 def main():
     gc.enable()
+    # ticks_ms() counts from reset: everything so far is interpreter start and imports
+    meter_metrics.phase("import")
+    boot_ms = meter_metrics.phases["import"]
     
     sys_log("Booting...", "BOOT")
     led.value(1)
@@ -227,9 +455,13 @@ def main():
     led.value(0)
     
     safe_gc()
+    meter_metrics.gauge("boot_ms", boot_ms)
+    meter_metrics.gauge("boot_heap_free", gc.mem_free())
+    sys_log("Loaded in {} ms, {} bytes free ({})".format(boot_ms, gc.mem_free(), ota_loader.mode), "BOOT")
 
     try:
         sys_log("Initializing GSM...", "INFO")
+        gsm_start = ticks_ms()
         gsmInitialization()
         
         wait = 0
@@ -242,16 +474,28 @@ def main():
             wait += 1
             if wait > 120: 
                  sys_log("GSM Timeout. Rebooting.", "ERROR")
-                 machine.reset()
+                 reboot("gsm_timeout")
         
         sys_log("GSM Connected.", "INFO")
+        meter_metrics.gauge("gsm_connect_ms", ticks_diff(ticks_ms(), gsm_start))
+        meter_metrics.phase("gsm")
         led.value(0)
         
         sys_log("Check Init Store File.", "INFO")
+        meter_bus.setup(SLAVE_ADDRESSES, workers=(RUNTIME != "async"))
+        meter_ledger.apply_pending()
         check_for_initConnection()
+        meter_metrics.phase("init")
+
+        if RUNTIME == "async":
+            # MQTT callbacks still arrive on the client's own task
+            meter_mqtts.mqttInitialize(meter_mqtts.client(), MQTT_SUB_TOPICS)
+            sys_log("System Running (async)", "INFO")
+            ota_boot.confirm()
+            asyncio.run(async_main())
 
         # 1. Start MQTT Listener (Receives -> Queue)
-        _thread.start_new_thread("MqttListener", meter_mqtts.mqttInitialize, (meter_mqtts.mqtt, MQTT_SUB_TOPICS,))
+        _thread.start_new_thread("MqttListener", meter_mqtts.mqttInitialize, (meter_mqtts.client(), MQTT_SUB_TOPICS,))
         
         # 2. Start Supervisor (Feeds WDT)
         _thread.start_new_thread("Supervisor", supervisor_thread, ())
@@ -261,6 +505,8 @@ def main():
         _thread.start_new_thread("MeterMonitor", monitor_loop, ())
 
         sys_log("System Running", "INFO")
+        # Reaching here is what makes a freshly swapped-in release stick
+        ota_boot.confirm()
         
         # Keep Main Thread Alive
         while True:
@@ -268,8 +514,7 @@ def main():
 
     except Exception as e:
         sys_log("Main Crash: {}".format(e), "ERROR")
-        sleep(5)
-        machine.reset()
+        reboot("main_crash", 5)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,57 +1,214 @@
 from machine import UART
+from array import array
+import _thread
 import time
 from meter_storage import *
+from meter_registers import plan_reads, decode_block, FLOW_FIELDS
+import meter_scheduler
+import meter_predict
+import meter_health
+import meter_metrics
+from meter_report import REPORT_MODE, report, device_report, should_report, mark_reported
 import json
 
 # ========== UART CONFIG ==========
-uart = UART(2, baudrate=9600, bits=8, parity=1, stop=1, tx=19, rx=18)
+UART_BAUD = 9600
+uart = UART(2, baudrate=UART_BAUD, bits=8, parity=1, stop=1, tx=19, rx=18)
 
-# ========== HELPER: CLEAR BUFFER ==========
-def clear_uart_buffer(uart):
-    """
-    Reads all pending data to ensure the line is silent before we speak.
-    """
-    try:
-        while uart.any():
-            uart.read()
-            time.sleep(0.01) # Yield to CPU
-    except:
-        pass
-    time.sleep(0.05) 
+# ========== RTU TIMING ==========
+# start + 8 data + parity + stop
+BITS_PER_CHAR = 11
+# Time allowed for the slave to start answering
+RESPONSE_TIMEOUT_MS = 300
+# The UART driver hands bytes over in bursts, so a gap shorter than a few
+# characters is not a real end of frame. Silence is max(t3.5, this).
+MIN_SILENCE_CHARS = 12
 
-# ========== HELPER: SMART READ ==========
-def smart_read_modbus(uart, expected_bytes, timeout_attempts=15):
+# ========== CRC Utils ==========
+def _build_crc_table():
     """
-    Waits for 'expected_bytes' to arrive in the buffer.
+    CRC-16/Modbus (poly 0xA001 reflected) for every byte value.
+    Built once at import so each frame costs one lookup per byte.
     """
-    for _ in range(timeout_attempts):
-        if uart.any() >= expected_bytes:
-            break
-        time.sleep(0.1) 
-    
-    try:
-        return uart.read(expected_bytes)
-    except:
-        return None
-
-# ========== CRC Utils ==========
-def calculate_crc(data):
-    crc = 0xFFFF
-    for byte in data:
-        crc ^= byte
+    table = array('H', bytes(512))
+    for i in range(256):
+        crc = i
         for _ in range(8):
             if crc & 0x0001:
-                crc >>= 1
-                crc ^= 0xA001
+                crc = (crc >> 1) ^ 0xA001
             else:
                 crc >>= 1
+        table[i] = crc
+    return table
+
+CRC_TABLE = _build_crc_table()
+
+def calculate_crc(data, start=0, end=None):
+    """
+    Table-driven CRC-16/Modbus over data[start:end].
+    Accepts bytes, bytearray or memoryview without copying.
+    """
+    if end is None:
+        end = len(data)
+    table = CRC_TABLE
+    crc = 0xFFFF
+    for i in range(start, end):
+        crc = (crc >> 8) ^ table[(crc ^ data[i]) & 0xFF]
     return crc
 
 def verify_crc(frame):
     if not frame or len(frame) < 3:
         return False
     received_crc = frame[-2] | (frame[-1] << 8)
-    return calculate_crc(frame[:-2]) == received_crc
+    return calculate_crc(frame, 0, len(frame) - 2) == received_crc
+
+# ========== RTU TRANSACTION LAYER ==========
+class ModbusError(Exception):
+    pass
+
+class ModbusTimeout(ModbusError):
+    pass
+
+class ModbusShortFrame(ModbusError):
+    pass
+
+class ModbusCRCError(ModbusError):
+    pass
+
+class ModbusExceptionReply(ModbusError):
+    def __init__(self, address, function, code):
+        ModbusError.__init__(self, "Addr %d fn 0x%02X exception %d" % (address, function, code))
+        self.address = address
+        self.function = function
+        self.code = code
+
+def rtu_timing(baud):
+    """
+    Returns (char_us, silence_us) for the given baud rate.
+    Above 19200 baud Modbus fixes t3.5 at 1750 us.
+    """
+    char_us = (BITS_PER_CHAR * 1000000) // baud
+    t35_us = 1750 if baud > 19200 else (char_us * 7) // 2
+    return char_us, max(t35_us, char_us * MIN_SILENCE_CHARS)
+
+CHAR_US, SILENCE_US = rtu_timing(UART_BAUD)
+
+# Latency of the most recent transaction (request written -> frame complete)
+last_latency_us = 0
+
+# Per-UART state {id(uart): [lock, last_activity_ticks_us]}. The lock keeps
+# bus workers and the command path from interleaving frames on one line.
+_buses = {}
+_buses_guard = _thread.allocate_lock()
+
+def bus_state(uart):
+    state = _buses.get(id(uart))
+    if state is None:
+        with _buses_guard:
+            state = _buses.get(id(uart))
+            if state is None:
+                state = [_thread.allocate_lock(), None]
+                _buses[id(uart)] = state
+    return state
+
+def _wait_bus_idle(uart, bus):
+    """
+    Drops stale bytes and makes sure the line has been quiet for the
+    inter-frame gap before we transmit. Costs nothing when already idle.
+    """
+    deadline = time.ticks_add(time.ticks_us(), RESPONSE_TIMEOUT_MS * 1000)
+    while True:
+        try:
+            if uart.any():
+                uart.read()
+                bus[1] = time.ticks_us()
+        except:
+            pass
+        if bus[1] is None:
+            return
+        now = time.ticks_us()
+        idle = time.ticks_diff(now, bus[1])
+        if idle >= SILENCE_US or time.ticks_diff(now, deadline) >= 0:
+            return
+        time.sleep_us(min(SILENCE_US - idle, CHAR_US))
+
+def _read_frame(uart, bus, function, expected, timeout_ms):
+    """
+    Collects one reply frame. Stops as soon as:
+      - 'expected' bytes are in,
+      - a complete 5 byte exception frame is in,
+      - the line goes silent after the reply started (short frame),
+      - or nothing arrived before the response deadline.
+    """
+    rx = bytearray()
+    start = time.ticks_us()
+    timeout_us = timeout_ms * 1000
+    last_rx = None
+    while len(rx) < expected:
+        n = uart.any()
+        if n:
+            chunk = uart.read(min(n, expected - len(rx)))
+            if chunk:
+                rx.extend(chunk)
+                last_rx = time.ticks_us()
+            if len(rx) >= 5 and rx[1] == (function | 0x80):
+                break
+            continue
+        now = time.ticks_us()
+        if last_rx is not None:
+            if time.ticks_diff(now, last_rx) >= SILENCE_US:
+                break
+        elif time.ticks_diff(now, start) >= timeout_us:
+            break
+        time.sleep_us(CHAR_US)
+    bus[1] = time.ticks_us()
+    return rx
+
+def transact(uart, request, expected, timeout_ms=RESPONSE_TIMEOUT_MS):
+    """
+    Sends one request frame and returns the verified reply.
+    Raises ModbusTimeout, ModbusShortFrame, ModbusCRCError or
+    ModbusExceptionReply. Latency is left in meter.last_latency_us.
+    """
+    global last_latency_us
+    function = request[1]
+
+    bus = bus_state(uart)
+    with bus[0]:
+        _wait_bus_idle(uart, bus)
+        start = time.ticks_us()
+        uart.write(request)
+        rx = _read_frame(uart, bus, function, expected, timeout_ms)
+    last_latency_us = time.ticks_diff(time.ticks_us(), start)
+    meter_metrics.observe("modbus_us", last_latency_us)
+    return check_reply(request, rx, expected, timeout_ms)
+
+def check_reply(request, rx, expected, timeout_ms=RESPONSE_TIMEOUT_MS):
+    """
+    Validates a collected reply against its request; raises ModbusError
+    subclasses. Failures are counted per address in meter_metrics.
+    """
+    address = request[0]
+    function = request[1]
+    if not rx:
+        meter_metrics.inc_addr("timeout", address)
+        raise ModbusTimeout("Addr %d: no reply in %d ms" % (address, timeout_ms))
+    if len(rx) >= 5 and rx[1] == (function | 0x80):
+        if calculate_crc(rx, 0, 3) != (rx[3] | (rx[4] << 8)):
+            meter_metrics.inc_addr("crc", address)
+            raise ModbusCRCError("Addr %d: bad CRC on exception frame" % address)
+        meter_metrics.inc_addr("exception", address)
+        raise ModbusExceptionReply(address, function, rx[2])
+    if len(rx) < expected:
+        meter_metrics.inc_addr("short", address)
+        raise ModbusShortFrame("Addr %d: %d of %d bytes" % (address, len(rx), expected))
+    if not verify_crc(rx):
+        meter_metrics.inc_addr("crc", address)
+        raise ModbusCRCError("Addr %d: bad CRC" % address)
+    if rx[0] != address or rx[1] != function:
+        meter_metrics.inc_addr("mismatch", address)
+        raise ModbusError("Addr %d: reply from addr %d fn 0x%02X" % (address, rx[0], rx[1]))
+    return rx
 
 # ========== MODBUS FUNCTIONS ==========
 def build_modbus_request(address, function_code, register_address, register_count):
@@ -66,8 +223,8 @@ def build_modbus_request(address, function_code, register_address, register_coun
     frame += bytearray([crc & 0xFF, (crc >> 8) & 0xFF])
     return frame
 
-def write_single_register(uart, address, register_address, value):
-    clear_uart_buffer(uart)
+def build_write_request(address, register_address, value):
+    """0x10 (write multiple) request for one register, as the meters expect."""
     frame = bytearray(9)
     frame[0] = address
     frame[1] = 0x10 
@@ -80,37 +237,144 @@ def write_single_register(uart, address, register_address, value):
     frame[8] = value & 0xFF
     crc = calculate_crc(frame)
     frame += bytearray([crc & 0xFF, (crc >> 8) & 0xFF])
-    
-    uart.write(frame)
-    # Wait for response (8 bytes for Write command)
-    response = smart_read_modbus(uart, 8)
-    return response and verify_crc(response)
+    return frame
+
+def write_single_register(uart, address, register_address, value):
+    frame = build_write_request(address, register_address, value)
+    # Response is 8 bytes for a Write command
+    try:
+        transact(uart, frame, 8)
+        return True
+    except ModbusError as e:
+        print("Write Err: {}".format(e))
+        return False
+
+def read_holding_registers(uart, address, start, count):
+    """
+    Reads 'count' registers from 'start' with one 0x03 request.
+    Returns the verified response frame (register data begins at byte 3) or None.
+    """
+    request = build_modbus_request(address, 0x03, start, count)
+    try:
+        response = transact(uart, request, 5 + 2 * count)
+    except ModbusError as e:
+        print("Read Err: {}".format(e))
+        return None
+
+    if response[2] != 2 * count:
+        return None
+    return response
+
+def read_meter_snapshot(uart, address, names=FLOW_FIELDS):
+    """
+    Reads every field in 'names' using the fewest requests the planner allows.
+    Returns {"addr": address, <field>: value, ...} or None if any read fails.
+    """
+    snapshot = {"addr": address}
+    for start, count, fields in plan_reads(names):
+        response = read_holding_registers(uart, address, start, count)
+        if response is None:
+            return None
+        decode_block(response, 3, start, fields, snapshot)
+    return snapshot
 
 def read_cumulative_flow(uart, address):
-    clear_uart_buffer(uart)
-    request = build_modbus_request(address, 0x03, 0x000E, 0x02)
-    uart.write(request)
-    response = smart_read_modbus(uart, 9)
-    
-    if response and len(response) == 9 and verify_crc(response):
-        if response[0] == address:
-            return (response[3] << 8) | response[4]
-    return None
+    snapshot = read_meter_snapshot(uart, address, FLOW_FIELDS)
+    if snapshot is None:
+        return None
+    return snapshot["cumulative_flow"]
+
+# ========== VALVE CONTROL ==========
+VALVE_REGISTER = 0x0060
+VALVE_OPEN = 0x0001
+VALVE_CLOSED = 0x0002
+# Re-read the valve register this often to catch manual or power-cycle changes
+VALVE_CONFIRM_INTERVAL = 1800
+# Time the valve motor gets after a write before the bus is used again
+VALVE_SETTLE_MS = 500
+
+# Last known valve state per address: {address: [state, confirmed_at]}
+# Empty after a reboot, so the first cycle always writes (resync).
+valve_cache = {}
+
+def _write_valve(uart, device_address, state):
+    if write_single_register(uart, device_address, VALVE_REGISTER, state):
+        valve_cache[device_address] = [state, time.time()]
+        return True
+    # Unknown state after a failed write; force a write next time
+    valve_cache.pop(device_address, None)
+    return False
 
 def open_valve(uart, device_address):
-    write_single_register(uart, device_address, 0x0060, 0x0001)
-    time.sleep(0.5)
+    _write_valve(uart, device_address, VALVE_OPEN)
+    meter_scheduler.wake(device_address, time.time())
+    time.sleep_ms(VALVE_SETTLE_MS)
 
 def close_valve(uart, device_address):
-    write_single_register(uart, device_address, 0x0060, 0x0002)
-    time.sleep(0.5)
+    _write_valve(uart, device_address, VALVE_CLOSED)
+    time.sleep_ms(VALVE_SETTLE_MS)
+
+def read_valve_state(uart, device_address):
+    snapshot = read_meter_snapshot(uart, device_address, ("valve_status",))
+    if snapshot is None:
+        return None
+    return snapshot["valve_status"]
+
+def invalidate_valve(device_address):
+    """Forget the cached state (meter error / power cycle) so the next enforce writes."""
+    valve_cache.pop(device_address, None)
+
+def enforce_valve(uart, device_address, state):
+    """
+    Write-on-change valve control.
+    Skips the write when the cached state already matches; once every
+    VALVE_CONFIRM_INTERVAL the cache is checked against the valve register.
+    Returns True if a write was sent.
+    """
+    entry = valve_cache.get(device_address)
+    if entry is not None and entry[0] == state:
+        if time.time() - entry[1] < VALVE_CONFIRM_INTERVAL:
+            return False
+        if read_valve_state(uart, device_address) == state:
+            entry[1] = time.time()
+            return False
+        print("Valve Addr %d: state drifted, rewriting" % device_address)
+
+    if state == VALVE_CLOSED:
+        close_valve(uart, device_address)
+    else:
+        open_valve(uart, device_address)
+    # The cache is empty after a reset, so the first enforcement always writes
+    meter_metrics.phase("first_valve")
+    return True
+
+# Gap before the first retry; doubles on each further attempt
+RETRY_DELAY_MS = 100
+
+def get_valid_volume(uart, address, retries=3, delay_ms=RETRY_DELAY_MS, force=False):
+    """
+    Reads the cumulative flow with retries. A meter that failed before is
+    skipped while it backs off (see meter_health) and otherwise gets one
+    probe, so a dead meter costs one timeout at most. 'force' probes it
+    even during the backoff (e.g. a credit just arrived for it).
+    """
+    now = time.time()
+    if meter_health.degraded(address):
+        if not force and meter_health.backing_off(address, now):
+            return None
+        retries = 1
 
-def get_valid_volume(uart, address, retries=5, delay=1):
     for attempt in range(retries):
         volume_value = read_cumulative_flow(uart, address)
         if volume_value is not None:
+            meter_health.record_ok(address, now)
+            meter_metrics.phase("first_reading")
             return volume_value
-        time.sleep(delay)
+        if attempt < retries - 1:
+            meter_metrics.inc("retries")
+            time.sleep_ms(delay_ms << attempt)
+
+    meter_health.record_failure(address, now)
     return None
 
 def monitor_target(uart, addresses):
@@ -118,65 +382,128 @@ def monitor_target(uart, addresses):
     Standard monitoring function (kept for reference or standalone use).
     """
     for address in addresses:
-        current_volume = get_valid_volume(uart, address)
-        time.sleep(0.2)
+        current_volume = get_valid_volume(uart, address, force=True)
         target_volume_liters = load_target_reading(address)
         
         if target_volume_liters is None:
             if current_volume is not None:
-                save_target_reading(address, current_volume)
+                save_target_reading(address, current_volume, flush=False)
                 target_volume_liters = current_volume
             else:
                 continue
 
-        if current_volume is None: continue 
+        if current_volume is None:
+            invalidate_valve(address)
+            continue
 
         print("Mon Addr: %d | Targ: %s | Curr: %s" % (address, target_volume_liters, current_volume))
+        meter_scheduler.record(address, current_volume, target_volume_liters, time.time())
 
-        if current_volume >= target_volume_liters:
-            close_valve(uart, address)
+        if meter_predict.should_close(address, current_volume, target_volume_liters):
+            enforce_valve(uart, address, VALVE_CLOSED)
         else:
-            open_valve(uart, address)
+            enforce_valve(uart, address, VALVE_OPEN)
+
+    # One store write for any targets initialised above
+    flush_targets(force=True)
 
-def read_meter_parameters_upload(uart, addresses, publish_func, mqtt_client, mqtt_topic):
+def valve_state(device_address):
+    """Cached valve state (VALVE_OPEN / VALVE_CLOSED) or None if unknown."""
+    entry = valve_cache.get(device_address)
+    return entry[0] if entry else None
+
+def sweep_meter(uart, address):
     """
-    Reads meter, enforces valve target logic locally, THEN uploads to MQTT.
+    Reads one meter and enforces its valve target locally.
+    Returns (address, cumulative, target, valve) or None if the meter did not
+    answer. An offline meter returns (address, None, target, None) so the
+    uplink can flag it.
     """
-    for address in addresses:
-        # 1. Read Meter
-        cumulative = get_valid_volume(uart, address)
-        if cumulative is None: continue
-        
-        # 2. Check Target
-        target_volume_liters = load_target_reading(address)
-        if target_volume_liters is None:
-            save_target_reading(address, cumulative)
-            target_volume_liters = cumulative
-        
-        print("Read OK: Curr %s L | Targ %s L" % (cumulative, target_volume_liters))
+    # 1. Read Meter
+    cumulative = get_valid_volume(uart, address)
+    if cumulative is None:
+        invalidate_valve(address)
+        meter_scheduler.record_failure(address, time.time(), meter_health.retry_at(address))
+        if meter_health.offline(address):
+            return (address, None, load_target_reading(address), None)
+        return None
+    
+    # 2. Check Target
+    target_volume_liters = load_target_reading(address)
+    if target_volume_liters is None:
+        save_target_reading(address, cumulative, flush=False)
+        target_volume_liters = cumulative
+    
+    print("Read OK: Addr %d | Curr %s L | Targ %s L" % (address, cumulative, target_volume_liters))
+    meter_scheduler.record(address, cumulative, target_volume_liters, time.time())
 
-        # 3. ENFORCE MONITOR TARGET (Valve Control)
-        # We do this immediately to prevent network latency (crushing) from delaying the valve close
-        if cumulative >= target_volume_liters:
-            close_valve(uart, address)
-        else:
-            open_valve(uart, address)
+    # 3. ENFORCE MONITOR TARGET (Valve Control)
+    # We do this immediately to prevent network latency (crushing) from delaying the valve close.
+    # Falls back to the plain cumulative >= target check when the flow estimate is unreliable.
+    if meter_predict.should_close(address, cumulative, target_volume_liters):
+        enforce_valve(uart, address, VALVE_CLOSED)
+    else:
+        enforce_valve(uart, address, VALVE_OPEN)
+        meter_predict.schedule_check(address, cumulative, target_volume_liters, time.time())
 
-        # 4. Prepare Payload
-        payload = '{"type": "device_report", "device": %d, "cumulative_flow_L": %s, "target_flow": %s}' % (
-            address, cumulative, target_volume_liters
-        )
+    return (address, cumulative, target_volume_liters, valve_state(address))
 
-        # 5. Upload
+def upload_readings(readings, publish_func, mqtt_client, mqtt_topic):
+    """
+    Publishes sweep results: one payload per meter, or one cycle_report in
+    "aggregate" REPORT_MODE. Delta mode skips unchanged meters between keyframes.
+    """
+    now = time.time()
+    changed = []
+    for reading in readings:
+        if should_report(reading[0], reading[1], reading[2], reading[3], now):
+            changed.append(reading)
+    if not changed:
+        return
+
+    if REPORT_MODE == "aggregate":
+        if not meter_scheduler.allow_publish(now):
+            # Nothing is marked reported, so the next sweep sends these meters
+            print("Publish budget spent, skipping cycle report")
+            meter_metrics.inc("publish_skipped")
+            return
+        report.begin()
+        for address, cumulative, target, valve in changed:
+            report.add_meter(address, cumulative, target, valve)
+            mark_reported(address, cumulative, target, valve, now)
         try:
-            publish_func(mqtt_client, mqtt_topic, payload)
+            publish_func(mqtt_client, mqtt_topic, report.payload())
         except:
             pass
+        return
 
-def valve_test(uart, addresses):
-    for address in addresses:
-        open_valve(uart, address)
-    time.sleep(2)
+    for address, cumulative, target, valve in changed:
+        if not meter_scheduler.allow_publish(now):
+            # Left unmarked: reported again on its next poll
+            print("Publish budget spent, skipping Addr %d" % address)
+            meter_metrics.inc("publish_skipped")
+            continue
+        mark_reported(address, cumulative, target, valve, now)
+        try:
+            publish_func(mqtt_client, mqtt_topic, device_report(address, cumulative, target))
+        except:
+            pass
+
+def read_meter_parameters_upload(uart, addresses, publish_func, mqtt_client, mqtt_topic, preempt=None):
+    """
+    Reads meter, enforces valve target logic locally, THEN uploads to MQTT.
+    'preempt' is called between meters so queued commands do not wait
+    for the whole sweep.
+    """
+    readings = []
     for address in addresses:
-        close_valve(uart, address)
-    time.sleep(2)
\ No newline at end of file
+        if preempt is not None:
+            preempt()
+        reading = sweep_meter(uart, address)
+        if reading is not None:
+            readings.append(reading)
+
+    upload_readings(readings, publish_func, mqtt_client, mqtt_topic)
+
+    # One store write for any targets initialised above
+    flush_targets(force=True)
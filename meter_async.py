@@ -0,0 +1,295 @@
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+import time
+import meter
+import meter_bus
+import meter_health
+import meter_scheduler
+import meter_predict
+import meter_metrics
+from meter import (
+    ModbusError, RESPONSE_TIMEOUT_MS, SILENCE_US, CHAR_US,
+    VALVE_REGISTER, VALVE_OPEN, VALVE_CLOSED, VALVE_CONFIRM_INTERVAL,
+    VALVE_SETTLE_MS, RETRY_DELAY_MS, valve_cache, invalidate_valve, valve_state
+)
+from meter_registers import plan_reads, decode_block, FLOW_FIELDS
+from meter_storage import load_target_reading, save_target_reading, flush_targets
+
+# ========== ASYNC CONFIG ==========
+# Reply polling interval. A 9 byte reply takes ~10 ms at 9600 baud, so the
+# loop gets several chances to run other tasks per transaction.
+POLL_MS = 2
+# Granularity of wait_event() (uasyncio has no Event.wait timeout)
+WAIT_SLICE_MS = 100
+# uasyncio v3 API this runtime is written against; older ports lack some
+REQUIRED_API = ("run", "create_task", "gather", "sleep", "Event", "Lock")
+
+def available():
+    """True if the uasyncio found has everything the async runtime uses."""
+    for name in REQUIRED_API:
+        if not hasattr(asyncio, name):
+            print("uasyncio has no %s" % name)
+            return False
+    return True
+
+try:
+    sleep_ms = asyncio.sleep_ms
+except AttributeError:
+    def sleep_ms(ms):
+        return asyncio.sleep(ms / 1000)
+
+async def wait_event(event, timeout_ms):
+    """Waits for 'event' up to 'timeout_ms'. Returns True if it was set."""
+    deadline = time.ticks_add(time.ticks_ms(), int(timeout_ms))
+    while not event.is_set():
+        left = time.ticks_diff(deadline, time.ticks_ms())
+        if left <= 0:
+            return False
+        await sleep_ms(min(left, WAIT_SLICE_MS))
+    return True
+
+class Queue:
+    """
+    Bounded FIFO between tasks of one loop (core uasyncio has none).
+    When full, the oldest item is dropped: for readings the newest sweep
+    is the one worth sending.
+    """
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.items = []
+        self.event = asyncio.Event()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put_nowait(self, item):
+        if len(self.items) >= self.maxsize:
+            self.items.pop(0)
+            self.dropped += 1
+        self.items.append(item)
+        self.event.set()
+
+    async def get(self):
+        while not self.items:
+            self.event.clear()
+            await self.event.wait()
+        return self.items.pop(0)
+
+# ========== RTU TRANSACTION (NON-BLOCKING) ==========
+# One asyncio lock per UART: tasks on the same line take turns per
+# transaction, tasks on different lines overlap.
+_locks = {}
+
+def _lock(uart):
+    lock = _locks.get(id(uart))
+    if lock is None:
+        lock = asyncio.Lock()
+        _locks[id(uart)] = lock
+    return lock
+
+# One lock per meter over read -> decide -> enforce, which spans several
+# transactions: a sweep holding the old target must not close a valve that
+# command_task has just opened for a credit.
+_address_locks = {}
+
+def address_lock(address):
+    lock = _address_locks.get(address)
+    if lock is None:
+        lock = asyncio.Lock()
+        _address_locks[address] = lock
+    return lock
+
+async def _wait_bus_idle(uart, bus):
+    try:
+        if uart.any():
+            uart.read()
+            bus[1] = time.ticks_us()
+    except:
+        pass
+    if bus[1] is None:
+        return
+    idle = time.ticks_diff(time.ticks_us(), bus[1])
+    if idle < SILENCE_US:
+        await sleep_ms((SILENCE_US - idle) // 1000 + 1)
+
+async def _read_frame(uart, bus, function, expected, timeout_ms):
+    """Same end-of-frame rules as meter._read_frame, yielding while the line is quiet."""
+    rx = bytearray()
+    start = time.ticks_us()
+    timeout_us = timeout_ms * 1000
+    last_rx = None
+    while len(rx) < expected:
+        n = uart.any()
+        if n:
+            chunk = uart.read(min(n, expected - len(rx)))
+            if chunk:
+                rx.extend(chunk)
+                last_rx = time.ticks_us()
+            if len(rx) >= 5 and rx[1] == (function | 0x80):
+                break
+            continue
+        now = time.ticks_us()
+        if last_rx is not None:
+            if time.ticks_diff(now, last_rx) >= SILENCE_US:
+                break
+            # Mid-frame: the rest is a few characters away
+            time.sleep_us(CHAR_US)
+            continue
+        if time.ticks_diff(now, start) >= timeout_us:
+            break
+        await sleep_ms(POLL_MS)
+    bus[1] = time.ticks_us()
+    return rx
+
+async def transact(uart, request, expected, timeout_ms=RESPONSE_TIMEOUT_MS):
+    """Async meter.transact: other tasks run while the slave is answering."""
+    bus = meter.bus_state(uart)
+    async with _lock(uart):
+        await _wait_bus_idle(uart, bus)
+        start = time.ticks_us()
+        uart.write(request)
+        rx = await _read_frame(uart, bus, request[1], expected, timeout_ms)
+    meter.last_latency_us = time.ticks_diff(time.ticks_us(), start)
+    meter_metrics.observe("modbus_us", meter.last_latency_us)
+    return meter.check_reply(request, rx, expected, timeout_ms)
+
+# ========== MODBUS FUNCTIONS ==========
+async def read_holding_registers(uart, address, start, count):
+    request = meter.build_modbus_request(address, 0x03, start, count)
+    try:
+        response = await transact(uart, request, 5 + 2 * count)
+    except ModbusError as e:
+        print("Read Err: {}".format(e))
+        return None
+    if response[2] != 2 * count:
+        return None
+    return response
+
+async def read_meter_snapshot(uart, address, names=FLOW_FIELDS):
+    snapshot = {"addr": address}
+    for start, count, fields in plan_reads(names):
+        response = await read_holding_registers(uart, address, start, count)
+        if response is None:
+            return None
+        decode_block(response, 3, start, fields, snapshot)
+    return snapshot
+
+async def get_valid_volume(uart, address, retries=3, delay_ms=RETRY_DELAY_MS, force=False):
+    """meter.get_valid_volume with the same health backoff, without blocking."""
+    now = time.time()
+    if meter_health.degraded(address):
+        if not force and meter_health.backing_off(address, now):
+            return None
+        retries = 1
+
+    for attempt in range(retries):
+        snapshot = await read_meter_snapshot(uart, address, FLOW_FIELDS)
+        if snapshot is not None:
+            meter_health.record_ok(address, now)
+            meter_metrics.phase("first_reading")
+            return snapshot["cumulative_flow"]
+        if attempt < retries - 1:
+            meter_metrics.inc("retries")
+            await sleep_ms(delay_ms << attempt)
+
+    meter_health.record_failure(address, now)
+    return None
+
+# ========== VALVE CONTROL ==========
+async def write_valve(uart, device_address, state):
+    """open_valve / close_valve: write, update the cache, let the motor settle."""
+    frame = meter.build_write_request(device_address, VALVE_REGISTER, state)
+    try:
+        await transact(uart, frame, 8)
+        valve_cache[device_address] = [state, time.time()]
+        if state == VALVE_OPEN:
+            meter_scheduler.wake(device_address, time.time())
+    except ModbusError as e:
+        print("Write Err: {}".format(e))
+        valve_cache.pop(device_address, None)
+    await sleep_ms(VALVE_SETTLE_MS)
+
+async def enforce_valve(uart, device_address, state):
+    """Write-on-change, as meter.enforce_valve."""
+    entry = valve_cache.get(device_address)
+    if entry is not None and entry[0] == state:
+        if time.time() - entry[1] < VALVE_CONFIRM_INTERVAL:
+            return False
+        snapshot = await read_meter_snapshot(uart, device_address, ("valve_status",))
+        if snapshot is not None and snapshot["valve_status"] == state:
+            entry[1] = time.time()
+            return False
+        print("Valve Addr %d: state drifted, rewriting" % device_address)
+    await write_valve(uart, device_address, state)
+    meter_metrics.phase("first_valve")
+    return True
+
+# ========== SWEEP ==========
+async def sweep_meter(uart, address):
+    """Async meter.sweep_meter; same return values."""
+    cumulative = await get_valid_volume(uart, address)
+    if cumulative is None:
+        invalidate_valve(address)
+        meter_scheduler.record_failure(address, time.time(), meter_health.retry_at(address))
+        if meter_health.offline(address):
+            return (address, None, load_target_reading(address), None)
+        return None
+
+    target_volume_liters = load_target_reading(address)
+    if target_volume_liters is None:
+        save_target_reading(address, cumulative, flush=False)
+        target_volume_liters = cumulative
+
+    print("Read OK: Addr %d | Curr %s L | Targ %s L" % (address, cumulative, target_volume_liters))
+    meter_scheduler.record(address, cumulative, target_volume_liters, time.time())
+
+    if meter_predict.should_close(address, cumulative, target_volume_liters):
+        await enforce_valve(uart, address, VALVE_CLOSED)
+    else:
+        await enforce_valve(uart, address, VALVE_OPEN)
+        meter_predict.schedule_check(address, cumulative, target_volume_liters, time.time())
+
+    return (address, cumulative, target_volume_liters, valve_state(address))
+
+async def _sweep_bus(bus, addresses):
+    readings = []
+    for address in addresses:
+        if address in bus.addresses:
+            async with address_lock(address):
+                reading = await sweep_meter(bus.uart, address)
+            if reading is not None:
+                readings.append(reading)
+    return readings
+
+async def sweep(addresses):
+    """Sweeps 'addresses' with one task per bus. Returns the combined readings."""
+    results = await asyncio.gather(*[_sweep_bus(bus, addresses) for bus in meter_bus.buses])
+    readings = []
+    for bus_readings in results:
+        readings.extend(bus_readings)
+    return readings
+
+async def monitor(uart, address):
+    """meter.monitor_target for one meter (after a credit)."""
+    current_volume = await get_valid_volume(uart, address, force=True)
+    target_volume_liters = load_target_reading(address)
+    if target_volume_liters is None:
+        if current_volume is None:
+            return
+        save_target_reading(address, current_volume, flush=False)
+        target_volume_liters = current_volume
+    if current_volume is None:
+        invalidate_valve(address)
+        flush_targets(force=True)
+        return
+
+    print("Mon Addr: %d | Targ: %s | Curr: %s" % (address, target_volume_liters, current_volume))
+    meter_scheduler.record(address, current_volume, target_volume_liters, time.time())
+    if meter_predict.should_close(address, current_volume, target_volume_liters):
+        await enforce_valve(uart, address, VALVE_CLOSED)
+    else:
+        await enforce_valve(uart, address, VALVE_OPEN)
+    flush_targets(force=True)
@@ -0,0 +1,97 @@
+import time
+from meter import calculate_crc, verify_crc, build_modbus_request, CRC_TABLE
+
+# ========== TIMING HELPERS ==========
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except AttributeError:
+    # CPython fallback so the same script runs on a host
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+# ========== REFERENCE CRC (previous implementation) ==========
+def crc_bitwise(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 0x0001:
+                crc >>= 1
+                crc ^= 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+def verify_crc_bitwise(frame):
+    if not frame or len(frame) < 3:
+        return False
+    received_crc = frame[-2] | (frame[-1] << 8)
+    return crc_bitwise(frame[:-2]) == received_crc
+
+# ========== SAMPLE FRAMES ==========
+def sample_frames():
+    """Typical traffic: read requests, a 0x03 reply and a write request."""
+    frames = []
+    for addr in range(1, 7):
+        frames.append(build_modbus_request(addr, 0x03, 0x000E, 0x02))
+    reply = bytearray([0x06, 0x03, 0x04, 0x12, 0x34, 0x00, 0x01])
+    crc = crc_bitwise(reply)
+    reply += bytearray([crc & 0xFF, (crc >> 8) & 0xFF])
+    frames.append(reply)
+    write = bytearray([0x06, 0x10, 0x00, 0x60, 0x00, 0x01, 0x02, 0x00, 0x02])
+    crc = crc_bitwise(write)
+    write += bytearray([crc & 0xFF, (crc >> 8) & 0xFF])
+    frames.append(write)
+    return frames
+
+# ========== CHECKS ==========
+def check_equivalence():
+    """Table CRC must match the bit-by-bit CRC on every byte pattern we use."""
+    for i in range(256):
+        if calculate_crc(bytes([i])) != crc_bitwise(bytes([i])):
+            raise AssertionError("CRC mismatch on byte 0x%02X" % i)
+    for frame in sample_frames():
+        body = frame[:-2]
+        if calculate_crc(body) != crc_bitwise(body):
+            raise AssertionError("CRC mismatch on frame %s" % frame)
+        if calculate_crc(memoryview(frame), 0, len(frame) - 2) != crc_bitwise(body):
+            raise AssertionError("memoryview CRC mismatch on frame %s" % frame)
+        if verify_crc(frame) != verify_crc_bitwise(frame):
+            raise AssertionError("verify_crc mismatch on frame %s" % frame)
+    bad = bytearray(sample_frames()[0])
+    bad[-1] ^= 0xFF
+    if verify_crc(bad):
+        raise AssertionError("Corrupted frame passed verify_crc")
+    print("✔ Table CRC matches bitwise CRC (%d table entries)" % len(CRC_TABLE))
+
+# ========== BENCHMARK ==========
+def _frames_per_sec(func, frames, rounds):
+    start = ticks_us()
+    for _ in range(rounds):
+        for frame in frames:
+            func(frame)
+    elapsed = ticks_diff(ticks_us(), start)
+    if elapsed <= 0:
+        elapsed = 1
+    return (rounds * len(frames) * 1000000) // elapsed
+
+def run(rounds=200):
+    check_equivalence()
+    frames = sample_frames()
+
+    before = _frames_per_sec(verify_crc_bitwise, frames, rounds)
+    after = _frames_per_sec(verify_crc, frames, rounds)
+    print("verify_crc  bitwise: %d frames/s" % before)
+    print("verify_crc  table:   %d frames/s (x%.1f)" % (after, after / max(before, 1)))
+
+    before = _frames_per_sec(crc_bitwise, frames, rounds)
+    after = _frames_per_sec(calculate_crc, frames, rounds)
+    print("calc_crc    bitwise: %d frames/s" % before)
+    print("calc_crc    table:   %d frames/s (x%.1f)" % (after, after / max(before, 1)))
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,176 @@
+import _thread
+import utime
+import globals
+from machine import UART
+import meter
+
+# ========== BUS CONFIG ==========
+# Optional in globals.py; without it every address is on meter.uart (UART2):
+# BUSES = [
+#     {"uart": 2, "tx": 19, "rx": 18, "addresses": [1, 2, 3]},
+#     {"uart": 1, "tx": 32, "rx": 33, "addresses": [4, 5, 6]},
+# ]
+BUS_CONFIG = getattr(globals, "BUSES", None)
+# Idle workers check for new work this often
+WORKER_POLL_MS = 20
+# A sweep waiting on a worker longer than this is abandoned (hung bus)
+SWEEP_TIMEOUT_S = 120
+
+class Bus:
+    """One RS-485 line: its UART, the addresses on it and its worker state."""
+    def __init__(self, name, uart, addresses):
+        self.name = name
+        self.uart = uart
+        self.addresses = addresses
+        self.work = None
+        self.busy = False
+
+buses = []
+# address -> Bus
+_by_address = {}
+
+# Shared sweep results {address: (address, cumulative, target, valve)}
+snapshot = {}
+snapshot_lock = _thread.allocate_lock()
+
+# address -> lock over one meter's read -> decide -> enforce (see address_lock)
+_address_locks = {}
+_address_locks_guard = _thread.allocate_lock()
+
+# ========== SETUP ==========
+def setup(default_addresses, workers=True):
+    """
+    Builds the bus list from globals.BUSES (or one bus on meter.uart) and
+    starts a worker thread per bus when there is more than one. The async
+    runtime passes workers=False and sweeps the buses as tasks instead.
+    """
+    if buses:
+        return buses
+    if not BUS_CONFIG:
+        buses.append(Bus("bus0", meter.uart, list(default_addresses)))
+    else:
+        for i, cfg in enumerate(BUS_CONFIG):
+            if cfg.get("uart", 2) == 2 and cfg.get("tx", 19) == 19 and cfg.get("rx", 18) == 18:
+                uart = meter.uart
+            else:
+                uart = UART(cfg["uart"], baudrate=cfg.get("baud", meter.UART_BAUD), bits=8,
+                            parity=1, stop=1, tx=cfg["tx"], rx=cfg["rx"])
+            buses.append(Bus("bus%d" % i, uart, list(cfg["addresses"])))
+
+    for bus in buses:
+        for address in bus.addresses:
+            _by_address[address] = bus
+
+    if workers and len(buses) > 1:
+        for bus in buses:
+            _thread.start_new_thread("Modbus_" + bus.name, _worker, (bus,))
+    print("[Bus] %d bus(es): %s" % (len(buses), ", ".join(
+        "%s=%s" % (b.name, b.addresses) for b in buses)))
+    return buses
+
+def uart_for(address):
+    """UART serving this address (meter.uart for unknown addresses)."""
+    bus = _by_address.get(address)
+    return bus.uart if bus else meter.uart
+
+def address_lock(address):
+    """
+    Held while a meter is swept or a command acts on it. The UART lock only
+    covers one transaction, so without this a bus worker holding the old
+    target could close a valve the command path has just opened.
+    """
+    lock = _address_locks.get(address)
+    if lock is None:
+        with _address_locks_guard:
+            lock = _address_locks.get(address)
+            if lock is None:
+                lock = _thread.allocate_lock()
+                _address_locks[address] = lock
+    return lock
+
+def all_addresses():
+    out = []
+    for bus in buses:
+        out.extend(bus.addresses)
+    return out
+
+# ========== WORKERS ==========
+def _store(address, reading):
+    with snapshot_lock:
+        if reading is None:
+            snapshot.pop(address, None)
+        else:
+            snapshot[address] = reading
+
+def _sweep_bus(bus, addresses):
+    readings = []
+    for address in addresses:
+        with address_lock(address):
+            reading = meter.sweep_meter(bus.uart, address)
+        _store(address, reading)
+        if reading is not None:
+            readings.append(reading)
+    return readings
+
+def _worker(bus):
+    while True:
+        work = bus.work
+        if work is None:
+            utime.sleep_ms(WORKER_POLL_MS)
+            continue
+        try:
+            _sweep_bus(bus, work)
+        except Exception as e:
+            print("[Bus] %s sweep error: %s" % (bus.name, e))
+        bus.work = None
+        bus.busy = False
+
+# ========== SWEEP ==========
+def sweep(addresses, publish_func, mqtt_client, mqtt_topic, preempt=None):
+    """
+    Reads and enforces 'addresses' on every bus, then uploads the combined
+    results. With one bus this runs inline (same as read_meter_parameters_upload);
+    with several, each bus worker sweeps its own meters concurrently while
+    this thread keeps servicing commands through 'preempt'.
+    """
+    if len(buses) <= 1:
+        readings = []
+        for address in addresses:
+            if preempt is not None:
+                preempt()
+            with address_lock(address):
+                reading = meter.sweep_meter(uart_for(address), address)
+            _store(address, reading)
+            if reading is not None:
+                readings.append(reading)
+    else:
+        with snapshot_lock:
+            for address in addresses:
+                snapshot.pop(address, None)
+        active = []
+        for bus in buses:
+            work = [a for a in addresses if _by_address.get(a) is bus]
+            if work:
+                bus.busy = True
+                bus.work = work
+                active.append(bus)
+
+        deadline = utime.time() + SWEEP_TIMEOUT_S
+        while any(bus.busy for bus in active):
+            if utime.time() > deadline:
+                print("[Bus] Sweep timeout, uploading partial results")
+                break
+            if preempt is not None:
+                preempt()
+            utime.sleep_ms(WORKER_POLL_MS)
+
+        readings = []
+        with snapshot_lock:
+            for address in addresses:
+                reading = snapshot.get(address)
+                if reading is not None:
+                    readings.append(reading)
+
+    meter.upload_readings(readings, publish_func, mqtt_client, mqtt_topic)
+    meter.flush_targets(force=True)
+    return readings
@@ -0,0 +1,192 @@
+import _thread
+import utime
+import globals
+
+# ========== QUEUE CONFIG ==========
+CMD_QUEUE_SIZE = getattr(globals, "CMD_QUEUE_SIZE", 16)
+
+# Lower number runs first. Closing a valve protects credit, loads add it,
+# opening can wait. Anything else (diagnostics etc.) goes last.
+PRIORITY = {
+    "valve_close": 0,
+    "success": 1,
+    "valve_open": 2,
+}
+LOWEST_PRIORITY = 3
+
+VALVE_COMMANDS = ("valve_open", "valve_close")
+
+# Rejected loads kept for a load_rejected report (a burst beyond this is
+# only counted in 'overflow'; the backend sees no ack for those either)
+REJECTED_MAX = 32
+
+# How often a waiting consumer checks the wake flag. A lock cannot be
+# acquired with a timeout on this firmware, so wait() sleeps in slices.
+WAKE_POLL_MS = 50
+
+# ========== COMMAND QUEUE ==========
+class CommandQueue:
+    """
+    Fixed-capacity priority queue shared by the MQTT thread (put) and the
+    monitor thread (get). One ring per priority class; removed entries are
+    left as None and skipped. Every method holds the lock briefly.
+    """
+    def __init__(self, capacity=CMD_QUEUE_SIZE):
+        self.capacity = capacity
+        self.lock = _thread.allocate_lock()
+        self._rings = [[None] * capacity for _ in range(LOWEST_PRIORITY + 1)]
+        self._heads = [0] * (LOWEST_PRIORITY + 1)
+        self._sizes = [0] * (LOWEST_PRIORITY + 1)
+        self._live = 0
+        self._wake = False
+        self.accepted = 0
+        self.coalesced = 0
+        self.evicted = 0
+        self.overflow = 0
+        # Loads turned away by a full queue, waiting to be reported back
+        self.rejected = []
+
+    def __len__(self):
+        return self._live
+
+    # ----- ring helpers (lock held) -----
+    def _compact(self, prio):
+        ring = self._rings[prio]
+        head = self._heads[prio]
+        items = []
+        for i in range(self._sizes[prio]):
+            item = ring[(head + i) % self.capacity]
+            if item is not None:
+                items.append(item)
+        for i in range(self.capacity):
+            ring[i] = items[i] if i < len(items) else None
+        self._heads[prio] = 0
+        self._sizes[prio] = len(items)
+
+    def _push(self, prio, item):
+        if self._sizes[prio] == self.capacity:
+            self._compact(prio)
+        ring = self._rings[prio]
+        ring[(self._heads[prio] + self._sizes[prio]) % self.capacity] = item
+        self._sizes[prio] += 1
+        self._live += 1
+
+    def _pop(self, prio):
+        ring = self._rings[prio]
+        while self._sizes[prio]:
+            head = self._heads[prio]
+            item = ring[head]
+            ring[head] = None
+            self._heads[prio] = (head + 1) % self.capacity
+            self._sizes[prio] -= 1
+            if item is not None:
+                self._live -= 1
+                return item
+        return None
+
+    def _remove_newest(self, prio):
+        ring = self._rings[prio]
+        for i in range(self._sizes[prio] - 1, -1, -1):
+            idx = (self._heads[prio] + i) % self.capacity
+            if ring[idx] is not None:
+                ring[idx] = None
+                self._live -= 1
+                return True
+        return False
+
+    def _drop_valve_commands(self, addr):
+        """Removes pending valve commands for 'addr'; the newest one wins."""
+        for cmd in VALVE_COMMANDS:
+            prio = PRIORITY[cmd]
+            ring = self._rings[prio]
+            for i in range(self._sizes[prio]):
+                idx = (self._heads[prio] + i) % self.capacity
+                item = ring[idx]
+                if item is not None and item['addr'] == addr:
+                    ring[idx] = None
+                    self._live -= 1
+                    self.coalesced += 1
+
+    # ----- public API -----
+    def put(self, item):
+        """
+        Queues a command dict ({"type", "addr", ...}). Returns False if it
+        was rejected because the queue is full of loads or equal/higher
+        priority work. A rejected load is kept for take_rejected() so the
+        backend can be told to send it again.
+        """
+        prio = PRIORITY.get(item.get('type'), LOWEST_PRIORITY)
+        is_load = item.get('type') == "success"
+        with self.lock:
+            if item.get('type') in VALVE_COMMANDS:
+                self._drop_valve_commands(item['addr'])
+
+            if self._live >= self.capacity:
+                # Make room by dropping the newest, least important command.
+                # Paid loads are never evicted, and may evict any other kind.
+                last = -1 if is_load else prio
+                for victim in range(LOWEST_PRIORITY, last, -1):
+                    if victim != PRIORITY["success"] and self._remove_newest(victim):
+                        self.evicted += 1
+                        break
+                else:
+                    self.overflow += 1
+                    if is_load and len(self.rejected) < REJECTED_MAX:
+                        self.rejected.append(item)
+                        self._wake = True
+                    return False
+
+            self._push(prio, item)
+            self.accepted += 1
+            self._wake = True
+            return True
+
+    def get(self):
+        """Returns the next command by priority (FIFO within a class), or None."""
+        with self.lock:
+            if not self._live:
+                return None
+            for prio in range(LOWEST_PRIORITY + 1):
+                item = self._pop(prio)
+                if item is not None:
+                    return item
+            return None
+
+    def take_rejected(self):
+        """Returns and clears the loads put() turned away."""
+        with self.lock:
+            items = self.rejected
+            self.rejected = []
+            return items
+
+    def signal(self):
+        """Wakes a consumer blocked in wait() without queuing anything."""
+        self._wake = True
+
+    def wait(self, timeout_s):
+        """
+        Sleeps up to 'timeout_s' seconds, returning early (True) as soon as
+        a command is queued or signal() is called.
+        """
+        deadline = utime.ticks_add(utime.ticks_ms(), int(timeout_s * 1000))
+        while not self._wake and not self._live:
+            left = utime.ticks_diff(deadline, utime.ticks_ms())
+            if left <= 0:
+                return False
+            utime.sleep_ms(min(left, WAKE_POLL_MS))
+        self._wake = False
+        return True
+
+    def stats(self):
+        """Counters since boot, published as cmd_* telemetry gauges."""
+        return {
+            "depth": self._live,
+            "accepted": self.accepted,
+            "coalesced": self.coalesced,
+            "evicted": self.evicted,
+            "overflow": self.overflow,
+            "rejected": len(self.rejected)
+        }
+
+# Shared instance: meter_mqtts.datacb puts, main.process_command_queue gets
+commands = CommandQueue()
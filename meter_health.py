@@ -0,0 +1,71 @@
+import globals
+
+# ========== HEALTH CONFIG ==========
+# A read where every retry failed counts as one failure. From the first one
+# the meter is "degraded": it is skipped until its backoff expires, then
+# gets a single quick probe instead of the full retry sequence.
+HEALTH_BACKOFF_BASE_S = getattr(globals, "HEALTH_BACKOFF_BASE_S", 60)
+HEALTH_BACKOFF_MAX_S = getattr(globals, "HEALTH_BACKOFF_MAX_S", 1800)
+# Consecutive failures before the meter is reported offline
+HEALTH_OFFLINE_AFTER = getattr(globals, "HEALTH_OFFLINE_AFTER", 3)
+
+# Per-meter state: {address: [failures, retry_at, last_ok, total_failures]}
+meters = {}
+
+def _entry(address):
+    entry = meters.get(address)
+    if entry is None:
+        entry = [0, 0, None, 0]
+        meters[address] = entry
+    return entry
+
+# ========== PUBLIC API ==========
+def degraded(address):
+    """True once a meter has failed a full read and not answered since."""
+    entry = meters.get(address)
+    return entry is not None and entry[0] > 0
+
+def offline(address):
+    entry = meters.get(address)
+    return entry is not None and entry[0] >= HEALTH_OFFLINE_AFTER
+
+def backing_off(address, now):
+    """True while a degraded meter should not be touched at all."""
+    entry = meters.get(address)
+    return entry is not None and entry[0] > 0 and now < entry[1]
+
+def retry_at(address):
+    entry = meters.get(address)
+    return entry[1] if entry else 0
+
+def record_ok(address, now):
+    entry = _entry(address)
+    if entry[0]:
+        print("✔ Meter %d back after %d failed reads" % (address, entry[0]))
+    entry[0] = 0
+    entry[1] = 0
+    entry[2] = now
+
+def record_failure(address, now):
+    """Counts a failed read and returns when the next probe is allowed."""
+    entry = _entry(address)
+    entry[0] += 1
+    entry[3] += 1
+    # 60 s, 120 s, 240 s ... up to the cap
+    backoff = min(HEALTH_BACKOFF_BASE_S << min(entry[0] - 1, 10), HEALTH_BACKOFF_MAX_S)
+    entry[1] = now + backoff
+    if entry[0] == HEALTH_OFFLINE_AFTER:
+        print("⚠️ Meter %d offline after %d failed reads" % (address, entry[0]))
+    return entry[1]
+
+def stats():
+    """For telemetry: meters offline now, and failed reads per meter since boot."""
+    offline_now = []
+    failures = {}
+    for address, entry in meters.items():
+        if entry[0] >= HEALTH_OFFLINE_AFTER:
+            offline_now.append(address)
+        if entry[3]:
+            # String keys: the payload must be valid JSON for the backend
+            failures[str(address)] = entry[3]
+    return {"offline": offline_now, "failures": failures}
@@ -0,0 +1,221 @@
+import os
+import struct
+import utime
+from meter import calculate_crc
+from meter_storage import (
+    TARGET_DIR, read_json_recover, write_json_atomic,
+    load_target_reading, save_target_reading, load_applied_seq
+)
+
+# ========== LEDGER CONFIG ==========
+# Append-only credit events, fixed 32 byte records
+LEDGER_FILE = TARGET_DIR + '/ledger.bin'
+# Per-address totals folded in from compacted records
+CHECKPOINT_FILE = TARGET_DIR + '/ledger_ckpt.json'
+# Compact once the ledger holds this many records
+COMPACT_THRESHOLD = 256
+
+# seq, address, litres (mL), timestamp, deviceID, crc16
+RECORD_FORMAT = '<IBxII16sH'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+_BODY_SIZE = RECORD_SIZE - 2
+
+# In-RAM index {address: [total_ml, count, last_seq]}
+_index = None
+_next_seq = 1
+_records = 0
+
+# ========== HELPERS ==========
+def _to_ml(litres):
+    return int(round(litres * 1000))
+
+def _to_litres(ml):
+    if ml % 1000 == 0:
+        return ml // 1000
+    return ml / 1000
+
+def _pack(seq, address, ml, timestamp, device_id):
+    dev = device_id.encode() if isinstance(device_id, str) else (device_id or b'')
+    body = struct.pack(RECORD_FORMAT[:-1], seq, address, ml, timestamp, dev[:16])
+    crc = calculate_crc(body)
+    return body + struct.pack('<H', crc)
+
+def _unpack(raw):
+    """Returns (seq, address, ml, timestamp, device_id) or None for a torn/corrupt record."""
+    if len(raw) != RECORD_SIZE:
+        return None
+    crc = raw[_BODY_SIZE] | (raw[_BODY_SIZE + 1] << 8)
+    if calculate_crc(raw, 0, _BODY_SIZE) != crc:
+        return None
+    seq, address, ml, timestamp, dev, _ = struct.unpack(RECORD_FORMAT, raw)
+    return seq, address, ml, timestamp, dev.rstrip(b'\x00').decode()
+
+def _index_add(seq, address, ml):
+    entry = _index.get(address)
+    if entry is None:
+        _index[address] = [ml, 1, seq]
+    else:
+        entry[0] += ml
+        entry[1] += 1
+        entry[2] = seq
+
+def _scan():
+    """Yields every valid record after the checkpoint. Stops at a torn tail."""
+    try:
+        f = open(LEDGER_FILE, 'rb')
+    except OSError:
+        return
+    with f:
+        while True:
+            raw = f.read(RECORD_SIZE)
+            if not raw:
+                return
+            record = _unpack(raw)
+            if record is None:
+                print("⚠ Ledger: torn record, ignoring tail")
+                return
+            yield record
+
+def _rewrite(records):
+    """Replaces the ledger with 'records' (used to drop a torn tail)."""
+    tmp = LEDGER_FILE + '.tmp'
+    with open(tmp, 'wb') as f:
+        for seq, address, ml, timestamp, dev in records:
+            f.write(_pack(seq, address, ml, timestamp, dev))
+    try:
+        os.remove(LEDGER_FILE)
+    except OSError:
+        pass
+    os.rename(tmp, LEDGER_FILE)
+
+# ========== PUBLIC API ==========
+def load():
+    """
+    Builds the index from the checkpoint plus the (bounded) ledger tail.
+    Returns the records that are not yet applied to their target.
+    """
+    global _index, _next_seq, _records
+    _index = {}
+    _next_seq = 1
+    _records = 0
+
+    ckpt = read_json_recover(CHECKPOINT_FILE)
+    if ckpt:
+        _next_seq = ckpt.get("next_seq", 1)
+        for key, entry in ckpt.get("balances", {}).items():
+            _index[int(key)] = entry
+
+    first_new = _next_seq
+    kept = []
+    pending = []
+    size = 0
+    for record in _scan():
+        seq, address, ml = record[0], record[1], record[2]
+        size += RECORD_SIZE
+        # Already folded into the checkpoint (crash between checkpoint and truncate)
+        if seq < first_new:
+            continue
+        kept.append(record)
+        _index_add(seq, address, ml)
+        _next_seq = seq + 1
+        if seq > load_applied_seq(address):
+            pending.append(record)
+
+    try:
+        on_disk = os.stat(LEDGER_FILE)[6]
+    except OSError:
+        on_disk = 0
+    if on_disk != size or len(kept) * RECORD_SIZE != size:
+        _rewrite(kept)
+    _records = len(kept)
+
+    print("📒 Ledger: %d records, %d addresses, %d pending" % (_records, len(_index), len(pending)))
+    return pending
+
+def _ensure_loaded():
+    if _index is None:
+        load()
+
+def append_credit(address, litres, device_id, timestamp=None):
+    """
+    Durably records a credit before it is applied. Returns its sequence number,
+    which the caller passes to save_target_reading(..., seq=seq).
+    """
+    global _next_seq, _records
+    _ensure_loaded()
+    if timestamp is None:
+        timestamp = int(utime.time())
+    seq = _next_seq
+    ml = _to_ml(litres)
+
+    try:
+        os.mkdir(TARGET_DIR)
+    except OSError:
+        pass
+    with open(LEDGER_FILE, 'ab') as f:
+        f.write(_pack(seq, address, ml, timestamp, device_id))
+    try:
+        os.sync()
+    except AttributeError:
+        pass
+
+    _next_seq = seq + 1
+    _records += 1
+    _index_add(seq, address, ml)
+    return seq
+
+def apply_credit(address, litres, seq):
+    """Adds a logged credit to the target and marks it applied in the same store write."""
+    current = load_target_reading(address)
+    if current is None:
+        current = 0
+    new_target = current + litres
+    save_target_reading(address, new_target, seq=seq)
+    return new_target
+
+def apply_pending(pending=None):
+    """Applies credits that were logged but not applied (power lost mid-load)."""
+    if pending is None:
+        pending = load()
+    for seq, address, ml, timestamp, dev in pending:
+        if seq > load_applied_seq(address):
+            new_target = apply_credit(address, _to_litres(ml), seq)
+            print("📒 Ledger: replayed credit #%d for Addr %d -> %s L" % (seq, address, new_target))
+    compact()
+
+def stats():
+    """
+    For telemetry: {"credits": {address: [litres_credited, last_seq]}}.
+    Lets the backend reconcile the loads it sold with what each meter
+    actually logged; the live balance is target minus reading.
+    """
+    _ensure_loaded()
+    credits = {}
+    for address, entry in _index.items():
+        credits[str(address)] = [_to_litres(entry[0]), entry[2]]
+    return {"credits": credits}
+
+def compact(force=False):
+    """
+    Folds the ledger into the checkpoint once it grows past COMPACT_THRESHOLD,
+    so replay at boot stays bounded. Only runs when every record is applied.
+    """
+    global _records
+    _ensure_loaded()
+    if _records == 0 or (not force and _records < COMPACT_THRESHOLD):
+        return False
+    for address, entry in _index.items():
+        if entry[2] > load_applied_seq(address):
+            return False
+
+    balances = {}
+    for address, entry in _index.items():
+        balances[str(address)] = entry
+    write_json_atomic(CHECKPOINT_FILE, {"next_seq": _next_seq, "balances": balances})
+    try:
+        os.remove(LEDGER_FILE)
+    except OSError:
+        pass
+    print("📒 Ledger compacted: %d records into checkpoint" % _records)
+    _records = 0
+    return True
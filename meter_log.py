@@ -0,0 +1,202 @@
+import os
+import _thread
+import utime
+import json
+import globals
+
+# ========== LOG CONFIG ==========
+LOG_FILE = "system_error.log"
+# Rotation: LOG_FILE, LOG_FILE.1 ... LOG_FILE.<LOG_FILES-1>, each up to LOG_FILE_BYTES
+LOG_FILES = getattr(globals, "LOG_FILES", 3)
+LOG_FILE_BYTES = getattr(globals, "LOG_FILE_BYTES", 8192)
+# Levels written to flash; everything else is console and RAM only
+PERSIST_LEVELS = ("ERROR", "BOOT", "WARN")
+# Flash lines are batched until this many are pending or LOG_FLUSH_S passed
+LOG_FLUSH_LINES = 8
+LOG_FLUSH_S = 300
+# Recent lines of every level kept in RAM (for log_tail)
+LOG_RAM_LINES = 32
+# The same message (first LOG_KEY_CHARS characters) is logged at most
+# LOG_RATE_PER_MIN times a minute; the rest are counted and summarised
+LOG_RATE_PER_MIN = getattr(globals, "LOG_RATE_PER_MIN", 6)
+LOG_KEY_CHARS = 24
+MAX_RATE_KEYS = 16
+# log_tail upload: default size, chunk size and gap between chunks
+LOG_TAIL_BYTES = 2048
+LOG_CHUNK_BYTES = 512
+LOG_CHUNK_GAP_MS = 200
+GATEWAY_ID = globals.MQTT_CLIENT_ID
+
+_lock = _thread.allocate_lock()
+_ram = [None] * LOG_RAM_LINES
+_ram_next = 0
+_pending = []
+_last_flush = utime.time()
+# Repeat suppression: last message and how often it repeated since
+_last = [None, None, 0]
+# {key: [minute_start, count, suppressed]}
+_rates = {}
+dropped = 0
+
+# ========== FORMATTING ==========
+def _format(msg, level):
+    t = utime.localtime()
+    return "[{:02d}-{:02d} {:02d}:{:02d}:{:02d}] [{}] {}".format(
+        t[1], t[2], t[3], t[4], t[5], level, msg)
+
+def _rate_ok(msg, now):
+    """Per-message rate limit. Returns (allowed, suppressed_since_last)."""
+    global dropped
+    key = msg[:LOG_KEY_CHARS]
+    entry = _rates.get(key)
+    if entry is None or now - entry[0] >= 60:
+        if entry is None and len(_rates) >= MAX_RATE_KEYS:
+            _rates.clear()
+        suppressed = entry[2] if entry else 0
+        _rates[key] = [now, 1, 0]
+        return True, suppressed
+    if entry[1] >= LOG_RATE_PER_MIN:
+        entry[2] += 1
+        dropped += 1
+        return False, 0
+    entry[1] += 1
+    return True, 0
+
+def _emit(line, level):
+    """Console, RAM ring and (for persisted levels) the flash batch. Lock held."""
+    global _ram_next
+    print(line)
+    _ram[_ram_next] = line
+    _ram_next = (_ram_next + 1) % LOG_RAM_LINES
+    if level in PERSIST_LEVELS:
+        _pending.append(line)
+
+# ========== PUBLIC API ==========
+def log(msg, level="INFO"):
+    """Logs one message: repeats and floods are folded, errors batched to flash."""
+    try:
+        now = utime.time()
+        with _lock:
+            if msg == _last[0] and level == _last[1]:
+                _last[2] += 1
+                return
+            if _last[2]:
+                _emit(_format("(last message repeated %d times)" % _last[2], _last[1]), _last[1])
+            _last[0] = msg
+            _last[1] = level
+            _last[2] = 0
+
+            allowed, suppressed = _rate_ok(msg, now)
+            if not allowed:
+                return
+            if suppressed:
+                msg = "%s (+%d suppressed)" % (msg, suppressed)
+            _emit(_format(msg, level), level)
+            due = len(_pending) >= LOG_FLUSH_LINES
+        if due:
+            flush()
+    except Exception:
+        print(msg)
+
+def maybe_flush(now):
+    """Periodic flush for lines that did not fill a batch."""
+    if _pending and now - _last_flush >= LOG_FLUSH_S:
+        flush()
+
+def _size(path):
+    try:
+        return os.stat(path)[6]
+    except OSError:
+        return -1
+
+def _rotate():
+    """LOG_FILE -> .1 -> .2 ...; the oldest file is dropped."""
+    oldest = "%s.%d" % (LOG_FILE, LOG_FILES - 1)
+    if LOG_FILES < 2:
+        oldest = LOG_FILE
+    try:
+        os.remove(oldest)
+    except OSError:
+        pass
+    for i in range(LOG_FILES - 2, 0, -1):
+        try:
+            os.rename("%s.%d" % (LOG_FILE, i), "%s.%d" % (LOG_FILE, i + 1))
+        except OSError:
+            pass
+    if LOG_FILES > 1:
+        try:
+            os.rename(LOG_FILE, LOG_FILE + ".1")
+        except OSError:
+            pass
+
+def flush():
+    """Writes pending lines in one append (rotating first if the file would overflow)."""
+    global _last_flush
+    with _lock:
+        if _last[2] and _last[1] in PERSIST_LEVELS:
+            _pending.append(_format("(last message repeated %d times)" % _last[2], _last[1]))
+            _last[2] = 0
+        if not _pending:
+            return
+        data = "\n".join(_pending) + "\n"
+        del _pending[:]
+        _last_flush = utime.time()
+        try:
+            if _size(LOG_FILE) + len(data) > LOG_FILE_BYTES:
+                _rotate()
+            with open(LOG_FILE, "a") as f:
+                f.write(data)
+        except Exception as e:
+            print("❌ Log write failed: %s" % str(e))
+
+def tail(nbytes=LOG_TAIL_BYTES):
+    """Last 'nbytes' of the flash log (newest file and, if short, the ones before)."""
+    flush()
+    out = b""
+    for i in range(LOG_FILES):
+        path = LOG_FILE if i == 0 else "%s.%d" % (LOG_FILE, i)
+        size = _size(path)
+        if size <= 0:
+            continue
+        want = nbytes - len(out)
+        try:
+            with open(path, "rb") as f:
+                if size > want:
+                    f.seek(size - want)
+                out = f.read() + out
+        except Exception as e:
+            print("❌ Log read failed: %s" % str(e))
+            break
+        if len(out) >= nbytes:
+            break
+    # The cut may land inside a multi-byte character (emoji); skip to the next one
+    start = 0
+    while start < len(out) and (out[start] & 0xC0) == 0x80:
+        start += 1
+    return out[start:].decode()
+
+def recent():
+    """RAM ring, oldest first."""
+    with _lock:
+        lines = _ram[_ram_next:] + _ram[:_ram_next]
+    return [line for line in lines if line is not None]
+
+def upload_tail(publish_func, mqtt_client, mqtt_topic, nbytes=None):
+    """
+    Publishes the flash log tail followed by the RAM ring as
+    {"type": "log_tail", "seq", "of", "data"} chunks. Returns chunks sent.
+    """
+    text = tail(nbytes or LOG_TAIL_BYTES) + "--- recent ---\n" + "\n".join(recent())
+    chunks = (len(text) + LOG_CHUNK_BYTES - 1) // LOG_CHUNK_BYTES
+    for seq in range(chunks):
+        payload = json.dumps({
+            "type": "log_tail",
+            "gateway": GATEWAY_ID,
+            "seq": seq,
+            "of": chunks,
+            "data": text[seq * LOG_CHUNK_BYTES:(seq + 1) * LOG_CHUNK_BYTES],
+        })
+        if not publish_func(mqtt_client, mqtt_topic, payload):
+            return seq
+        utime.sleep_ms(LOG_CHUNK_GAP_MS)
+    return chunks
@@ -0,0 +1,145 @@
+import utime
+import json
+import globals
+import meter_log
+
+# ========== METRICS CONFIG ==========
+# Seconds between telemetry messages (0 disables them)
+TELEMETRY_INTERVAL_S = getattr(globals, "TELEMETRY_INTERVAL_S", 3600)
+GATEWAY_ID = globals.MQTT_CLIENT_ID
+# Reset reasons survive the reboot they cause, so they are kept on flash
+RESETS_FILE = "metrics_resets.json"
+
+# ========== REGISTRY ==========
+# Plain dicts, no lock: an increment lost to a thread switch is acceptable
+# for telemetry, a lock on every Modbus frame is not.
+# {name: count}
+counters = {}
+# {name: [count, total, min, max]}
+timers = {}
+# {name: {address: count}}
+per_address = {}
+# {name: value} (last value wins)
+gauges = {}
+
+boot_ticks = utime.ticks_ms()
+period_start = utime.time()
+_last_publish = utime.time()
+_resets = None
+
+# ticks_ms() (ms since reset) when each boot phase was first reached:
+# import, gsm, init, first_reading, first_valve, first_publish
+phases = {}
+_boot_sent = False
+
+def inc(name, n=1):
+    counters[name] = counters.get(name, 0) + n
+
+def inc_addr(name, address):
+    table = per_address.get(name)
+    if table is None:
+        table = {}
+        per_address[name] = table
+    table[address] = table.get(address, 0) + 1
+
+def observe(name, value):
+    t = timers.get(name)
+    if t is None:
+        timers[name] = [1, value, value, value]
+        return
+    t[0] += 1
+    t[1] += value
+    if value < t[2]:
+        t[2] = value
+    if value > t[3]:
+        t[3] = value
+
+def gauge(name, value):
+    gauges[name] = value
+
+def reset():
+    """Starts a new telemetry period (gauges and reset counts are kept)."""
+    global period_start
+    counters.clear()
+    timers.clear()
+    per_address.clear()
+    period_start = utime.time()
+
+# ========== BOOT PHASES ==========
+def phase(name):
+    """Records the first time 'name' is reached since reset (later calls are ignored)."""
+    if name in phases:
+        return
+    phases[name] = utime.ticks_ms()
+    meter_log.log("Boot phase %s at %d ms" % (name, phases[name]), "BOOT")
+
+def publish_boot(publish_func, mqtt_client, mqtt_topic):
+    """Sends the boot phases once per boot, after the first publish got through."""
+    global _boot_sent
+    if _boot_sent or "first_publish" not in phases:
+        return False
+    _boot_sent = publish_func(mqtt_client, mqtt_topic, json.dumps({
+        "type": "boot",
+        "gateway": GATEWAY_ID,
+        "phases": phases,
+        "resets": _load_resets(),
+    }))
+    return _boot_sent
+
+# ========== RESET REASONS ==========
+def _load_resets():
+    global _resets
+    if _resets is None:
+        try:
+            with open(RESETS_FILE, "r") as f:
+                _resets = json.loads(f.read())
+        except:
+            _resets = {}
+    return _resets
+
+def note_reset(reason):
+    """Counts a deliberate machine.reset() by reason. Call just before resetting."""
+    resets = _load_resets()
+    resets[reason] = resets.get(reason, 0) + 1
+    try:
+        with open(RESETS_FILE, "w") as f:
+            f.write(json.dumps(resets))
+    except Exception as e:
+        print("❌ Metrics: reset count not saved: %s" % str(e))
+
+# ========== TELEMETRY ==========
+def telemetry():
+    """
+    Compact telemetry payload for the period so far. Timers are
+    [count, avg, min, max]; per-address counts are keyed by address.
+    """
+    t = {}
+    for name, v in timers.items():
+        t[name] = [v[0], v[1] // v[0], v[2], v[3]]
+    a = {}
+    for name, table in per_address.items():
+        a[name] = dict((str(addr), n) for addr, n in table.items())
+    return json.dumps({
+        "type": "telemetry",
+        "gateway": GATEWAY_ID,
+        "uptime_s": utime.ticks_diff(utime.ticks_ms(), boot_ticks) // 1000,
+        "period_s": utime.time() - period_start,
+        "c": counters,
+        "t": t,
+        "a": a,
+        "g": gauges,
+        "boot": phases,
+        "resets": _load_resets(),
+    })
+
+def due(now):
+    return TELEMETRY_INTERVAL_S > 0 and now - _last_publish >= TELEMETRY_INTERVAL_S
+
+def publish(publish_func, mqtt_client, mqtt_topic, now):
+    """Publishes and starts a new period; on failure the period keeps accumulating."""
+    global _last_publish
+    _last_publish = now
+    if publish_func(mqtt_client, mqtt_topic, telemetry()):
+        reset()
+        return True
+    return False
@@ -3,6 +3,9 @@ import utime
 import globals
 import json
 import machine
+import meter_outbox
+import meter_cmdqueue
+import meter_metrics
 
 # Global Variables
 MQTT_BROKER_HOST = globals.MQTT_BROKER_HOST
@@ -28,6 +31,7 @@ def conncb(task):
 
 def disconncb(task):
     print("[{}] Disconnected".format(task))
+    meter_metrics.inc("mqtt_disconnect")
     mqttInitialize(mqtt, MQTT_SUB_TOPICS)
 
 def subscb(task):
@@ -58,23 +62,38 @@ def datacb(msg):
             "type": message,
             "addr": hex_address,
             "litres": litres,
-            "device_id": deviceID
+            "device_id": deviceID,
+            "rx_ms": utime.ticks_ms()
         }
+        if message == "log_tail":
+            cmd_data["bytes"] = payload.get('bytes')
         
-        globals.CMD_QUEUE.append(cmd_data)
-        print("queued: {}".format(message))
+        if meter_cmdqueue.commands.put(cmd_data):
+            print("queued: {}".format(message))
+            meter_metrics.observe("cmd_depth", len(meter_cmdqueue.commands))
+        else:
+            # A load is reported back as load_rejected (main.publish_rejections)
+            print("Command queue full, dropped: {}".format(message))
 
     except Exception as e:
         print("MQTT Parse Error: {}".format(e))
 
 # ---------------- MQTT INITIALIZATION ---------------- #
 
-mqtt = network.mqtt(
-    MQTT_CLIENT_ID, MQTT_BROKER_HOST, user=MQTT_CLIENT_USERNAME, password=MQTT_CLIENT_PASSWORD,
-    port=MQTT_BROKER_PORT, autoreconnect=True, clientid=MQTT_CLIENT_ID,
-    connected_cb=conncb, disconnected_cb=disconncb, subscribed_cb=subscb,
-    published_cb=pubcb, data_cb=datacb
-)
+# Built by client() once GSM is up, not at import
+mqtt = None
+
+def client():
+    """The shared network.mqtt client, created on first use."""
+    global mqtt
+    if mqtt is None:
+        mqtt = network.mqtt(
+            MQTT_CLIENT_ID, MQTT_BROKER_HOST, user=MQTT_CLIENT_USERNAME, password=MQTT_CLIENT_PASSWORD,
+            port=MQTT_BROKER_PORT, autoreconnect=True, clientid=MQTT_CLIENT_ID,
+            connected_cb=conncb, disconnected_cb=disconncb, subscribed_cb=subscb,
+            published_cb=pubcb, data_cb=datacb
+        )
+    return mqtt
 
 def mqttInitialize(mqtt, topic_list):
     loopCount = 10
@@ -95,8 +114,34 @@ def mqttInitialize(mqtt, topic_list):
         mqtt.subscribe(topic)
     return mqtt
 
+def mqttConnected(mqtt):
+    return mqtt is not None and mqtt.status()[0] == 2
+
 def mqttPublish(mqtt, topic, message):
+    """Returns True if the message was handed to the client."""
+    start = utime.ticks_ms()
     try:
         mqtt.publish(topic, message)
-    except:
-        pass
\ No newline at end of file
+        meter_metrics.observe("publish_ms", utime.ticks_diff(utime.ticks_ms(), start))
+        meter_metrics.phase("first_publish")
+        return True
+    except Exception as e:
+        print("MQTT Publish Error: {}".format(e))
+        meter_metrics.inc("publish_fail")
+        return False
+
+def publishOrQueue(mqtt, topic, message):
+    """
+    Publishes a report, or stores it in the flash outbox while MQTT is
+    down so it can be replayed after reconnecting.
+    """
+    if mqttConnected(mqtt) and mqttPublish(mqtt, topic, message):
+        return True
+    meter_outbox.enqueue(message)
+    return False
+
+def drainOutbox(mqtt, topic):
+    """Replays one rate-limited batch of queued reports if connected."""
+    if not mqttConnected(mqtt) or not meter_outbox.pending():
+        return 0
+    return meter_outbox.drain(lambda payload: mqttPublish(mqtt, topic, payload))
\ No newline at end of file
@@ -0,0 +1,171 @@
+import os
+import struct
+import utime
+import globals
+from meter_storage import TARGET_DIR, read_json_recover, write_json_atomic
+
+# ========== OUTBOX CONFIG ==========
+# Reports that could not be published are kept in a fixed-size ring on flash
+OUTBOX_FILE = TARGET_DIR + '/outbox.bin'
+# head/tail pointers and counters
+OUTBOX_META = TARGET_DIR + '/outbox.json'
+SLOT_SIZE = 256
+OUTBOX_SLOTS = getattr(globals, "OUTBOX_SLOTS", 128)
+# Records published per drain() call and the gap between them
+OUTBOX_BATCH = getattr(globals, "OUTBOX_BATCH", 10)
+OUTBOX_GAP_MS = 200
+
+# Record header in its first slot: payload length, queued timestamp.
+# Longer payloads continue in the following slots.
+_HEADER = '<HI'
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+# head/tail are slot counters that only grow; slot index = counter % OUTBOX_SLOTS
+_meta = None
+
+# ========== RING HELPERS ==========
+def _load_meta():
+    global _meta
+    if _meta is None:
+        _meta = read_json_recover(OUTBOX_META) or {}
+        for key in ("head", "tail", "dropped", "replayed", "queued"):
+            _meta.setdefault(key, 0)
+        # Ring geometry changed (config update): stored slots are meaningless
+        if _meta.get("slots", OUTBOX_SLOTS) != OUTBOX_SLOTS:
+            _meta["dropped"] += _meta["head"] - _meta["tail"]
+            _meta["tail"] = _meta["head"]
+        _meta["slots"] = OUTBOX_SLOTS
+    return _meta
+
+def _save_meta():
+    try:
+        write_json_atomic(OUTBOX_META, _meta)
+    except Exception as e:
+        print("❌ Outbox meta write failed: %s" % str(e))
+
+def _open_ring():
+    """Opens the ring file, creating it at full size the first time."""
+    try:
+        if os.stat(OUTBOX_FILE)[6] >= SLOT_SIZE * OUTBOX_SLOTS:
+            return open(OUTBOX_FILE, 'r+b')
+    except OSError:
+        pass
+    try:
+        os.mkdir(TARGET_DIR)
+    except OSError:
+        pass
+    blank = bytes(SLOT_SIZE)
+    with open(OUTBOX_FILE, 'wb') as f:
+        for _ in range(OUTBOX_SLOTS):
+            f.write(blank)
+    return open(OUTBOX_FILE, 'r+b')
+
+def _slots_for(length):
+    return (length + _HEADER_SIZE + SLOT_SIZE - 1) // SLOT_SIZE
+
+def _write_at(f, counter, data):
+    """Writes 'data' starting at slot 'counter', wrapping around the ring."""
+    pos = 0
+    while pos < len(data):
+        f.seek((counter % OUTBOX_SLOTS) * SLOT_SIZE)
+        f.write(data[pos:pos + SLOT_SIZE])
+        pos += SLOT_SIZE
+        counter += 1
+
+def _read_at(f, counter):
+    """Returns (payload, queued_at, slots_used) for the record at slot 'counter'."""
+    f.seek((counter % OUTBOX_SLOTS) * SLOT_SIZE)
+    first = f.read(SLOT_SIZE)
+    length, queued_at = struct.unpack(_HEADER, first[:_HEADER_SIZE])
+    slots = _slots_for(length)
+    data = bytearray(first[_HEADER_SIZE:])
+    for i in range(1, slots):
+        f.seek(((counter + i) % OUTBOX_SLOTS) * SLOT_SIZE)
+        data.extend(f.read(SLOT_SIZE))
+    return bytes(data[:length]), queued_at, slots
+
+# ========== PUBLIC API ==========
+def pending():
+    """Number of slots in use (0 means nothing queued)."""
+    meta = _load_meta()
+    return meta["head"] - meta["tail"]
+
+def enqueue(payload):
+    """
+    Queues one report. When the ring is full the oldest records are
+    evicted (counted in 'dropped') to make room for the newest.
+    """
+    meta = _load_meta()
+    if isinstance(payload, str):
+        payload = payload.encode()
+    slots = _slots_for(len(payload))
+    if slots > OUTBOX_SLOTS:
+        meta["dropped"] += 1
+        return False
+
+    try:
+        f = _open_ring()
+    except Exception as e:
+        print("❌ Outbox unavailable: %s" % str(e))
+        meta["dropped"] += 1
+        return False
+
+    with f:
+        while meta["head"] - meta["tail"] + slots > OUTBOX_SLOTS:
+            _, _, used = _read_at(f, meta["tail"])
+            meta["tail"] += used
+            meta["dropped"] += 1
+        record = struct.pack(_HEADER, len(payload), int(utime.time())) + payload
+        _write_at(f, meta["head"], record)
+    meta["head"] += slots
+    meta["queued"] += 1
+    _save_meta()
+    return True
+
+def _stamp(payload, queued_at):
+    """Adds the time the report was taken so late deliveries can be placed correctly."""
+    if payload.endswith(b'}'):
+        return payload[:-1] + (', "queued_ts": %d}' % queued_at).encode()
+    return payload
+
+def drain(publish_func, max_records=OUTBOX_BATCH):
+    """
+    Publishes up to 'max_records' queued reports, oldest first, spaced by
+    OUTBOX_GAP_MS. Stops at the first failed publish. Returns records sent.
+    """
+    meta = _load_meta()
+    if meta["head"] == meta["tail"]:
+        return 0
+
+    sent = 0
+    try:
+        f = _open_ring()
+    except Exception as e:
+        print("❌ Outbox unavailable: %s" % str(e))
+        return 0
+
+    with f:
+        while sent < max_records and meta["tail"] < meta["head"]:
+            payload, queued_at, used = _read_at(f, meta["tail"])
+            if not publish_func(_stamp(payload, queued_at)):
+                break
+            meta["tail"] += used
+            meta["replayed"] += 1
+            sent += 1
+            if meta["tail"] < meta["head"]:
+                utime.sleep_ms(OUTBOX_GAP_MS)
+
+    if sent:
+        _save_meta()
+        print("📤 Outbox: replayed %d, %d slots left" % (sent, meta["head"] - meta["tail"]))
+    return sent
+
+def stats():
+    """Slots in use and the queued / replayed / dropped record counts (kept across reboots)."""
+    meta = _load_meta()
+    return {
+        "pending_slots": meta["head"] - meta["tail"],
+        "queued": meta["queued"],
+        "replayed": meta["replayed"],
+        "dropped": meta["dropped"]
+    }
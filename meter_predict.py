@@ -0,0 +1,84 @@
+import globals
+import meter_metrics
+import meter_scheduler
+
+# ========== PREDICTOR CONFIG ==========
+# Close this many seconds before the predicted crossing
+PREDICT_LEAD_S = getattr(globals, "PREDICT_LEAD_S", 5)
+# Never close earlier than this many litres before the target
+PREDICT_MAX_EARLY_L = getattr(globals, "PREDICT_MAX_EARLY_L", 2)
+# The rate estimate is trusted after this many rate samples (3 readings) ...
+PREDICT_MIN_SAMPLES = 2
+# ... and while its smoothed deviation stays under this fraction of the rate
+PREDICT_MAX_DEV = 0.5
+
+# Active closures: {address: [target, cumulative_at_close, predicted, measured]}
+_closures = {}
+
+# ========== HELPERS ==========
+def _reliable(address):
+    rate, dev, samples = meter_scheduler.rate_stats(address)
+    if samples < PREDICT_MIN_SAMPLES or rate < meter_scheduler.IDLE_RATE:
+        return 0.0
+    if dev > rate * PREDICT_MAX_DEV:
+        return 0.0
+    return rate
+
+def _measure(address, closure, cumulative):
+    """
+    The first reading after a close shows how much ran past the target.
+    Goes out with the telemetry: timer "overshoot_l" and the per-address
+    "closes_predicted" / "closes_threshold" counts.
+    """
+    if closure[3]:
+        return
+    closure[3] = True
+    given = cumulative - closure[0]
+    meter_metrics.observe("overshoot_l", given)
+    meter_metrics.inc_addr("closes_predicted" if closure[2] else "closes_threshold", address)
+    print("Overshoot Addr %d: %s L (%s close)" % (address, given, "predicted" if closure[2] else "threshold"))
+
+# ========== PUBLIC API ==========
+def should_close(address, cumulative, target):
+    """
+    Valve decision for one reading. Closes on the target as before, or
+    slightly early when a steady flow will cross it within PREDICT_LEAD_S.
+    A close stays latched until the target changes (new credit), so an
+    early close is not reopened once the flow stops.
+    """
+    closure = _closures.get(address)
+    if closure is not None and closure[0] != target:
+        _closures.pop(address, None)
+        closure = None
+    if closure is not None:
+        _measure(address, closure, cumulative)
+        return True
+
+    remaining = target - cumulative
+    if remaining <= 0:
+        predicted = False
+    else:
+        rate = _reliable(address)
+        if not rate or remaining > min(rate * PREDICT_LEAD_S, PREDICT_MAX_EARLY_L):
+            return False
+        predicted = True
+
+    _closures[address] = [target, cumulative, predicted, False]
+    return True
+
+def schedule_check(address, cumulative, target, now):
+    """
+    Asks the scheduler for a poll just before the predicted crossing.
+    Returns the planned check time, or None when the estimate is unreliable
+    (the scheduler's normal cadence and the threshold close then apply).
+    """
+    closure = _closures.get(address)
+    if closure is not None and closure[0] == target:
+        return None
+    remaining = target - cumulative
+    rate = _reliable(address)
+    if remaining <= 0 or not rate:
+        return None
+    when = now + int(remaining / rate) - PREDICT_LEAD_S
+    meter_scheduler.poll_at(address, when, now)
+    return when
@@ -0,0 +1,83 @@
+# ========== REGISTER MAP ==========
+# name: (register, word_count, word_order, signed)
+#   word_order "lo_hi": low 16-bit word is sent first (meter default)
+#   word_order "hi_lo": high 16-bit word is sent first
+# Add meter-specific registers here; the planner picks them up automatically.
+REGISTER_MAP = {
+    "cumulative_flow": (0x000E, 2, "lo_hi", False),
+    "valve_status": (0x0060, 1, "hi_lo", False),
+}
+
+# Fields read on every sweep
+FLOW_FIELDS = ("cumulative_flow",)
+
+# Registers further apart than this are read in separate requests.
+# Reading a few unused registers is cheaper than another round trip.
+MAX_GAP = 8
+# Keep replies well under the 256 byte RTU frame limit
+MAX_REGISTERS = 32
+
+_plan_cache = {}
+
+# ========== READ PLANNER ==========
+def plan_reads(names, max_gap=MAX_GAP, max_count=MAX_REGISTERS):
+    """
+    Groups the requested fields into the fewest 0x03 reads.
+    Returns a list of (start_register, register_count, [names]).
+    Plans are cached per field tuple since the same set is read every cycle.
+    """
+    key = (tuple(names), max_gap, max_count)
+    plan = _plan_cache.get(key)
+    if plan is not None:
+        return plan
+
+    fields = sorted(names, key=lambda n: REGISTER_MAP[n][0])
+    plan = []
+    start = end = None
+    group = []
+    for name in fields:
+        reg, words = REGISTER_MAP[name][0], REGISTER_MAP[name][1]
+        if group and reg - end <= max_gap and max(end, reg + words) - start <= max_count:
+            end = max(end, reg + words)
+            group.append(name)
+        else:
+            if group:
+                plan.append((start, end - start, group))
+            start, end, group = reg, reg + words, [name]
+    if group:
+        plan.append((start, end - start, group))
+
+    _plan_cache[key] = plan
+    return plan
+
+# ========== DECODING ==========
+def decode_field(data, offset, name):
+    """
+    Decodes one field from register data starting at 'offset' (the first
+    byte of the field). Big-endian bytes within each word, per Modbus.
+    """
+    reg, words, order, signed = REGISTER_MAP[name]
+    if words == 1:
+        value = (data[offset] << 8) | data[offset + 1]
+        if signed and value & 0x8000:
+            value -= 0x10000
+        return value
+
+    first = (data[offset] << 8) | data[offset + 1]
+    second = (data[offset + 2] << 8) | data[offset + 3]
+    if order == "lo_hi":
+        value = (second << 16) | first
+    else:
+        value = (first << 16) | second
+    if signed and value & 0x80000000:
+        value -= 0x100000000
+    return value
+
+def decode_block(data, data_offset, start, names, out):
+    """
+    Decodes every field in 'names' from one read response into dict 'out'.
+    'data_offset' is where register 'start' begins in 'data' (3 for a raw frame).
+    """
+    for name in names:
+        out[name] = decode_field(data, data_offset + 2 * (REGISTER_MAP[name][0] - start), name)
+    return out
@@ -0,0 +1,128 @@
+import globals
+
+# ========== REPORT CONFIG ==========
+# "per_meter": one device_report publish per meter (original behaviour)
+# "aggregate": one cycle_report publish per sweep holding every meter
+REPORT_MODE = getattr(globals, "REPORT_MODE", "per_meter")
+GATEWAY_ID = globals.MQTT_CLIENT_ID
+# Initial buffer size; grows (once) if a site has more meters than fit
+REPORT_BUFFER_SIZE = 1024
+
+# Delta reporting: skip meters whose reading moved less than the deadband
+# and whose target/valve did not change, but always send each meter at
+# least once per keyframe interval so the backend can see it is alive.
+REPORT_DELTA = getattr(globals, "REPORT_DELTA", False)
+REPORT_DEADBAND_L = getattr(globals, "REPORT_DEADBAND_L", 1)
+REPORT_KEYFRAME_S = getattr(globals, "REPORT_KEYFRAME_S", 3600)
+
+# The scheduler polls a flowing meter near its target much faster than
+# 'timer'; its reports still go out about once per 'timer' (the slack keeps
+# a meter on the normal cadence from skipping every other one) unless its
+# target, valve or online state changed.
+REPORT_MIN_INTERVAL_S = globals.timer - getattr(globals, "POLL_MIN_S", 15)
+
+VALVE_NAMES = {1: "open", 2: "closed"}
+
+# Last published state per address: {address: [cumulative, target, valve, sent_at]}
+_last_sent = {}
+
+def _json_num(value):
+    return 'null' if value is None else str(value)
+
+# ========== REPORT BUFFER ==========
+class ReportBuffer:
+    """
+    Builds a JSON cycle report straight into a preallocated bytearray,
+    so a sweep produces one payload object instead of a string per meter.
+    """
+    def __init__(self, size=REPORT_BUFFER_SIZE):
+        self.buf = bytearray(size)
+        self.n = 0
+        self.count = 0
+
+    def _write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        end = self.n + len(data)
+        if end > len(self.buf):
+            grown = bytearray(max(end, 2 * len(self.buf)))
+            grown[:self.n] = self.buf[:self.n]
+            self.buf = grown
+        self.buf[self.n:end] = data
+        self.n = end
+
+    def begin(self):
+        self.n = 0
+        self.count = 0
+        self._write(b'{"type": "cycle_report", "gateway": "')
+        self._write(GATEWAY_ID)
+        self._write(b'", "meters": [')
+
+    def add_meter(self, address, cumulative, target, valve=None):
+        """Appends one meter; cumulative None marks it offline."""
+        if self.count:
+            self._write(b', ')
+        self._write(b'{"device": ')
+        self._write(str(address))
+        self._write(b', "cumulative_flow_L": ')
+        self._write(_json_num(cumulative))
+        self._write(b', "target_flow": ')
+        self._write(_json_num(target))
+        self._write(b', "valve": ')
+        name = VALVE_NAMES.get(valve)
+        if name is None:
+            self._write(b'null')
+        else:
+            self._write(b'"')
+            self._write(name)
+            self._write(b'"')
+        if cumulative is None:
+            self._write(b', "offline": true')
+        self._write(b'}')
+        self.count += 1
+
+    def payload(self):
+        """Closes the JSON document and returns it as one bytes object."""
+        self._write(b']}')
+        return bytes(memoryview(self.buf)[:self.n])
+
+report = ReportBuffer()
+
+def device_report(address, cumulative, target):
+    """Single-meter payload used in per_meter mode (cumulative None = offline)."""
+    if cumulative is None:
+        return '{"type": "device_report", "device": %d, "cumulative_flow_L": null, "target_flow": %s, "offline": true}' % (
+            address, _json_num(target)
+        )
+    return '{"type": "device_report", "device": %d, "cumulative_flow_L": %s, "target_flow": %s}' % (
+        address, cumulative, _json_num(target)
+    )
+
+# ========== DELTA REPORTING ==========
+def should_report(address, cumulative, target, valve, now):
+    """True if this meter needs publishing this cycle."""
+    last = _last_sent.get(address)
+    if last is None:
+        return True
+    if target != last[1] or valve != last[2]:
+        return True
+    if (cumulative is None) != (last[0] is None):
+        # Going offline or coming back
+        return True
+    if now - last[3] < REPORT_MIN_INTERVAL_S:
+        return False
+    if not REPORT_DELTA or now - last[3] >= REPORT_KEYFRAME_S:
+        return True
+    if cumulative is None:
+        return False
+    return abs(cumulative - last[0]) >= REPORT_DEADBAND_L
+
+def mark_reported(address, cumulative, target, valve, now):
+    entry = _last_sent.get(address)
+    if entry is None:
+        _last_sent[address] = [cumulative, target, valve, now]
+    else:
+        entry[0] = cumulative
+        entry[1] = target
+        entry[2] = valve
+        entry[3] = now
@@ -8,6 +8,16 @@ uart = UART(2, baudrate=9600, bits=8, parity=1, stop=1, tx=19, rx=18)  # UART2 o
 # MODBUS Slave Addresses
 # SLAVE_ADDRESSES = [1, 2, 3, 4, 5, 6]
 SLAVE_ADDRESSES = [6]
+# ========== TEST HELPERS ==========
+# Bench-only; kept out of meter.py so the gateway never loads them
+def valve_test(uart, addresses):
+    for address in addresses:
+        open_valve(uart, address)
+    time.sleep(2)
+    for address in addresses:
+        close_valve(uart, address)
+    time.sleep(2)
+
 # ========== MAIN LOOP ==========
 
 def main():
@@ -0,0 +1,163 @@
+import globals
+
+# ========== SCHEDULER CONFIG ==========
+# Normal poll interval; idle meters back off from here, busy ones speed up
+POLL_BASE_S = globals.timer
+POLL_MIN_S = getattr(globals, "POLL_MIN_S", 15)
+POLL_MAX_S = getattr(globals, "POLL_MAX_S", 900)
+# Flow a meter can plausibly reach (DN15 Q3 is 2.5 m3/h). Once flow is
+# seen or the valve is opened, no poll is later than the time the
+# remaining credit would last at this rate
+MAX_FLOW_LPS = getattr(globals, "MAX_FLOW_LPS", 0.7)
+# Poll again after this fraction of the predicted time-to-target
+POLL_TARGET_FRACTION = 0.5
+# Weight of the newest sample in the flow-rate average
+RATE_ALPHA = 0.5
+# Below this (L/s) a meter counts as idle
+IDLE_RATE = 0.001
+
+# Global caps: RS-485 polls per minute, GSM publishes per hour
+POLL_BUDGET_PER_MIN = getattr(globals, "POLL_BUDGET_PER_MIN", 60)
+PUBLISH_BUDGET_PER_HOUR = getattr(globals, "PUBLISH_BUDGET_PER_HOUR", 240)
+
+# Per-meter state:
+# {address: [last_cumulative, last_time, rate_lps, next_due, idle_cycles, samples, rate_dev, target, watch]}
+# 'watch' is set when the valve opens and cleared by the next idle reading
+meters = {}
+
+_poll_window = [0, 0]      # [window_start, polls]
+_publish_window = [0, 0]   # [window_start, publishes]
+
+# ========== HELPERS ==========
+def _entry(address):
+    entry = meters.get(address)
+    if entry is None:
+        entry = [None, None, 0.0, 0, 0, 0, 0.0, None, False]
+        meters[address] = entry
+    return entry
+
+def _take(window, period, budget, now):
+    if now - window[0] >= period:
+        window[0] = now
+        window[1] = 0
+    if window[1] >= budget:
+        return False
+    window[1] += 1
+    return True
+
+def _interval(entry, remaining):
+    rate = entry[2]
+    if remaining is not None and remaining <= 0:
+        # Valve closed on target; new credit arrives as a command
+        return POLL_BASE_S
+    if rate < IDLE_RATE:
+        # Back off while nothing flows: base, 2x, 4x ... up to the cap
+        interval = min(POLL_BASE_S << min(entry[4], 8), POLL_MAX_S)
+        if remaining is None or not entry[8]:
+            return interval
+    elif remaining is None:
+        return POLL_BASE_S
+    else:
+        interval = min(int(remaining / rate * POLL_TARGET_FRACTION), POLL_BASE_S)
+    # Water is flowing or the valve was just opened: never sleep past the
+    # point where the credit could be gone at the highest plausible flow
+    return max(POLL_MIN_S, min(interval, int(remaining / MAX_FLOW_LPS)))
+
+# ========== PUBLIC API ==========
+def record(address, cumulative, target, now):
+    """Updates the flow rate from a fresh reading and schedules the next poll."""
+    entry = _entry(address)
+    if entry[0] is not None and now > entry[1]:
+        used = cumulative - entry[0]
+        if used < 0:
+            # Meter reset or replaced: start the estimate again
+            used = 0
+            entry[5] = 0
+        sample = used / (now - entry[1])
+        if entry[5]:
+            # Smoothed absolute deviation tells the predictor how steady the flow is
+            entry[6] = RATE_ALPHA * abs(sample - entry[2]) + (1 - RATE_ALPHA) * entry[6]
+            entry[2] = RATE_ALPHA * sample + (1 - RATE_ALPHA) * entry[2]
+        else:
+            entry[2] = sample
+            entry[6] = 0.0
+        entry[5] += 1
+        if sample < IDLE_RATE:
+            # Nothing ran since the last reading: back to the idle backoff
+            entry[4] += 1
+            entry[8] = False
+        else:
+            entry[4] = 0
+    if target != entry[7]:
+        # New credit (or a target set from the backend): start the backoff again
+        entry[4] = 0
+        entry[7] = target
+    entry[0] = cumulative
+    entry[1] = now
+
+    remaining = None if target is None else target - cumulative
+    entry[3] = now + _interval(entry, remaining)
+    return entry[3]
+
+def record_failure(address, now, retry_at=0):
+    """A failed read keeps the normal cadence, or waits out the meter's health backoff."""
+    _entry(address)[3] = max(now + POLL_BASE_S, retry_at)
+
+def wake(address, now):
+    """
+    The valve was opened: flow may start, so drop the idle backoff and
+    watch the meter closely until a reading shows it idle again.
+    """
+    entry = _entry(address)
+    entry[4] = 0
+    entry[8] = True
+    if entry[0] is not None and entry[7] is not None:
+        poll_at(address, now + _interval(entry, entry[7] - entry[0]), now)
+
+def poll_at(address, when, now):
+    """Brings the next poll forward to 'when' (never later than already planned)."""
+    entry = _entry(address)
+    entry[3] = min(entry[3], max(when, now + 1))
+
+def due(addresses, now):
+    """
+    Addresses whose poll time has come, most overdue first, limited by
+    the per-minute bus budget. Meters left out stay due for the next pass.
+    """
+    ready = []
+    for address in addresses:
+        if _entry(address)[3] <= now:
+            ready.append(address)
+    ready.sort(key=lambda a: meters[a][3])
+
+    allowed = []
+    for address in ready:
+        if not _take(_poll_window, 60, POLL_BUDGET_PER_MIN, now):
+            break
+        allowed.append(address)
+    return allowed
+
+def seconds_until_next(addresses, now):
+    """Seconds until the earliest meter is due (at least 1, at most POLL_MAX_S)."""
+    soonest = now + POLL_MAX_S
+    for address in addresses:
+        soonest = min(soonest, _entry(address)[3])
+    if _poll_window[1] >= POLL_BUDGET_PER_MIN:
+        soonest = max(soonest, _poll_window[0] + 60)
+    return max(1, soonest - now)
+
+def allow_publish(now):
+    """Consumes one publish from the hourly GSM budget; False if it is spent."""
+    return _take(_publish_window, 3600, PUBLISH_BUDGET_PER_HOUR, now)
+
+def rate(address):
+    """Smoothed flow rate in L/s (0.0 if unknown)."""
+    entry = meters.get(address)
+    return entry[2] if entry else 0.0
+
+def rate_stats(address):
+    """(rate_lps, rate_deviation, samples) for the predictor."""
+    entry = meters.get(address)
+    if entry is None:
+        return 0.0, 0.0, 0
+    return entry[2], entry[6], entry[5]
@@ -1,3 +1,4 @@
+import _thread
 import time
 import os
 import json
@@ -5,58 +6,202 @@ import json
 # Directory for storing target readings
 TARGET_DIR = '/flash/mem'
 
-# ========== Persistent Storage Functions ==========
+# All targets live in one file:
+# {"targets": {"13": 789, "14": 120}, "applied": {"13": 4}}
+STORE_FILE = TARGET_DIR + '/targets.json'
 
-def save_target_reading(address, value):
-    """
-    Save target reading for a specific device to its own JSON file.
-    Example file: /flash/mem/target_13.json => {"13": 789}
-    """
+# Deferred saves are written at most this many seconds later
+FLUSH_DELAY = 10
+
+# In-memory table {address: target}; loaded once on first use
+_targets = None
+# Last ledger sequence applied to each target {address: seq}
+_applied = {}
+_dirty = False
+_dirty_since = 0
+# Bus workers may save targets concurrently
+_lock = _thread.allocate_lock()
+
+# ========== File Helpers ==========
+
+def _exists(path):
     try:
-        # Ensure storage directory exists
-        if "mem" not in os.listdir("/flash"):
-            os.mkdir(TARGET_DIR)
+        os.stat(path)
+        return True
+    except OSError:
+        return False
 
-        filename = TARGET_DIR + "/target_" + str(address) + ".json"
-        data = {str(address): value}
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
-        with open(filename, 'w') as f:
-            json.dump(data, f)
+def _ensure_dir():
+    if not _exists(TARGET_DIR):
+        os.mkdir(TARGET_DIR)
 
-        print("✔ Target reading saved for address %s: %s" % (address, value))
+def read_json_recover(path):
+    """
+    Reads a file written by write_json_atomic. A crash mid-swap can leave
+    the new data in .tmp or the previous data in .bak, so check those too.
+    Returns None if nothing readable exists.
+    """
+    for candidate in (path, path + '.tmp', path + '.bak'):
+        try:
+            with open(candidate, 'r') as f:
+                return json.load(f)
+        except Exception:
+            pass
+    return None
 
-    except Exception as e:
-        print("❌ Failed to save target reading for address %s: %s" % (address, str(e)))
+def write_json_atomic(path, data):
+    """
+    Writes a temp file first, then swaps it in with renames so a power
+    cut never leaves a half-written file. Raises on failure.
+    """
+    tmp = path + '.tmp'
+    bak = path + '.bak'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
 
+    _remove(bak)
+    if _exists(path):
+        os.rename(path, bak)
+    os.rename(tmp, path)
+    _remove(bak)
 
-def load_target_reading(address):
+def _int_keys(data):
+    table = {}
+    for key, value in data.items():
+        table[int(key)] = value
+    return table
+
+def _str_keys(table):
+    data = {}
+    for key, value in table.items():
+        data[str(key)] = value
+    return data
+
+def _migrate_legacy(table):
     """
-    Load target reading for a specific device from its own file.
-    Returns None if the file or value doesn't exist.
+    Pulls old per-address files (/flash/mem/target_N.json) into the table.
+    Returns the list of migrated file paths (removed after the first flush).
     """
+    migrated = []
     try:
-        filename = TARGET_DIR + "/target_" + str(address) + ".json"
+        names = os.listdir(TARGET_DIR)
+    except OSError:
+        return migrated
 
+    for name in names:
+        if not (name.startswith("target_") and name.endswith(".json")):
+            continue
+        path = TARGET_DIR + "/" + name
         try:
-            os.stat(filename)
-        except OSError:
-            print("⚠ No saved target reading file found for address %s." % address)
-            return None
-
-        with open(filename, 'r') as f:
-            data = json.load(f)
-
-        value = data.get(str(address))
-        if value is not None:
-            print("📦 Loaded target reading for address %s: %s" % (address, value))
-            return value
-        else:
-            print("⚠ No target reading found in file for address %s." % address)
-            return None
+            address = int(name[7:-5])
+            with open(path, 'r') as f:
+                value = json.load(f).get(str(address))
+            if value is not None and address not in table:
+                table[address] = value
+            migrated.append(path)
+        except Exception as e:
+            print("⚠ Skipping legacy target file %s: %s" % (name, str(e)))
+    if migrated:
+        print("🔧 Migrated %d legacy target files" % len(migrated))
+    return migrated
+
+def _load_store():
+    """Loads all targets once; later calls return the in-memory table."""
+    global _targets, _applied
+    if _targets is not None:
+        return _targets
 
+    data = read_json_recover(STORE_FILE)
+    if data is None:
+        data = {}
+    try:
+        _targets = _int_keys(data.get("targets", {}))
+        _applied = _int_keys(data.get("applied", {}))
     except Exception as e:
-        print("❌ Failed to load target reading for address %s: %s" % (address, str(e)))
-        return None
+        print("❌ Target store unreadable, starting empty: %s" % str(e))
+        _targets = {}
+        _applied = {}
+
+    legacy = _migrate_legacy(_targets)
+    if legacy:
+        global _dirty
+        _dirty = True
+        if flush_targets(force=True):
+            for path in legacy:
+                _remove(path)
+    return _targets
+
+# ========== Persistent Storage Functions ==========
+
+def flush_targets(force=False):
+    """
+    Writes the table if it changed, atomically (see write_json_atomic).
+    Without 'force' the write waits until FLUSH_DELAY has passed; 'force'
+    only skips that wait, an unchanged table is never rewritten.
+    Returns True when the store on flash is up to date.
+    """
+    global _dirty
+    if not _dirty:
+        return True
+    if not force and time.time() - _dirty_since < FLUSH_DELAY:
+        return False
+
+    with _lock:
+        try:
+            _ensure_dir()
+            write_json_atomic(STORE_FILE, {
+                "targets": _str_keys(_targets),
+                "applied": _str_keys(_applied)
+            })
+            _dirty = False
+            return True
+        except Exception as e:
+            print("❌ Failed to flush target store: %s" % str(e))
+            return False
+
+def save_target_reading(address, value, flush=True, seq=None):
+    """
+    Save target reading for a specific device.
+    With flush=False the write is deferred to flush_targets().
+    'seq' marks the ledger record this target includes; it is stored in
+    the same write so a credit is either fully applied or not at all.
+    """
+    global _dirty, _dirty_since
+    table = _load_store()
+    if table.get(address) == value and seq is None:
+        return
+
+    with _lock:
+        table[address] = value
+        if seq is not None:
+            _applied[address] = seq
+        if not _dirty:
+            _dirty = True
+            _dirty_since = time.time()
+
+    if flush:
+        flush_targets(force=True)
+    print("✔ Target reading saved for address %s: %s" % (address, value))
+
+
+def load_target_reading(address):
+    """
+    Load target reading for a specific device from the in-memory table.
+    Returns None if no target is stored.
+    """
+    return _load_store().get(address)
+
+
+def load_applied_seq(address):
+    """Ledger sequence number of the last credit applied to this target (0 if none)."""
+    _load_store()
+    return _applied.get(address, 0)
 
 
 def init_target_reading(address, default_value=45):
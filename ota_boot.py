@@ -0,0 +1,149 @@
+import uos
+import json
+try:
+    import globals
+except ImportError:
+    globals = None
+
+# ========== A/B OTA STATE ==========
+# run_ota stages a verified release in STAGE_DIR, then swaps it in. The
+# files it replaces move to BACKUP_DIR until main.py confirms the new set
+# ("System Running"). Kept tiny: boot.py runs this before anything else.
+FLASH_DIR = "/flash/"
+STAGE_DIR = "/flash/temp"
+BACKUP_DIR = "/flash/ota_prev"
+STATE_FILE = "/flash/ota_state.json"
+VERSION_FILE = getattr(globals, "VERSION_FILE", "/flash/version.txt")
+# Boots a new release gets to reach "System Running" before rollback
+OTA_TRIAL_BOOTS = getattr(globals, "OTA_TRIAL_BOOTS", 3)
+
+# State file: {"state": "swap" | "trial" | "rolled_back", "version",
+#              "files": [staged names], "removed": [names], "boots"}
+
+def log(msg):
+    print("[OTA] " + msg)
+
+def exists(path):
+    try:
+        uos.stat(path)
+        return True
+    except OSError:
+        return False
+
+def _mkdir(path):
+    try:
+        uos.mkdir(path)
+    except OSError:
+        pass
+
+def load_state():
+    try:
+        with open(STATE_FILE, "r") as f:
+            return json.loads(f.read())
+    except:
+        return None
+
+def save_state(state):
+    tmp_path = STATE_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps(state))
+    if exists(STATE_FILE):
+        uos.remove(STATE_FILE)
+    uos.rename(tmp_path, STATE_FILE)
+
+def clear_state():
+    for path in (STATE_FILE, STATE_FILE + ".tmp"):
+        if exists(path):
+            uos.remove(path)
+
+def clear_backup():
+    if not exists(BACKUP_DIR):
+        return
+    for name in uos.listdir(BACKUP_DIR):
+        uos.remove(BACKUP_DIR + "/" + name)
+
+def rejected_version():
+    """Version that was rolled back (not retried until the server moves on)."""
+    state = load_state()
+    if state is not None and state.get("state") == "rolled_back":
+        return state.get("version")
+    return None
+
+# ========== SWAP ==========
+def begin_swap(files, removed, version):
+    """Commits to swapping staged 'files' in (and 'removed' out). Power-cut safe from here."""
+    _mkdir(BACKUP_DIR)
+    clear_backup()
+    save_state({"state": "swap", "version": version, "files": files,
+                "removed": removed, "boots": 0})
+    swap()
+
+def _move(src, dst):
+    if exists(dst):
+        uos.remove(dst)
+    uos.rename(src, dst)
+
+def swap():
+    """
+    Moves each live file to BACKUP_DIR and its staged copy into place.
+    Every step is repeatable, so a swap cut by power is finished at boot.
+    """
+    state = load_state()
+    for name in state["files"]:
+        staged = STAGE_DIR + "/" + name
+        if not exists(staged):
+            continue
+        live = FLASH_DIR + name
+        backup = BACKUP_DIR + "/" + name
+        if exists(live) and not exists(backup):
+            uos.rename(live, backup)
+        _move(staged, live)
+    for name in state["removed"]:
+        live = FLASH_DIR + name
+        if exists(live):
+            _move(live, BACKUP_DIR + "/" + name)
+    state["state"] = "trial"
+    state["boots"] = 0
+    save_state(state)
+    log("Swapped in {} ({} files), on trial".format(state["version"], len(state["files"])))
+
+def rollback(state):
+    """Puts the previous set back: backups return, files new in the release go."""
+    for name in state["files"] + state["removed"]:
+        live = FLASH_DIR + name
+        backup = BACKUP_DIR + "/" + name
+        if exists(backup):
+            _move(backup, live)
+        elif exists(live):
+            uos.remove(live)
+    save_state({"state": "rolled_back", "version": state["version"]})
+    log("⚠️ Rolled back {} after {} boots".format(state["version"], state["boots"] - 1))
+
+# ========== BOOT / CONFIRM ==========
+def run():
+    """Called from boot.py: finishes a cut swap, counts trial boots, rolls back."""
+    state = load_state()
+    if state is None:
+        return
+    if state["state"] == "swap":
+        swap()
+        state = load_state()
+    if state["state"] == "trial":
+        state["boots"] += 1
+        if state["boots"] > OTA_TRIAL_BOOTS:
+            rollback(state)
+        else:
+            save_state(state)
+            log("Trial boot {}/{} of {}".format(state["boots"], OTA_TRIAL_BOOTS, state["version"]))
+
+def confirm():
+    """Called once the system is running: the trial release becomes the current one."""
+    state = load_state()
+    if state is None or state.get("state") != "trial":
+        return False
+    with open(VERSION_FILE, "w") as f:
+        f.write(state["version"])
+    clear_backup()
+    clear_state()
+    log("✅ Confirmed {}".format(state["version"]))
+    return True
@@ -0,0 +1,242 @@
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+try:
+    import ussl as ssl
+except ImportError:
+    import ssl
+try:
+    import uhashlib as hashlib
+    import ubinascii as binascii
+except ImportError:
+    import hashlib
+    import binascii
+import uos
+import json
+from utime import sleep
+
+# ========== RESUMABLE DOWNLOAD CONFIG ==========
+# curl.get() cannot send a Range header, so OTA files are fetched with a
+# small HTTP/1.0 client. Bytes go to <path>.part as they arrive; a dropped
+# link, a retry or a reboot continues from the end of that file.
+PART_SUFFIX = ".part"
+# {"url", "sha256", "total", "chunk"} next to the partial file
+PROGRESS_SUFFIX = ".prog"
+# Range size per request: halved after a failed request, doubled after
+# CHUNK_GROW_AFTER good ones in a row
+CHUNK_MIN = 512
+CHUNK_MAX = 8192
+CHUNK_START = 2048
+CHUNK_GROW_AFTER = 4
+HTTP_TIMEOUT_S = 20
+RETRY_DELAY_S = 3
+READ_BYTES = 512
+
+# ========== UTILITIES ==========
+def log(msg):
+    print("[OTA] " + msg)
+
+def _size(path):
+    try:
+        return uos.stat(path)[6]
+    except OSError:
+        return -1
+
+def _remove(path):
+    try:
+        uos.remove(path)
+    except OSError:
+        pass
+
+def _mkdir_for(path):
+    """Creates the directory 'path' goes in (fresh flash, or removed by a cleanup)."""
+    folder = path.rsplit("/", 1)[0]
+    if folder:
+        try:
+            uos.mkdir(folder)
+        except OSError:
+            pass
+
+def _load_progress(path):
+    try:
+        with open(path + PROGRESS_SUFFIX, "r") as f:
+            return json.loads(f.read())
+    except:
+        return {}
+
+def _save_progress(path, prog):
+    try:
+        with open(path + PROGRESS_SUFFIX, "w") as f:
+            f.write(json.dumps(prog))
+    except Exception as e:
+        log("⚠️ Could not save download progress: {}".format(e))
+
+def _hash_file(path):
+    """sha256 object fed with what is already in 'path' (resuming a hashed download)."""
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(READ_BYTES)
+                if not data:
+                    break
+                h.update(data)
+    except OSError:
+        pass
+    return h
+
+def _split_url(url):
+    """'https://host[:port]/path' -> (tls, host, port, '/path')."""
+    proto, _, rest = url.split("/", 2)
+    host, _, path = rest.partition("/")
+    tls = proto == "https:"
+    port = 443 if tls else 80
+    if ":" in host:
+        host, port = host.split(":")
+        port = int(port)
+    return tls, host, port, "/" + path
+
+# ========== HTTP RANGE REQUEST ==========
+def request_range(url, start, end, f, h=None):
+    """
+    GET bytes start..end (inclusive) of 'url', appending the body to the
+    open file 'f' (and to hash 'h') as it arrives. Returns (status, total):
+    total is the full file size from Content-Range, or Content-Length on a
+    plain 200. A 200 for start > 0 (server ignored Range) is not read.
+    Raises OSError if the link drops before the body is complete; the bytes
+    received up to then are already in 'f'.
+    """
+    tls, host, port, path = _split_url(url)
+    addr = socket.getaddrinfo(host, port)[0][-1]
+    s = socket.socket()
+    try:
+        s.settimeout(HTTP_TIMEOUT_S)
+        s.connect(addr)
+        if tls:
+            s = ssl.wrap_socket(s, server_hostname=host)
+        s.write(("GET {} HTTP/1.0\r\nHost: {}\r\nRange: bytes={}-{}\r\n\r\n".format(
+            path, host, start, end)).encode())
+
+        line = s.readline()
+        if not line:
+            raise OSError("no response")
+        status = int(line.split(None, 2)[1])
+        length = None
+        total = None
+        while True:
+            line = s.readline()
+            if not line or line == b"\r\n":
+                break
+            name, _, value = line.decode().partition(":")
+            name = name.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "content-range":
+                # "bytes 0-2047/10310" or "bytes */10310"
+                total = int(value.strip().rsplit("/", 1)[1])
+        if status == 200:
+            total = length
+        if status not in (200, 206) or (status == 200 and start > 0):
+            return status, total
+        if length is None:
+            raise OSError("no Content-Length")
+
+        left = length
+        while left > 0:
+            data = s.read(min(READ_BYTES, left))
+            if not data:
+                raise OSError("closed after {} of {} bytes".format(length - left, length))
+            f.write(data)
+            if h is not None:
+                h.update(data)
+            left -= len(data)
+        return status, total
+    finally:
+        s.close()
+
+# ========== RESUMABLE DOWNLOAD ==========
+def download(url, path, sha256=None, retries=3):
+    """
+    Fetches 'url' into 'path' in Range chunks, resuming from <path>.part.
+    With 'sha256' the data is hashed as it streams in and a mismatch throws
+    the partial file away. Gives up after 'retries' failed requests in a row
+    without progress, keeping the partial file for the next call.
+    Returns True once 'path' holds the complete file.
+    """
+    part = path + PART_SUFFIX
+    _mkdir_for(path)
+    prog = _load_progress(path)
+    if prog.get("url") != url or prog.get("sha256") != sha256:
+        # Nothing to resume, or a different file (or release) was in progress
+        _remove(part)
+        prog = {"url": url, "sha256": sha256, "total": None, "chunk": CHUNK_START}
+        _save_progress(path, prog)
+    offset = max(_size(part), 0)
+    h = _hash_file(part) if sha256 else None
+    if offset:
+        log("Resuming {} at {} bytes".format(path, offset))
+
+    chunk = prog["chunk"]
+    failures = 0
+    good = 0
+    while prog["total"] is None or offset < prog["total"]:
+        if failures >= retries:
+            log("⚠️ {} incomplete ({} bytes), resuming next time".format(path, offset))
+            return False
+        start = offset
+        known = (prog["total"], prog["chunk"])
+        f = open(part, "ab")
+        try:
+            status, total = request_range(url, start, start + chunk - 1, f, h)
+            error = None
+        except Exception as e:
+            status, total = None, None
+            error = e
+        finally:
+            f.close()
+        offset = max(_size(part), 0)
+
+        if status in (200, 206) and offset > start:
+            prog["total"] = total
+            good += 1
+            failures = 0
+            if good >= CHUNK_GROW_AFTER and chunk < CHUNK_MAX:
+                chunk = min(chunk * 2, CHUNK_MAX)
+                good = 0
+        elif status == 200 or (status == 416 and total != offset):
+            # Range ignored, or the file on the server shrank: start over
+            log("Server sent the whole file, restarting {}".format(path))
+            _remove(part)
+            offset = 0
+            h = hashlib.sha256() if sha256 else None
+            failures += 1
+        elif status == 416:
+            prog["total"] = total
+        else:
+            if error is not None:
+                log("⚠️ Chunk at {} failed: {}".format(start, error))
+            else:
+                log("❌ Chunk at {}: HTTP {}".format(start, status))
+            if offset > start:
+                failures = 0
+            failures += 1
+            good = 0
+            chunk = max(chunk // 2, CHUNK_MIN)
+            sleep(RETRY_DELAY_S)
+        prog["chunk"] = chunk
+        if (prog["total"], prog["chunk"]) != known:
+            _save_progress(path, prog)
+
+    _remove(path + PROGRESS_SUFFIX)
+    if offset != prog["total"]:
+        log("❌ {} is {} bytes, expected {}; discarded".format(path, offset, prog["total"]))
+        _remove(part)
+        return False
+    if sha256 is not None and binascii.hexlify(h.digest()).decode() != sha256:
+        log("❌ {} failed the hash check, discarded".format(path))
+        _remove(part)
+        return False
+    _remove(path)
+    uos.rename(part, path)
+    return True
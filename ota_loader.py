@@ -0,0 +1,57 @@
+import uos
+import machine
+
+# ========== .MPY LOADER ==========
+# A release built by tools/build_mpy.py ships the gateway as precompiled
+# bytecode: main.py is a stub that calls start("main_app"), every other
+# module is X.mpy with its source alongside as X.py.src. A .mpy built for a
+# different firmware (or damaged) fails to import; the sources are then
+# put in place and the device restarts on them. Stays source, like
+# ota_boot, so a bad bytecode set can always be recovered.
+FLASH_DIR = "/flash/"
+SRC_SUFFIX = ".src"
+
+# "mpy" once start() loaded the application from bytecode
+mode = "py"
+
+def log(msg):
+    print("[OTA] " + msg)
+
+def exists(path):
+    try:
+        uos.stat(path)
+        return True
+    except OSError:
+        return False
+
+def fall_back():
+    """Replaces each X.mpy that has an X.py.src with that source. Returns files replaced."""
+    replaced = 0
+    for name in uos.listdir(FLASH_DIR):
+        if not name.endswith(".mpy"):
+            continue
+        base = FLASH_DIR + name[:-4]
+        if not exists(base + ".py" + SRC_SUFFIX):
+            continue
+        if exists(base + ".py"):
+            uos.remove(base + ".py")
+        uos.rename(base + ".py" + SRC_SUFFIX, base + ".py")
+        uos.remove(FLASH_DIR + name)
+        replaced += 1
+    return replaced
+
+def start(name):
+    """Imports the application module 'name' and runs its main()."""
+    global mode
+    try:
+        app = __import__(name)
+    except Exception as e:
+        log("⚠️ {} failed to load: {}".format(name, e))
+        replaced = fall_back()
+        if replaced:
+            log("Restarting on sources ({} modules)".format(replaced))
+            machine.reset()
+        raise
+    if getattr(app, "__file__", "").endswith(".mpy"):
+        mode = "mpy"
+    app.main()
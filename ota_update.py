@@ -2,25 +2,52 @@ import curl
 import machine
 import uos
 import gc
+import json
 import globals
+try:
+    import uhashlib as hashlib
+    import ubinascii as binascii
+except ImportError:
+    import hashlib
+    import binascii
 from utime import sleep
 from meter_gsm import gsmInitialization, gsmCheckStatus
+import ota_boot
+import ota_http
+from ota_boot import STAGE_DIR
 
 # ====== Configuration ======
 UPDATE_URL = globals.UPDATE_URL
 VERSION_FILE = globals.VERSION_FILE
+# {"version", "files": {name: {"size", "sha256"}}} built by tools/make_manifest.py.
+# The device keeps the manifest of what it has installed next to the files.
+MANIFEST_NAME = "manifest.json"
+LOCAL_MANIFEST = "/flash/manifest.json"
+HASH_CHUNK = 512
 
 FILES_TO_UPDATE = [
     "boot.py",
-    "main_meter.py",
     "main.py",
+    "meter_async.py",
+    "meter_bus.py",
+    "meter_cmdqueue.py",
     "meter_gsm.py",
+    "meter_health.py",
+    "meter_ledger.py",
+    "meter_log.py",
+    "meter_metrics.py",
     "meter_mqtts.py",
+    "meter_outbox.py",
+    "meter_predict.py",
+    "meter_registers.py",
+    "meter_report.py",
     "meter_run.py",
-    "meter_sim.py",
+    "meter_scheduler.py",
     "meter_storage.py",
-    "meter_tests.py",
-    "meter.py"
+    "meter.py",
+    "ota_boot.py",
+    "ota_http.py",
+    "ota_loader.py"
 ]
 
 # ====== Utility Functions ======
@@ -59,6 +86,119 @@ def save_local_version(version):
     except Exception as e:
         log("Failed to write version file: {}".format(e))
 
+def file_hash(path):
+    """sha256 of a file as hex, read in small chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    return binascii.hexlify(h.digest()).decode()
+
+# ====== Manifest ======
+def load_local_manifest():
+    try:
+        with open(LOCAL_MANIFEST, "r") as f:
+            manifest = json.loads(f.read())
+        manifest.setdefault("files", {})
+        return manifest
+    except:
+        return {"version": get_local_version(), "files": {}}
+
+def save_local_manifest(manifest):
+    tmp_path = LOCAL_MANIFEST + ".tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(manifest))
+        if file_exists(LOCAL_MANIFEST):
+            uos.remove(LOCAL_MANIFEST)
+        uos.rename(tmp_path, LOCAL_MANIFEST)
+    except Exception as e:
+        log("Failed to write manifest: {}".format(e))
+
+def fetch_manifest():
+    """Server manifest as a dict, or None (missing on the server, bad JSON, no link)."""
+    tmp_path = ensure_temp_dir() + "/tmp_" + MANIFEST_NAME
+    try:
+        res_code, hdr, body = curl.get(UPDATE_URL + "/" + MANIFEST_NAME, tmp_path)
+        if res_code != 0 or "200" not in hdr:
+            log("No manifest (curl code {})".format(res_code))
+            return None
+        with open(tmp_path, "r") as f:
+            manifest = json.loads(f.read())
+        uos.remove(tmp_path)
+        if "files" not in manifest:
+            return None
+        return manifest
+    except Exception as e:
+        log("Error reading manifest: {}".format(e))
+        return None
+
+def changed_files(remote, local):
+    """
+    Files whose installed copy differs from the server manifest. The local
+    manifest stands in for hashing; files it does not know are hashed on
+    flash and, if they match, added to it.
+    """
+    changed = []
+    for fname in sorted(remote["files"]):
+        entry = remote["files"][fname]
+        dest_path = "/flash/" + fname
+        try:
+            size = uos.stat(dest_path)[6]
+        except OSError:
+            changed.append(fname)
+            continue
+        if size != entry["size"]:
+            changed.append(fname)
+            continue
+        known = local["files"].get(fname)
+        if known is not None and known.get("size") == size:
+            sha = known["sha256"]
+        else:
+            sha = file_hash(dest_path)
+        if sha != entry["sha256"]:
+            changed.append(fname)
+        elif known is None:
+            local["files"][fname] = entry
+    return changed
+
+def apply_manifest(remote, version):
+    """
+    Stages only the files that changed, then swaps the whole set in through
+    ota_boot (new local manifest included). A failed download leaves the
+    live files alone; what was staged is reused next time. Returns True if
+    a new set was swapped in.
+    """
+    local = load_local_manifest()
+    todo = changed_files(remote, local)
+    # Files this device got from an earlier manifest that the release dropped
+    removed = [fname for fname in local["files"] if fname not in remote["files"]]
+    # A source left next to a release's .mpy (older install, loader fallback) would shadow it
+    for fname in remote["files"]:
+        if fname.endswith(".mpy"):
+            source = fname[:-4] + ".py"
+            if source not in remote["files"] and source not in removed and file_exists("/flash/" + source):
+                removed.append(source)
+    log("{} of {} files changed, {} removed".format(len(todo), len(remote["files"]), len(removed)))
+
+    if not todo and not removed:
+        local["version"] = version
+        save_local_manifest(local)
+        save_local_version(version)
+        return False
+    if not stage_files(todo, remote):
+        log("⚠️ Staging incomplete; live files untouched, resuming next time")
+        return False
+
+    remote["version"] = version
+    with open(STAGE_DIR + "/" + MANIFEST_NAME, "w") as f:
+        f.write(json.dumps(remote))
+    ota_boot.begin_swap(todo + [MANIFEST_NAME], removed, version)
+    return True
+
 # ====== OTA Logic ======
 def check_for_update():
     try:
@@ -74,6 +214,9 @@ def check_for_update():
         server_version = body.strip()
         local_version = get_local_version()
 
+        if server_version == ota_boot.rejected_version():
+            log("Version {} was rolled back, waiting for a newer one".format(server_version))
+            return None
         if server_version != local_version:
             log("New version available: {} (local {})".format(server_version, local_version))
             return server_version
@@ -85,56 +228,40 @@ def check_for_update():
         return None
 
 
-def download_file(fname, retries=3):
+def download_file(fname, retries=3, sha256=None):
     """
-    Downloads file from UPDATE_URL + fname using curl, writes to flash in chunks.
-    Ensures file integrity by checking size consistency.
+    Downloads UPDATE_URL + fname into the staging directory; nothing live is
+    touched. With 'sha256' (from the manifest) a mismatching download is
+    discarded, and a copy already staged by an earlier run is reused.
     """
-    temp_dir = ensure_temp_dir()
+    ensure_temp_dir()
     url = UPDATE_URL + "/" + fname
-    tmp_path = temp_dir + "/tmp_" + fname
-    dest_path = "/flash/" + fname
-
-    for attempt in range(1, retries + 1):
-        try:
-            log("Downloading [{}] (Attempt {}/{})".format(fname, attempt, retries))
-
-            # Use LoBo-style curl.get() with file output
-            res_code, hdr, body = curl.get(url, tmp_path)
-
-            if res_code == 0 and "200" in hdr:
-                size_on_disk = uos.stat(tmp_path)[6]
-                log("✅ Download complete: {} bytes".format(size_on_disk))
-
-                # Safely replace the old file
-                if file_exists(dest_path):
-                    uos.remove(dest_path)
-                uos.rename(tmp_path, dest_path)
-                log("✅ Updated {}".format(fname))
-                return True
-            else:
-                log("❌ Download failed {} (curl code {}, hdr: {})".format(fname, res_code, hdr))
+    staged_path = STAGE_DIR + "/" + fname
 
-        except Exception as e:
-            log("⚠️ Error downloading {}: {}".format(fname, e))
+    if sha256 is not None and file_exists(staged_path) and file_hash(staged_path) == sha256:
+        log("Already staged: {}".format(fname))
+        return True
 
-        sleep(3)
+    log("Downloading [{}]".format(fname))
+    # Range chunks, resumed across retries and reboots; hashed while streaming
+    if ota_http.download(url, staged_path, sha256=sha256, retries=retries):
+        log("✅ Staged {}: {} bytes".format(fname, uos.stat(staged_path)[6]))
+        return True
 
-    log("⚠️ Skipping {} after multiple failures".format(fname))
+    log("⚠️ Giving up on {} after multiple failures".format(fname))
     return False
 
-
-
-def download_and_replace_files(file_list):
+def stage_files(file_list, manifest=None):
+    """Stages every file in 'file_list'. Returns False at the first one that fails."""
     total = len(file_list)
     for i, fname in enumerate(file_list):
-        log("Updating file {}/{}: {}".format(i + 1, total, fname))
-        success = download_file(fname)
-        if not success:
-            log("⚠️ Skipped file due to repeated failures: {}".format(fname))
+        log("Staging file {}/{}: {}".format(i + 1, total, fname))
+        sha256 = manifest["files"][fname]["sha256"] if manifest else None
+        if not download_file(fname, sha256=sha256):
+            return False
         gc.collect()
-        sleep(1)
-        
+    return True
+
 def update_global_file(device_id, retries=3):
     """
     Safely update globals.py only for the correct device.
@@ -184,9 +311,7 @@ def update_global_file(device_id, retries=3):
     for attempt in range(1, retries + 1):
         try:
             log("⬇️ Downloading device-specific [{}] (Attempt {}/{})".format(fname, attempt, retries))
-            res_code, hdr, body = curl.get(url, tmp_path)
-
-            if res_code == 0 and "200" in hdr:
+            if ota_http.download(url, tmp_path, retries=1):
                 new_version = get_version(tmp_path)
                 log("🆕 Downloaded version: {}".format(new_version))
 
@@ -221,7 +346,7 @@ def update_global_file(device_id, retries=3):
                         uos.remove(tmp_path)
                     return False
             else:
-                log("❌ Download failed (curl code {}, hdr: {})".format(res_code, hdr))
+                log("❌ Download of {} incomplete".format(fname))
 
         except Exception as e:
             log("⚠️ Error downloading {}: {}".format(fname, e))
@@ -265,10 +390,20 @@ def run_ota():
     new_version = check_for_update()
 
     if new_version:
-        log("Starting file updates...")
-        download_and_replace_files(FILES_TO_UPDATE)
-        save_local_version(new_version)
-        log("✅ Update complete. Rebooting in 3 seconds...")
+        manifest = fetch_manifest()
+        if manifest is None:
+            # Server without a manifest: every file, still staged and swapped as a set
+            log("Starting file updates...")
+            if not stage_files(FILES_TO_UPDATE):
+                log("⚠️ Staging incomplete; live files untouched")
+                return
+            # Installed files no longer match the local manifest
+            removed = [MANIFEST_NAME] if file_exists(LOCAL_MANIFEST) else []
+            ota_boot.begin_swap(list(FILES_TO_UPDATE), removed, new_version)
+        elif not apply_manifest(manifest, new_version):
+            return
+        # version.txt is written when main.py confirms the new set
+        log("✅ Update staged. Rebooting in 3 seconds...")
         sleep(3)
         machine.reset()
     else:
@@ -0,0 +1,333 @@
+"""
+CPython simulator for the gateway.
+
+The firmware modules (main.py, meter*.py, ota_update.py) run unmodified:
+their imports of machine, gsm, network, curl, usocket, ussl, utime/time,
+uos/os, _thread, gc, uasyncio and globals are answered with the stand-ins in
+sim.hal, sim.clock, sim.flash and sim.aio, and their open() goes to an
+in-memory /flash.
+RS-485 meters are emulated by sim.modbus.SimMeter, time is virtual.
+
+    from sim import Simulator
+    sim = Simulator("FQX_SM_10009")
+    for addr in sim.globals.SLAVE_ADDRESSES:
+        sim.add_meter(addr, cumulative=1000, flow_lps=0.02)
+    sim.command(600, 1, "success", litres=50)
+    sim.run(3600)                      # boots main.main() and runs 1 h
+    print(sim.broker.messages("device_report"))
+
+Only one Simulator is active per process; creating one retires the last.
+"""
+import builtins
+import collections
+import importlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
+import io
+import os
+import random
+import sys
+import traceback
+import types
+
+from sim.clock import SimClock, SimStop, DEFAULT_START, make_utime
+from sim.flash import Flash, make_uos
+from sim.aio import make_uasyncio
+from sim.modbus import SimMeter, RS485Line, VALVE_OPEN, VALVE_CLOSED
+from sim import hal
+from sim.hal import SimReset
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_DIR = os.path.join(REPO_ROOT, "device_configs")
+# FQX_SM_10007 uses Python 2 style 01 literals and cannot be loaded here
+DEFAULT_CONFIG = "FQX_SM_10009"
+# ESP32 + PSRAM-less LoBo build: roughly what gc.mem_free() shows after boot
+HEAP_SIZE = 110000
+HEAP_FREE = 90000
+
+_active = None
+
+def load_globals(config=DEFAULT_CONFIG, overrides=None):
+    """Builds the 'globals' module from device_configs/<config>_globals.py."""
+    path = os.path.join(CONFIG_DIR, config + "_globals.py")
+    with open(path) as f:
+        source = f.read()
+    mod = types.ModuleType("globals")
+    mod.__file__ = path
+    exec(compile(source, path, "exec"), mod.__dict__)
+    for name, value in (overrides or {}).items():
+        setattr(mod, name, value)
+    return mod, source
+
+def _repo_modules():
+    names = []
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if path and os.path.dirname(os.path.abspath(path)) == REPO_ROOT:
+            names.append(name)
+    return names
+
+def _unload_repo_modules():
+    for name in _repo_modules():
+        del sys.modules[name]
+
+# ========== IMPORT HOOK ==========
+class _RepoLoader(importlib.machinery.SourceFileLoader):
+    """Runs a firmware module with the simulator's builtins (open, __import__, print)."""
+    def __init__(self, sim, name, path):
+        importlib.machinery.SourceFileLoader.__init__(self, name, path)
+        self.sim = sim
+
+    def exec_module(self, module):
+        module.__dict__["__builtins__"] = self.sim.builtins
+        importlib.machinery.SourceFileLoader.exec_module(self, module)
+
+class _RepoFinder(importlib.abc.MetaPathFinder):
+    def __init__(self, sim):
+        self.sim = sim
+
+    def find_spec(self, name, path=None, target=None):
+        if path is not None or "." in name:
+            return None
+        filename = os.path.join(REPO_ROOT, name + ".py")
+        if not os.path.isfile(filename):
+            return None
+        loader = _RepoLoader(self.sim, name, filename)
+        return importlib.util.spec_from_file_location(name, filename, loader=loader)
+
+class Network(object):
+    """Link state shared by gsm, the MQTT broker and the HTTP server."""
+    def __init__(self):
+        self.gsm_up = True
+
+# ========== SIMULATOR ==========
+class Simulator(object):
+    def __init__(self, config=DEFAULT_CONFIG, overrides=None, start=DEFAULT_START,
+                 seed=1, quiet=True, auto_reboot=True):
+        global _active
+        if _active is not None:
+            _active.close()
+
+        self.clock = SimClock(start)
+        self.clock.on_exit = self._thread_exit
+        self.rng = random.Random(seed)
+        self.flash = Flash()
+        self.network = Network()
+        self.globals, globals_source = load_globals(config, overrides)
+        self.broker = hal.Broker(self)
+        self.http = hal.HttpServer(self, self.globals.UPDATE_URL, REPO_ROOT)
+        self.lines = {}
+
+        self.heap_size = HEAP_SIZE
+        self.heap_free = HEAP_FREE
+        self.gc_runs = 0
+        self.wdt_enabled = False
+        self.wdt_fed = None
+        # Longest time the firmware went without feeding an enabled WDT
+        self.wdt_max_gap = 0.0
+        self.thread_names = []
+        self.boots = 0
+        self.resets = []
+        self.crashes = []
+        self.auto_reboot = auto_reboot
+        self.quiet = quiet
+        self.console = collections.deque(maxlen=5000)
+
+        # The device has its own globals.py and version file on flash
+        self.flash.write("/flash/globals.py", globals_source)
+        version = os.path.join(REPO_ROOT, "version.txt")
+        if os.path.isfile(version):
+            with open(version, "rb") as f:
+                self.flash.write(self.globals.VERSION_FILE, f.read().strip())
+
+        utime = make_utime(self.clock)
+        uos = make_uos(self.flash)
+        self.standins = {
+            "machine": hal.make_machine(self),
+            "gsm": hal.make_gsm(self),
+            "network": hal.make_network(self),
+            "curl": hal.make_curl(self),
+            "usocket": hal.make_usocket(self),
+            "ussl": hal.make_ussl(self),
+            "_thread": hal.make_thread(self),
+            "gc": hal.make_gc(self),
+            "utime": utime,
+            "time": utime,
+            "uos": uos,
+            "os": uos,
+            "uasyncio": make_uasyncio(self),
+            "globals": self.globals,
+        }
+        self.builtins = dict(builtins.__dict__)
+        self.builtins["open"] = self.flash.open
+        self.builtins["__import__"] = self._import
+        self.builtins["print"] = self._print
+
+        _unload_repo_modules()
+        self._finder = _RepoFinder(self)
+        sys.meta_path.insert(0, self._finder)
+        _active = self
+
+    def close(self):
+        global _active
+        self.clock.kill_all()
+        if self._finder in sys.meta_path:
+            sys.meta_path.remove(self._finder)
+        _unload_repo_modules()
+        if _active is self:
+            _active = None
+
+    # ----- firmware side -----
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level == 0:
+            mod = self.standins.get(name)
+            if mod is not None:
+                return mod
+        return builtins.__import__(name, globals, locals, fromlist, level)
+
+    def _print(self, *args, **kwargs):
+        kwargs.pop("file", None)
+        out = io.StringIO()
+        builtins.print(*args, file=out, **kwargs)
+        text = out.getvalue()
+        self.console.append("[%9.3f] %s" % (self.clock.elapsed(), text.rstrip("\n")))
+        if not self.quiet:
+            sys.stdout.write(text)
+
+    def log(self, msg):
+        self._print("[SIM] " + msg)
+
+    def _wdt_gap(self):
+        if self.wdt_enabled and self.wdt_fed is not None:
+            self.wdt_max_gap = max(self.wdt_max_gap, self.clock.elapsed() - self.wdt_fed)
+
+    def wdt_feed(self):
+        self._wdt_gap()
+        self.wdt_fed = self.clock.elapsed()
+
+    def machine_reset(self):
+        """
+        machine.reset(): every thread of this boot is retired at once and,
+        with auto_reboot, the next boot starts at the same instant.
+        """
+        self.resets.append(self.clock.elapsed())
+        self.log("machine.reset()")
+        self._wdt_gap()
+        self.clock.kill_all()
+        if self.auto_reboot:
+            self.clock.spawn(self._power_on)
+
+    def _thread_exit(self, func, error):
+        name = getattr(func, "__name__", "?")
+        if error is not None:
+            self.crashes.append((self.clock.elapsed(), name, "".join(
+                traceback.format_exception(type(error), error, error.__traceback__))))
+            self.log("Thread %s crashed: %r" % (name, error))
+
+    # ----- hardware -----
+    def line(self, uart_id):
+        """RS-485 line behind UART 'uart_id' (created on first use)."""
+        line = self.lines.get(uart_id)
+        if line is None:
+            line = RS485Line(self.clock)
+            self.lines[uart_id] = line
+        return line
+
+    def add_meter(self, address, uart=2, **kwargs):
+        """Wires an emulated meter to UART 'uart' (UART2 is the default bus)."""
+        kwargs.setdefault("seed", self.rng.randrange(1 << 30))
+        return self.line(uart).add(SimMeter(address, **kwargs))
+
+    def meter(self, address):
+        for line in self.lines.values():
+            if address in line.meters:
+                return line.meters[address]
+        return None
+
+    def litres(self, address):
+        """Current reading of an emulated meter."""
+        meter = self.meter(address)
+        meter.advance(self.clock.elapsed())
+        return meter.cumulative
+
+    # ----- scenario -----
+    def load(self, name):
+        """Imports a firmware module under the simulator."""
+        return importlib.import_module(name)
+
+    def at(self, elapsed_s, func, *args):
+        self.clock.at(elapsed_s, func, *args)
+
+    def command(self, elapsed_s, address, message, litres=None):
+        """Schedules a backend command (success / valve_open / valve_close)."""
+        device_id = "%s-%d" % (self.globals.MQTT_CLIENT_ID, address)
+        topic = "smartmeter/%s/sub/controlcomm/message" % device_id
+        payload = {"message": message, "deviceID": device_id}
+        if litres is not None:
+            payload["litres"] = litres
+        self.at(elapsed_s, self.broker.deliver, topic, payload)
+
+    def boot(self, entry="main"):
+        """Imports main.py afresh and starts main.main() in a simulated thread."""
+        self.boots += 1
+        self.log("Boot #%d" % self.boots)
+        # boot.py's OTA check (finish a swap, count trial boots, roll back)
+        self.load("ota_boot").run()
+        module = self.load(entry)
+        self.clock.spawn(module.main)
+
+    def reboot(self):
+        """Power cycle: RAM (modules, threads, MQTT session) is lost, flash is kept."""
+        self.clock.kill_all()
+        self._power_on()
+
+    def _power_on(self):
+        # The hardware WDT is off again until the firmware enables it
+        self.wdt_enabled = False
+        self.wdt_fed = None
+        _unload_repo_modules()
+        self.broker.clients = []
+        for line in self.lines.values():
+            line.take(len(line._rx))
+        self.boot()
+
+    def run(self, seconds):
+        """Advances the simulation by 'seconds', booting the device first if needed."""
+        if not self.boots:
+            self.boot()
+        self.clock.sleep_us(seconds * 1000000)
+        return self
+
+    @property
+    def elapsed(self):
+        return self.clock.elapsed()
+
+    def stats(self):
+        """Summary of one run for logs and benchmarks."""
+        lines = {}
+        for uart_id, line in self.lines.items():
+            lines[uart_id] = {
+                "tx_bytes": line.tx_bytes,
+                "rx_bytes": line.rx_bytes,
+                "busy_s": round(line.busy_us / 1000000.0, 3),
+                "requests": sum(m.requests for m in line.meters.values()),
+                "valve_writes": sum(m.valve_writes for m in line.meters.values()),
+            }
+        return {
+            "elapsed_s": self.clock.elapsed(),
+            "boots": self.boots,
+            "resets": len(self.resets),
+            "crashes": len(self.crashes),
+            "wdt_max_gap_s": round(self.wdt_max_gap, 3),
+            "published": len(self.broker.published),
+            "http_requests": len(self.http.requests),
+            "flash_writes": self.flash.writes,
+            "flash_bytes_written": self.flash.bytes_written,
+            "buses": lines,
+        }
+
+__all__ = [
+    "Simulator", "SimMeter", "SimReset", "SimStop", "VALVE_OPEN", "VALVE_CLOSED",
+    "load_globals", "DEFAULT_CONFIG",
+]
@@ -0,0 +1,180 @@
+"""
+uasyncio stand-in on the simulated clock.
+
+Implements the subset the firmware uses (run, create_task, sleep,
+sleep_ms, gather, Event, Lock). The loop runs inside one simulated
+thread: when every task is waiting it sleeps that thread on SimClock
+until the next timer, so MQTT callbacks and other threads still run.
+"""
+import collections
+import heapq
+import types
+
+# Poll interval while every task waits on an event nobody in the loop will set
+IDLE_US = 10000
+
+class _Task(object):
+    def __init__(self, loop, coro):
+        self.loop = loop
+        self.coro = coro
+        self.done = False
+        self.result = None
+        self.error = None
+        self.waiters = []
+
+    def __await__(self):
+        while not self.done:
+            yield ("join", self)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+@types.coroutine
+def _park(event):
+    yield ("wait", event)
+
+@types.coroutine
+def sleep_ms(ms):
+    yield ("sleep", int(ms * 1000))
+
+def sleep(seconds):
+    return sleep_ms(seconds * 1000)
+
+class Event(object):
+    def __init__(self):
+        self.state = False
+        self.waiting = []
+
+    def set(self):
+        self.state = True
+        waiting, self.waiting = self.waiting, []
+        for task in waiting:
+            task.loop.ready.append(task)
+
+    def clear(self):
+        self.state = False
+
+    def is_set(self):
+        return self.state
+
+    async def wait(self):
+        while not self.state:
+            await _park(self)
+        return True
+
+class Lock(object):
+    def __init__(self):
+        self.held = False
+        self._released = Event()
+
+    def locked(self):
+        return self.held
+
+    async def acquire(self):
+        while self.held:
+            self._released.clear()
+            await self._released.wait()
+        self.held = True
+        return True
+
+    def release(self):
+        self.held = False
+        self._released.set()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+class _Loop(object):
+    def __init__(self, clock, log):
+        self.clock = clock
+        self.log = log
+        self.ready = collections.deque()
+        self.sleeping = []
+        self.seq = 0
+
+    def create_task(self, coro):
+        task = _Task(self, coro)
+        self.ready.append(task)
+        return task
+
+    def _step(self, task):
+        try:
+            request = task.coro.send(None)
+        except StopIteration as e:
+            self._finish(task, e.value, None)
+            return
+        except Exception as e:
+            self.log("Task exception: %r" % e)
+            self._finish(task, None, e)
+            return
+        kind, arg = request
+        if kind == "sleep":
+            self.seq += 1
+            heapq.heappush(self.sleeping, (self.clock.us + arg, self.seq, task))
+        elif kind == "wait":
+            arg.waiting.append(task)
+        elif kind == "join":
+            arg.waiters.append(task)
+
+    def _finish(self, task, result, error):
+        task.done = True
+        task.result = result
+        task.error = error
+        for waiter in task.waiters:
+            self.ready.append(waiter)
+        task.waiters = []
+
+    def run_until_complete(self, main):
+        while not main.done:
+            while self.ready:
+                self._step(self.ready.popleft())
+            if main.done:
+                break
+            if self.sleeping:
+                wake = self.sleeping[0][0]
+                self.clock.sleep_us(max(0, wake - self.clock.us))
+            else:
+                self.clock.sleep_us(IDLE_US)
+            while self.sleeping and self.sleeping[0][0] <= self.clock.us:
+                self.ready.append(heapq.heappop(self.sleeping)[2])
+        if main.error is not None:
+            raise main.error
+        return main.result
+
+def make_uasyncio(sim):
+    mod = types.ModuleType("uasyncio")
+    state = {"loop": None}
+
+    def get_event_loop():
+        if state["loop"] is None:
+            state["loop"] = _Loop(sim.clock, sim.log)
+        return state["loop"]
+
+    def create_task(coro):
+        return get_event_loop().create_task(coro)
+
+    def run(coro):
+        state["loop"] = None
+        loop = get_event_loop()
+        return loop.run_until_complete(loop.create_task(coro))
+
+    async def gather(*coros):
+        tasks = [create_task(c) for c in coros]
+        results = []
+        for task in tasks:
+            results.append(await task)
+        return results
+
+    mod.run = run
+    mod.create_task = create_task
+    mod.get_event_loop = get_event_loop
+    mod.gather = gather
+    mod.sleep = sleep
+    mod.sleep_ms = sleep_ms
+    mod.Event = Event
+    mod.Lock = Lock
+    return mod
@@ -0,0 +1,270 @@
+"""
+Benchmark suite for the gateway hot paths, run on the simulator.
+
+    python -m sim.bench                     # run, compare with the baseline
+    python -m sim.bench --quick             # fewer CPU rounds, skips 247 meters
+    python -m sim.bench --save-baseline     # accept the current numbers
+
+Two kinds of metric are recorded:
+  "sim"  - simulated device time and counts (bus latency, sweep time,
+           command latency, flash bytes). Deterministic, so compared tightly.
+  "host" - CPU time of the Python code on this machine. Useful for spotting
+           code that got slower, but noisy and machine dependent.
+
+Results go to --output as JSON. The exit status is 1 if any metric is
+worse than the baseline by more than its tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from sim import Simulator
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+SWEEP_SIZES = (1, 6, 32, 247)
+STORAGE_SIZES = (6, 247)
+# Allowed change in the "worse" direction before a metric is a regression
+HOST_TOLERANCE = 0.50
+SIM_TOLERANCE = 0.02
+TOPIC = "bench/pub"
+# Every target store write goes through this temp file (write_json_atomic)
+STORE_TMP = "/flash/mem/targets.json.tmp"
+
+class Results(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit, better="lower", kind="sim"):
+        self.metrics[name] = {
+            "value": round(value, 3),
+            "unit": unit,
+            "better": better,
+            "kind": kind,
+        }
+        print("  %-32s %12.3f %s" % (name, value, unit))
+
+def _rate(func, args, rounds):
+    """Calls per second of func(*args) over 'rounds' calls (host CPU)."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(*args)
+    elapsed = time.perf_counter() - start
+    return rounds / max(elapsed, 1e-9)
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+def _noop_publish(client, topic, message):
+    return True
+
+# ========== BENCHMARKS ==========
+def bench_codec(results, rounds):
+    """CRC, request build and reply parse throughput."""
+    print("Codec")
+    Simulator()
+    import meter
+    import meter_registers
+
+    request = meter.build_modbus_request(1, 0x03, 0x000E, 2)
+    body = bytearray([0x01, 0x03, 0x04, 0x86, 0xA0, 0x00, 0x01])
+    crc = meter.calculate_crc(body)
+    reply = bytes(body + bytearray([crc & 0xFF, crc >> 8]))
+
+    def parse(frame):
+        if not meter.verify_crc(frame):
+            raise AssertionError("bad CRC in benchmark frame")
+        out = {}
+        meter_registers.decode_block(frame, 3, 0x000E, ("cumulative_flow",), out)
+        return out
+
+    if parse(reply)["cumulative_flow"] != 100000:
+        raise AssertionError("decode mismatch")
+    results.add("crc_frames_per_s", _rate(meter.calculate_crc, (request, 0, 6), rounds),
+                "frames/s", "higher", "host")
+    results.add("build_request_per_s", _rate(meter.build_modbus_request, (1, 0x03, 0x000E, 2), rounds),
+                "frames/s", "higher", "host")
+    results.add("parse_reply_per_s", _rate(parse, (reply,), rounds), "frames/s", "higher", "host")
+
+def bench_transaction(results, count):
+    """One 0x03 read and one 0x10 valve write against a 20 ms meter at 9600 baud."""
+    print("Modbus transaction")
+    sim = Simulator()
+    sim.add_meter(1, cumulative=12345, latency_ms=20, jitter_ms=10)
+    import meter
+
+    latencies = []
+    host = 0.0
+    for _ in range(count):
+        start = time.perf_counter()
+        if meter.read_cumulative_flow(meter.uart, 1) is None:
+            raise AssertionError("simulated meter did not answer")
+        host += time.perf_counter() - start
+        latencies.append(meter.last_latency_us / 1000.0)
+    results.add("read_latency_ms_mean", sum(latencies) / len(latencies), "ms")
+    results.add("read_latency_ms_p95", _percentile(latencies, 0.95), "ms")
+    results.add("read_host_us", host * 1000000 / count, "us", "lower", "host")
+
+    meter.write_single_register(meter.uart, 1, meter.VALVE_REGISTER, meter.VALVE_OPEN)
+    results.add("write_latency_ms", meter.last_latency_us / 1000.0, "ms")
+
+def bench_sweep(results, sizes):
+    """read_meter_parameters_upload over growing meter counts (cold, then steady state)."""
+    print("Sweep")
+    for n in sizes:
+        addresses = list(range(1, n + 1))
+        sim = Simulator(overrides={"SLAVE_ADDRESSES": addresses, "PUBLISH_BUDGET_PER_HOUR": 1000000})
+        for address in addresses:
+            sim.add_meter(address, cumulative=1000 + address, flow_lps=0.01)
+        import meter
+
+        # Cold: targets are initialised and every valve is written once
+        start = sim.elapsed
+        meter.read_meter_parameters_upload(meter.uart, addresses, _noop_publish, None, TOPIC)
+        results.add("sweep_%d_cold_s" % n, sim.elapsed - start, "s")
+
+        sim.clock.sleep_us(180 * 1000000)
+        start = sim.elapsed
+        stored = sim.flash.writes_by_path.get(STORE_TMP, 0)
+        host = time.perf_counter()
+        meter.read_meter_parameters_upload(meter.uart, addresses, _noop_publish, None, TOPIC)
+        host = time.perf_counter() - host
+        results.add("sweep_%d_s" % n, sim.elapsed - start, "s")
+        results.add("sweep_%d_host_ms" % n, host * 1000, "ms", "lower", "host")
+        # No target changed, so the target store must not be rewritten
+        results.add("sweep_%d_store_writes" % n,
+                    sim.flash.writes_by_path.get(STORE_TMP, 0) - stored, "writes")
+
+def bench_storage(results, sizes, rounds):
+    """Target store: one flushed save and a cold load, by table size."""
+    print("Storage")
+    for n in sizes:
+        sim = Simulator()
+        import meter_storage
+        for address in range(1, n + 1):
+            meter_storage.save_target_reading(address, 1000 + address, flush=False)
+        meter_storage.flush_targets(force=True)
+
+        written = sim.flash.bytes_written
+        start = time.perf_counter()
+        for i in range(rounds):
+            meter_storage.save_target_reading(1 + i % n, 2000 + i, flush=True)
+        host = time.perf_counter() - start
+        results.add("store_%d_save_host_us" % n, host * 1000000 / rounds, "us", "lower", "host")
+        results.add("store_%d_save_bytes" % n, (sim.flash.bytes_written - written) / float(rounds), "B")
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            meter_storage._targets = None
+            meter_storage._load_store()
+        host = time.perf_counter() - start
+        results.add("store_%d_load_host_us" % n, host * 1000000 / rounds, "us", "lower", "host")
+
+def bench_commands(results, count, runtime="threads"):
+    """MQTT command to actuation latency on a booted gateway, per RUNTIME."""
+    prefix = "cmd" if runtime == "threads" else "cmd_" + runtime
+    print("Commands (%s)" % runtime)
+    sim = Simulator(seed=7, overrides={"RUNTIME": runtime})
+    addresses = sim.globals.SLAVE_ADDRESSES
+    for address in addresses:
+        sim.add_meter(address, cumulative=1000 + address, flow_lps=0.01)
+
+    kinds = ("valve_close", "valve_open", "success")
+    first = 120
+    gap = 37.3
+    for i in range(count):
+        kind = kinds[i % len(kinds)]
+        litres = 5 if kind == "success" else None
+        sim.command(first + i * gap, addresses[i % len(addresses)], kind, litres)
+    sim.run(first + count * gap + 60)
+
+    acks = [msg for _, msg in sim.broker.messages("device_report") if "latency_ms" in msg]
+    if not acks:
+        raise AssertionError("no command acknowledgements published")
+    latencies = [msg["latency_ms"] for msg in acks]
+    results.add(prefix + "_acked", len(acks), "cmds", "higher")
+    results.add(prefix + "_latency_ms_mean", sum(latencies) / float(len(latencies)), "ms")
+    results.add(prefix + "_latency_ms_max", max(latencies), "ms")
+
+# ========== BASELINE ==========
+def compare(metrics, baseline, host_tolerance=HOST_TOLERANCE, sim_tolerance=SIM_TOLERANCE):
+    """Prints current vs baseline and returns the names of regressed metrics."""
+    regressions = []
+    print("\n%-32s %12s %12s %8s" % ("metric", "baseline", "current", "change"))
+    for name in sorted(metrics):
+        current = metrics[name]
+        base = baseline.get(name)
+        if base is None:
+            print("%-32s %12s %12.3f %8s" % (name, "-", current["value"], "new"))
+            continue
+        tolerance = host_tolerance if current["kind"] == "host" else sim_tolerance
+        old = base["value"]
+        new = current["value"]
+        change = (new - old) / old if old else (0.0 if new == old else float("inf"))
+        if current["better"] == "lower":
+            worse = new > old * (1 + tolerance) if old else new > 0
+        else:
+            worse = new < old * (1 - tolerance)
+        flag = "  REGRESSION" if worse else ""
+        print("%-32s %12.3f %12.3f %+7.1f%%%s" % (name, old, new, change * 100, flag))
+        if worse:
+            regressions.append(name)
+    return regressions
+
+def run(quick=False):
+    results = Results()
+    # Quick mode only trims host timing rounds and the 247 meter sweep;
+    # simulated workloads stay the same so they still match the baseline
+    bench_codec(results, 2000 if quick else 20000)
+    bench_transaction(results, 200)
+    bench_sweep(results, SWEEP_SIZES[:-1] if quick else SWEEP_SIZES)
+    bench_storage(results, STORAGE_SIZES, 200)
+    bench_commands(results, 30)
+    bench_commands(results, 30, "async")
+    return results.metrics
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m sim.bench")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--host-tolerance", type=float, default=HOST_TOLERANCE)
+    parser.add_argument("--sim-tolerance", type=float, default=SIM_TOLERANCE)
+    args = parser.parse_args()
+
+    metrics = run(args.quick)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "metrics": metrics,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("\nResults written to %s" % args.output)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("Baseline saved to %s" % args.baseline)
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print("No baseline at %s (run with --save-baseline)" % args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)["metrics"]
+    regressions = compare(metrics, baseline, args.host_tolerance, args.sim_tolerance)
+    if regressions:
+        print("\n%d regression(s): %s" % (len(regressions), ", ".join(regressions)))
+        return 1
+    print("\nNo regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
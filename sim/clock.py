@@ -0,0 +1,181 @@
+import heapq
+import threading
+import time as _host_time
+import types
+
+# ========== CLOCK CONFIG ==========
+# Virtual wall clock at boot (2026-01-05 08:00:00 UTC)
+DEFAULT_START = 1767600000
+# MicroPython ticks wrap at 2**30
+TICKS_PERIOD = 1 << 30
+_TICKS_MASK = TICKS_PERIOD - 1
+_TICKS_HALF = TICKS_PERIOD // 2
+
+class SimStop(BaseException):
+    """Ends a simulated thread that belongs to a previous boot."""
+    pass
+
+# ========== VIRTUAL CLOCK ==========
+class SimClock(object):
+    """
+    Discrete-event clock shared by every simulated thread.
+
+    Only one simulated thread runs at a time (it holds the baton). Time
+    stands still while code runs and only moves when the running thread
+    sleeps; the clock then jumps to the earliest wake-up among all
+    sleepers and hands the baton to that thread. Scheduled callbacks
+    (at()) run on whichever thread is resumed at or after their time.
+    Code that spins without ever sleeping stalls the whole simulation,
+    just as it would starve the watchdog on the device.
+    """
+    def __init__(self, start=DEFAULT_START):
+        self.start = start
+        self.us = 0
+        # Bumped on every simulated reboot; older threads stop when resumed
+        self.generation = 0
+        self.threads = 0
+        self.on_exit = None
+        self._cond = threading.Condition(threading.RLock())
+        self._local = threading.local()
+        self._sleepers = []
+        self._events = []
+        self._seq = 0
+        # The host thread that created the clock holds the baton
+        self._running = 1
+        self._current = None
+
+    # ----- time -----
+    def time(self):
+        return self.start + self.us // 1000000
+
+    def elapsed(self):
+        """Seconds since the simulation started (float)."""
+        return self.us / 1000000.0
+
+    def ticks_us(self):
+        return self.us & _TICKS_MASK
+
+    def ticks_ms(self):
+        return (self.us // 1000) & _TICKS_MASK
+
+    # ----- scheduling -----
+    def at(self, elapsed_s, func, *args):
+        """Runs func(*args) once the simulation reaches 'elapsed_s'."""
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._events, (int(elapsed_s * 1000000), self._seq, func, args))
+
+    def _push(self, wake, token):
+        self._seq += 1
+        heapq.heappush(self._sleepers, (wake, self._seq, token))
+
+    def _dispatch(self):
+        """Hands the baton to the next sleeper once nobody is running (lock held)."""
+        if self._running or not self._sleepers:
+            return
+        wake, _, token = heapq.heappop(self._sleepers)
+        self.us = max(self.us, wake)
+        self._current = token
+        self._running = 1
+        self._cond.notify_all()
+
+    def _wait_turn(self, token):
+        while self._current is not token:
+            self._cond.wait()
+
+    def _resume(self):
+        generation = getattr(self._local, "generation", None)
+        if generation is not None and generation != self.generation:
+            raise SimStop()
+        while True:
+            with self._cond:
+                if not self._events or self._events[0][0] > self.us:
+                    return
+                _, _, func, args = heapq.heappop(self._events)
+            func(*args)
+
+    def sleep_us(self, us):
+        token = object()
+        with self._cond:
+            self._push(self.us + max(0, int(us)), token)
+            self._running -= 1
+            self._dispatch()
+            self._wait_turn(token)
+        self._resume()
+
+    # ----- threads -----
+    def spawn(self, func, args=()):
+        """
+        Starts a simulated thread. It runs when the current thread next
+        sleeps; threads due at the same instant run in creation order.
+        """
+        token = object()
+        generation = self.generation
+        with self._cond:
+            self._push(self.us, token)
+            self.threads += 1
+
+        def body():
+            self._local.generation = generation
+            error = None
+            with self._cond:
+                self._wait_turn(token)
+            try:
+                self._resume()
+                func(*args)
+            except SimStop:
+                pass
+            except BaseException as e:
+                error = e
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self.threads -= 1
+            if self.on_exit is not None:
+                self.on_exit(func, error)
+            with self._cond:
+                self._dispatch()
+
+        thread = threading.Thread(target=body)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def kill_all(self):
+        """Retires every simulated thread (they exit the next time they wake)."""
+        self.generation += 1
+
+# ========== utime STAND-IN ==========
+def make_utime(clock):
+    """Builds a module with the utime API used by the firmware, on 'clock'."""
+    mod = types.ModuleType("utime")
+
+    def ticks_add(ticks, delta):
+        return (ticks + delta) & _TICKS_MASK
+
+    def ticks_diff(new, old):
+        return ((new - old + _TICKS_HALF) & _TICKS_MASK) - _TICKS_HALF
+
+    def localtime(secs=None):
+        if secs is None:
+            secs = clock.time()
+        t = _host_time.gmtime(secs)
+        return (t[0], t[1], t[2], t[3], t[4], t[5], t[6], t[7])
+
+    def mktime(t):
+        import calendar
+        return calendar.timegm((t[0], t[1], t[2], t[3], t[4], t[5], 0, 0, 0))
+
+    mod.time = clock.time
+    mod.ticks_us = clock.ticks_us
+    mod.ticks_ms = clock.ticks_ms
+    mod.ticks_cpu = clock.ticks_us
+    mod.ticks_add = ticks_add
+    mod.ticks_diff = ticks_diff
+    mod.sleep = lambda s: clock.sleep_us(s * 1000000)
+    mod.sleep_ms = lambda ms: clock.sleep_us(ms * 1000)
+    mod.sleep_us = clock.sleep_us
+    mod.localtime = localtime
+    mod.gmtime = localtime
+    mod.mktime = mktime
+    return mod
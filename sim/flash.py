@@ -0,0 +1,170 @@
+import errno
+import io
+import types
+
+# ========== IN-MEMORY FLASH ==========
+ROOT = "/flash"
+_DIR_MODE = 0x4000
+_FILE_MODE = 0x8000
+
+def _error(code, path):
+    return OSError(code, "%s: %s" % (errno.errorcode.get(code, code), path))
+
+class _FlashBuffer(io.BytesIO):
+    """File contents are written back to the flash dict on flush/close."""
+    def __init__(self, flash, path, data, writable):
+        io.BytesIO.__init__(self, data)
+        self._flash = flash
+        self._path = path
+        self._writable = writable
+
+    def write(self, data):
+        self._flash.bytes_written += len(data)
+        return io.BytesIO.write(self, data)
+
+    def flush(self):
+        io.BytesIO.flush(self)
+        if self._writable and not self.closed:
+            self._flash._commit(self._path, self.getvalue())
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+        io.BytesIO.close(self)
+
+class Flash(object):
+    """
+    The device's /flash filesystem held in a dict {path: bytes}.
+    Relative paths resolve against /flash like the firmware's cwd.
+    Write counters show how much a change costs in flash wear.
+    """
+    def __init__(self):
+        self.files = {}
+        self.dirs = set([ROOT, ROOT + "/lib"])
+        self.writes = 0
+        self.bytes_written = 0
+        # {path: writes}, to see which file a change rewrites
+        self.writes_by_path = {}
+
+    def path(self, path):
+        if not path.startswith("/"):
+            path = ROOT + "/" + path
+        while "//" in path:
+            path = path.replace("//", "/")
+        if len(path) > 1 and path.endswith("/"):
+            path = path[:-1]
+        return path
+
+    def _parent(self, path):
+        return path.rsplit("/", 1)[0] or "/"
+
+    def _commit(self, path, data):
+        if self.files.get(path) != data:
+            self.writes += 1
+            self.writes_by_path[path] = self.writes_by_path.get(path, 0) + 1
+        self.files[path] = data
+
+    # ----- builtins.open -----
+    def open(self, path, mode="r", *args, **kwargs):
+        path = self.path(path)
+        if path in self.dirs:
+            raise _error(errno.EISDIR, path)
+        exists = path in self.files
+        if "r" in mode and not exists:
+            raise _error(errno.ENOENT, path)
+        if ("w" in mode or "a" in mode) and self._parent(path) not in self.dirs:
+            raise _error(errno.ENOENT, path)
+
+        if "w" in mode:
+            data = b""
+            self._commit(path, data)
+        else:
+            data = self.files.get(path, b"")
+            if not exists:
+                self._commit(path, data)
+        writable = "w" in mode or "a" in mode or "+" in mode
+        buf = _FlashBuffer(self, path, data, writable)
+        if "a" in mode:
+            buf.seek(0, 2)
+        if "b" in mode:
+            return buf
+        return io.TextIOWrapper(buf, encoding="utf-8", newline="")
+
+    # ----- uos API -----
+    def stat(self, path):
+        path = self.path(path)
+        if path in self.dirs:
+            return (_DIR_MODE, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        if path in self.files:
+            return (_FILE_MODE, 0, 0, 0, 0, 0, len(self.files[path]), 0, 0, 0)
+        raise _error(errno.ENOENT, path)
+
+    def listdir(self, path=ROOT):
+        path = self.path(path)
+        if path not in self.dirs:
+            raise _error(errno.ENOENT, path)
+        prefix = path + "/"
+        names = set()
+        for entry in list(self.files) + list(self.dirs):
+            if entry.startswith(prefix):
+                names.add(entry[len(prefix):].split("/")[0])
+        return sorted(names)
+
+    def mkdir(self, path):
+        path = self.path(path)
+        if path in self.dirs or path in self.files:
+            raise _error(errno.EEXIST, path)
+        if self._parent(path) not in self.dirs:
+            raise _error(errno.ENOENT, path)
+        self.dirs.add(path)
+
+    def rmdir(self, path):
+        path = self.path(path)
+        if path not in self.dirs:
+            raise _error(errno.ENOENT, path)
+        if self.listdir(path):
+            raise _error(errno.ENOTEMPTY, path)
+        self.dirs.discard(path)
+
+    def remove(self, path):
+        path = self.path(path)
+        if path not in self.files:
+            raise _error(errno.ENOENT, path)
+        del self.files[path]
+
+    def rename(self, old, new):
+        old = self.path(old)
+        new = self.path(new)
+        if old not in self.files:
+            raise _error(errno.ENOENT, old)
+        if self._parent(new) not in self.dirs:
+            raise _error(errno.ENOENT, new)
+        self.files[new] = self.files.pop(old)
+
+    def sync(self):
+        pass
+
+    def getcwd(self):
+        return ROOT
+
+    def read(self, path):
+        """Host helper: file contents as bytes (None if missing)."""
+        return self.files.get(self.path(path))
+
+    def write(self, path, data):
+        """Host helper: creates parent dirs and stores 'data'."""
+        path = self.path(path)
+        parts = path.split("/")
+        for i in range(2, len(parts)):
+            self.dirs.add("/".join(parts[:i]))
+        if isinstance(data, str):
+            data = data.encode()
+        self.files[path] = data
+
+def make_uos(flash):
+    """Builds the os/uos module the firmware sees, backed by 'flash'."""
+    mod = types.ModuleType("uos")
+    for name in ("stat", "listdir", "mkdir", "rmdir", "remove", "rename", "sync", "getcwd"):
+        setattr(mod, name, getattr(flash, name))
+    mod.sep = "/"
+    return mod
@@ -0,0 +1,392 @@
+"""
+Stand-ins for the LoBo MicroPython firmware modules (machine, gsm,
+network.mqtt, curl, usocket, ussl, _thread, gc). Each make_* function builds a module
+object bound to one Simulator; sim.install() hands them to the firmware
+code in place of the real imports.
+"""
+import io
+import json
+import os
+import types
+
+from sim.clock import SimStop
+from sim.modbus import VirtualUART
+
+class SimReset(SimStop):
+    """
+    Unwinds the thread that called machine.reset(). The reset itself does
+    not depend on it: a bare except: in the firmware may swallow it, the
+    thread still stops at its next sleep because its boot is retired.
+    """
+    pass
+
+# ========== machine ==========
+class Pin(object):
+    IN = 0
+    OUT = 1
+    PULL_UP = 2
+    PULL_DOWN = 3
+
+    def __init__(self, pin, mode=IN, *args, **kwargs):
+        self.pin = pin
+        self.mode = mode
+        self._value = 0
+
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+def make_machine(sim):
+    mod = types.ModuleType("machine")
+
+    def UART(uart_id, baudrate=9600, **kwargs):
+        return VirtualUART(sim.line(uart_id), uart_id, baudrate, **kwargs)
+
+    def WDT(*args, **kwargs):
+        sim.wdt_enabled = True
+
+    def resetWDT():
+        sim.wdt_feed()
+
+    def reset():
+        sim.machine_reset()
+        raise SimReset()
+
+    mod.UART = UART
+    mod.Pin = Pin
+    mod.WDT = WDT
+    mod.resetWDT = resetWDT
+    mod.reset = reset
+    mod.unique_id = lambda: b"\x24\x0a\xc4\x00\x00\x01"
+    mod.freq = lambda *args: 240000000
+    return mod
+
+# ========== gsm ==========
+STATUS_QUERY_US = 2000
+
+def make_gsm(sim):
+    """PPPoS modem: connects at once; 'sim.network.gsm_up' drops the link."""
+    mod = types.ModuleType("gsm")
+    net = sim.network
+    state = {"started": False, "connected": False}
+
+    def status():
+        # A status query is a round trip to the modem; charging for it lets
+        # busy-wait loops (while gsm.status()[0] != 1: pass) see time pass
+        sim.clock.sleep_us(STATUS_QUERY_US)
+        if state["connected"] and net.gsm_up:
+            return (1, "Connected")
+        return (0, "Disconnected")
+
+    def start(*args, **kwargs):
+        state["started"] = True
+
+    def connect():
+        state["connected"] = True
+
+    def disconnect():
+        state["connected"] = False
+
+    mod.debug = lambda *args: None
+    mod.start = start
+    mod.stop = disconnect
+    mod.atcmd = lambda *args, **kwargs: "OK" if state["started"] else ""
+    mod.connect = connect
+    mod.disconnect = disconnect
+    mod.status = status
+    mod.ifconfig = lambda: ("10.64.0.2", "255.255.255.255", "10.64.0.1")
+    return mod
+
+# ========== network.mqtt ==========
+class Broker(object):
+    """
+    The MQTT broker side: records what the gateway publishes and delivers
+    commands to subscribed clients. 'up' (with the GSM link) controls
+    whether clients are connected.
+    """
+    def __init__(self, sim):
+        self.sim = sim
+        self.up = True
+        self.clients = []
+        # [(elapsed_s, topic, payload_str)]
+        self.published = []
+
+    def online(self):
+        return self.up and self.sim.network.gsm_up
+
+    def deliver(self, topic, payload):
+        """Sends a message to every running client subscribed to 'topic'."""
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+        for client in self.clients:
+            if client.running and topic in client.topics and self.online() and client.data_cb:
+                client.data_cb((client.name, topic, payload))
+
+    def messages(self, type_=None):
+        """Published payloads decoded as JSON (optionally of one "type")."""
+        out = []
+        for t, topic, payload in self.published:
+            try:
+                msg = json.loads(payload)
+            except ValueError:
+                continue
+            if type_ is None or msg.get("type") == type_:
+                out.append((t, msg))
+        return out
+
+class MQTTClient(object):
+    """network.mqtt stand-in (LoBo API subset used by meter_mqtts)."""
+    def __init__(self, broker, name, host, user=None, password=None, port=1883,
+                 autoreconnect=False, clientid=None, connected_cb=None,
+                 disconnected_cb=None, subscribed_cb=None, published_cb=None,
+                 data_cb=None, **kwargs):
+        self.broker = broker
+        self.name = name
+        self.host = host
+        self.port = port
+        self.connected_cb = connected_cb
+        self.disconnected_cb = disconnected_cb
+        self.subscribed_cb = subscribed_cb
+        self.published_cb = published_cb
+        self.data_cb = data_cb
+        self.running = False
+        self.topics = set()
+        broker.clients.append(self)
+
+    def start(self):
+        self.running = True
+        if self.broker.online() and self.connected_cb:
+            self.connected_cb(self.name)
+
+    def stop(self):
+        self.running = False
+
+    def status(self):
+        if self.running and self.broker.online():
+            return (2, "Connected")
+        return (0, "Disconnected")
+
+    def subscribe(self, topic):
+        self.topics.add(topic)
+        if self.subscribed_cb:
+            self.subscribed_cb(self.name)
+
+    def publish(self, topic, message):
+        if self.status()[0] != 2:
+            raise OSError("MQTT not connected")
+        if isinstance(message, (bytes, bytearray)):
+            message = bytes(message).decode()
+        self.broker.published.append((self.broker.sim.clock.elapsed(), topic, message))
+        if self.published_cb:
+            self.published_cb((self.name, topic))
+        return True
+
+def make_network(sim):
+    mod = types.ModuleType("network")
+
+    def mqtt(name, host, **kwargs):
+        return MQTTClient(sim.broker, name, host, **kwargs)
+
+    mod.mqtt = mqtt
+    return mod
+
+# ========== curl ==========
+class HttpServer(object):
+    """
+    Serves UPDATE_URL from the repository checkout, so OTA pulls the files
+    in this tree. Extra or overriding URLs go in 'routes' {url: bytes}.
+    'fail' is a probability per request of a transport error. Socket
+    clients (usocket) get Range support; 'drop' is a probability per
+    request that the body is cut off part way, and 'ranges' = False
+    makes the server ignore Range like some proxies do.
+    """
+    def __init__(self, sim, base_url, root):
+        self.sim = sim
+        self.base_url = base_url.rstrip("/")
+        self.root = root
+        self.routes = {}
+        self.fail = 0.0
+        self.drop = 0.0
+        self.ranges = True
+        self.requests = []
+
+    def fetch(self, url):
+        """Returns (http_status, body_bytes) or None on a transport error."""
+        self.requests.append((self.sim.clock.elapsed(), url))
+        if not self.sim.network.gsm_up or (self.fail and self.sim.rng.random() < self.fail):
+            return None
+        if url in self.routes:
+            return 200, self.routes[url]
+        if url.startswith(self.base_url + "/"):
+            path = os.path.normpath(os.path.join(self.root, url[len(self.base_url) + 1:]))
+            if path.startswith(self.root) and os.path.isfile(path):
+                with open(path, "rb") as f:
+                    return 200, f.read()
+        return 404, b"Not Found"
+
+    def respond(self, raw):
+        """Full HTTP response bytes for a raw socket request (b"" = connection failed)."""
+        head = raw.decode("latin-1").split("\r\n")
+        method, path = head[0].split(" ")[:2]
+        headers = {}
+        for line in head[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        url = "https://" + headers.get("host", "") + path
+        result = self.fetch(url)
+        if result is None:
+            return b""
+        status, body = result
+        extra = ""
+        want = headers.get("range")
+        if status == 200 and want and self.ranges:
+            first, last = want.split("=", 1)[1].split("-")
+            first = int(first)
+            last = min(int(last), len(body) - 1) if last else len(body) - 1
+            if first >= len(body):
+                status, body = 416, b""
+                extra = "Content-Range: bytes */%d\r\n" % len(result[1])
+            else:
+                status, body = 206, body[first:last + 1]
+                extra = "Content-Range: bytes %d-%d/%d\r\n" % (first, last, len(result[1]))
+        head = "HTTP/1.0 %d %s\r\nContent-Length: %d\r\n%s\r\n" % (
+            status, "OK" if status < 300 else "Error", len(body), extra)
+        if body and self.drop and self.sim.rng.random() < self.drop:
+            body = body[:self.sim.rng.randrange(len(body))]
+        return head.encode() + body
+
+def make_curl(sim):
+    mod = types.ModuleType("curl")
+
+    def get(url, file=None, *args, **kwargs):
+        result = sim.http.fetch(url)
+        if result is None:
+            # CURLE_COULDNT_CONNECT
+            return 7, "", ""
+        status, body = result
+        hdr = "HTTP/1.1 %d %s\r\nContent-Length: %d\r\n" % (
+            status, "OK" if status == 200 else "Error", len(body))
+        if file is not None:
+            with sim.flash.open(file, "wb") as f:
+                f.write(body)
+            return 0, hdr, ""
+        return 0, hdr, body.decode("utf-8", "replace")
+
+    mod.get = get
+    return mod
+
+# ========== usocket / ussl ==========
+class SimSocket(object):
+    """Client socket to the HttpServer: the request is answered on the first read."""
+    def __init__(self, sim):
+        self.sim = sim
+        self._request = b""
+        self._reply = None
+
+    def settimeout(self, timeout):
+        pass
+
+    def connect(self, addr):
+        if not self.sim.network.gsm_up:
+            raise OSError(113)  # EHOSTUNREACH
+
+    def write(self, data):
+        self._request += data
+        return len(data)
+
+    send = write
+
+    def _stream(self):
+        if self._reply is None:
+            self._reply = io.BytesIO(self.sim.http.respond(self._request))
+        return self._reply
+
+    def readline(self):
+        return self._stream().readline()
+
+    def read(self, n=-1):
+        return self._stream().read(n)
+
+    recv = read
+
+    def close(self):
+        pass
+
+def make_usocket(sim):
+    mod = types.ModuleType("usocket")
+    mod.getaddrinfo = lambda host, port, *args: [(2, 1, 6, "", (host, port))]
+    mod.socket = lambda *args: SimSocket(sim)
+    return mod
+
+def make_ussl(sim):
+    mod = types.ModuleType("ussl")
+    mod.wrap_socket = lambda sock, **kwargs: sock
+    return mod
+
+# ========== _thread ==========
+class SimLock(object):
+    """
+    _thread lock on the simulated clock. A blocked acquire sleeps a little
+    and retries, so the holder (parked in its own sleep) can run.
+    """
+    SPIN_US = 100
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.held = False
+
+    def acquire(self, waitflag=1, timeout=-1):
+        while self.held:
+            if not waitflag:
+                return False
+            self.clock.sleep_us(self.SPIN_US)
+        self.held = True
+        return True
+
+    def release(self):
+        if not self.held:
+            raise RuntimeError("release unlocked lock")
+        self.held = False
+
+    def locked(self):
+        return self.held
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def make_thread(sim):
+    mod = types.ModuleType("_thread")
+
+    def start_new_thread(name, func, args, **kwargs):
+        sim.thread_names.append(name)
+        sim.clock.spawn(func, args)
+        return len(sim.thread_names)
+
+    mod.start_new_thread = start_new_thread
+    mod.allocate_lock = lambda: SimLock(sim.clock)
+    mod.get_ident = lambda: 0
+    mod.stack_size = lambda *args: 4096
+    return mod
+
+# ========== gc ==========
+def make_gc(sim):
+    """Heap figures come from sim.heap_free, not the host."""
+    mod = types.ModuleType("gc")
+
+    def collect():
+        sim.gc_runs += 1
+
+    mod.collect = collect
+    mod.enable = lambda: None
+    mod.disable = lambda: None
+    mod.isenabled = lambda: True
+    mod.mem_free = lambda: sim.heap_free
+    mod.mem_alloc = lambda: sim.heap_size - sim.heap_free
+    mod.threshold = lambda *args: -1
+    return mod
@@ -0,0 +1,218 @@
+import random
+
+# ========== METER REGISTERS ==========
+# Mirrors meter_registers.REGISTER_MAP for the stock meter
+FLOW_REGISTER = 0x000E
+VALVE_REGISTER = 0x0060
+VALVE_OPEN = 1
+VALVE_CLOSED = 2
+# Registers outside this range answer with exception 2 (illegal address)
+REGISTER_LIMIT = 0x0100
+# 8N1 would be 10; the meters run 8E1
+BITS_PER_CHAR = 11
+
+def crc16(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+def _frame(body):
+    crc = crc16(body)
+    return bytes(body) + bytes([crc & 0xFF, crc >> 8])
+
+# ========== EMULATED WATER METER ==========
+class SimMeter(object):
+    """
+    A Modbus RTU water meter: a cumulative flow counter that advances at
+    'flow_lps' while the valve is open, and the valve register.
+
+    Fault injection, each a probability per request:
+      timeout   - no reply at all
+      crc       - reply with a corrupted CRC
+      short     - reply cut off half way
+      exception - exception reply (code 4, slave device failure)
+    'dead' makes the meter silent (unplugged / unpowered).
+    """
+    def __init__(self, address, cumulative=0, flow_lps=0.0, valve=VALVE_OPEN,
+                 latency_ms=20, jitter_ms=0, seed=None):
+        self.address = address
+        self.litres = float(cumulative)
+        self.flow_lps = flow_lps
+        self.valve = valve
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.faults = {"timeout": 0.0, "crc": 0.0, "short": 0.0, "exception": 0.0}
+        self.dead = False
+        self.requests = 0
+        self.replies = 0
+        self.valve_writes = 0
+        self._rng = random.Random(address if seed is None else seed)
+        self._updated_at = None
+
+    @property
+    def cumulative(self):
+        return int(self.litres)
+
+    def advance(self, now_s):
+        if self._updated_at is not None and self.valve == VALVE_OPEN:
+            self.litres += self.flow_lps * (now_s - self._updated_at)
+        self._updated_at = now_s
+
+    def inject(self, **faults):
+        """e.g. meter.inject(timeout=0.1, crc=0.02)"""
+        for name, rate in faults.items():
+            if name not in self.faults:
+                raise ValueError("unknown fault %r" % name)
+            self.faults[name] = rate
+
+    def _register(self, reg):
+        value = self.cumulative & 0xFFFFFFFF
+        if reg == FLOW_REGISTER:
+            return value & 0xFFFF
+        if reg == FLOW_REGISTER + 1:
+            return value >> 16
+        if reg == VALVE_REGISTER:
+            return self.valve
+        return 0
+
+    def handle(self, request, now_s):
+        """
+        Returns (reply_bytes, latency_ms) for one request frame, or None
+        if the meter stays silent.
+        """
+        self.requests += 1
+        self.advance(now_s)
+        if self.dead or len(request) < 8 or crc16(request[:-2]) != (request[-2] | (request[-1] << 8)):
+            return None
+        if self._roll("timeout"):
+            return None
+
+        function = request[1]
+        start = (request[2] << 8) | request[3]
+        count = (request[4] << 8) | request[5]
+        if self._roll("exception"):
+            reply = _frame([self.address, function | 0x80, 4])
+        elif function == 0x03:
+            if count < 1 or start + count > REGISTER_LIMIT:
+                reply = _frame([self.address, 0x83, 2])
+            else:
+                body = [self.address, 0x03, 2 * count]
+                for reg in range(start, start + count):
+                    value = self._register(reg)
+                    body.append(value >> 8)
+                    body.append(value & 0xFF)
+                reply = _frame(body)
+        elif function == 0x10:
+            if start == VALVE_REGISTER and count == 1 and len(request) >= 11:
+                value = (request[7] << 8) | request[8]
+                if value in (VALVE_OPEN, VALVE_CLOSED):
+                    self.valve = value
+                    self.valve_writes += 1
+                    reply = _frame(request[:6])
+                else:
+                    reply = _frame([self.address, 0x90, 3])
+            else:
+                reply = _frame([self.address, 0x90, 2])
+        else:
+            reply = _frame([self.address, function | 0x80, 1])
+
+        if self._roll("crc"):
+            reply = reply[:-1] + bytes([reply[-1] ^ 0xFF])
+        if self._roll("short"):
+            reply = reply[:len(reply) // 2]
+        self.replies += 1
+        latency = self.latency_ms
+        if self.jitter_ms:
+            latency += self._rng.uniform(0, self.jitter_ms)
+        return reply, latency
+
+    def _roll(self, fault):
+        rate = self.faults[fault]
+        return rate > 0 and self._rng.random() < rate
+
+# ========== VIRTUAL UART / RS-485 LINE ==========
+class RS485Line(object):
+    """One bus: the meters wired to a UART and the bytes in flight."""
+    def __init__(self, clock):
+        self.clock = clock
+        self.meters = {}
+        self.baud = 9600
+        # [(arrival_us, byte)] not yet read by the UART
+        self._rx = []
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self.busy_us = 0
+
+    def char_us(self):
+        return (BITS_PER_CHAR * 1000000) // self.baud
+
+    def add(self, meter):
+        self.meters[meter.address] = meter
+        return meter
+
+    def send(self, frame):
+        char_us = self.char_us()
+        now = self.clock.us
+        self.tx_bytes += len(frame)
+        end_of_request = now + len(frame) * char_us
+        self.busy_us += len(frame) * char_us
+        if not frame:
+            return
+        meter = self.meters.get(frame[0])
+        if meter is None:
+            return
+        result = meter.handle(bytes(frame), self.clock.elapsed())
+        if result is None:
+            return
+        reply, latency_ms = result
+        start = end_of_request + int(latency_ms * 1000)
+        for i, byte in enumerate(reply):
+            self._rx.append((start + (i + 1) * char_us, byte))
+        self.busy_us += len(reply) * char_us
+
+    def available(self):
+        now = self.clock.us
+        n = 0
+        for arrival, _ in self._rx:
+            if arrival > now:
+                break
+            n += 1
+        return n
+
+    def take(self, n):
+        data = bytes(b for _, b in self._rx[:n])
+        del self._rx[:n]
+        self.rx_bytes += len(data)
+        return data
+
+class VirtualUART(object):
+    """machine.UART stand-in wired to an RS485Line."""
+    def __init__(self, line, uart_id, baudrate=9600, **kwargs):
+        self.line = line
+        self.id = uart_id
+        self.kwargs = kwargs
+        line.baud = baudrate
+
+    def any(self):
+        return self.line.available()
+
+    def read(self, n=None):
+        available = self.line.available()
+        if not available:
+            return None
+        if n is None or n > available:
+            n = available
+        return self.line.take(n)
+
+    def write(self, data):
+        self.line.send(bytes(data))
+        return len(data)
+
+    def deinit(self):
+        pass
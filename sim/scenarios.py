@@ -0,0 +1,178 @@
+"""
+End-to-end checks of device behaviour on the simulator.
+
+    python -m sim.scenarios            # run every scenario
+    python -m sim.scenarios ota        # only the ones whose name contains "ota"
+
+Each scenario boots the firmware, drives it through one situation and
+returns a list of failed expectations. The exit status is 1 if any fail.
+"""
+import argparse
+import calendar
+import os
+import sys
+
+from sim import Simulator, REPO_ROOT
+
+# LoBo's fixed hardware watchdog
+WDT_TIMEOUT_S = 15
+# Water a credited meter may pass beyond its target before the valve closes
+MAX_OVERSHOOT_L = 5
+# 2026-01-05 23:55:00 UTC: the midnight OTA check is five minutes away
+BEFORE_MIDNIGHT = calendar.timegm((2026, 1, 5, 23, 55, 0, 0, 0, 0))
+
+def _meters(sim, flow_lps=0.02):
+    for address in sim.globals.SLAVE_ADDRESSES:
+        sim.add_meter(address, cumulative=1000 * address, flow_lps=flow_lps)
+
+def _check(failures, ok, message):
+    if not ok:
+        failures.append(message)
+
+def _repo_version():
+    with open(os.path.join(REPO_ROOT, "version.txt")) as f:
+        return f.read().strip()
+
+# ========== SCENARIOS ==========
+def scenario_ota_reboot_confirm(runtime="threads"):
+    """Midnight OTA: stage, swap, machine.reset(), boot the release and confirm it."""
+    sim = Simulator(start=BEFORE_MIDNIGHT, overrides={"RUNTIME": runtime})
+    _meters(sim)
+    sim.flash.write(sim.globals.VERSION_FILE, b"0.0.1")
+    sim.run(20 * 60)
+
+    failures = []
+    version = (sim.flash.read(sim.globals.VERSION_FILE) or b"").decode()
+    _check(failures, len(sim.resets) >= 1, "no machine.reset() after the OTA")
+    _check(failures, sim.boots >= 2, "device did not boot again (boots=%d)" % sim.boots)
+    _check(failures, version == _repo_version(), "version.txt is %r, not confirmed" % version)
+    _check(failures, sim.flash.read("/flash/ota_state.json") is None, "OTA still on trial")
+    _check(failures, not sim.crashes, "%d thread crash(es)" % len(sim.crashes))
+    _check(failures, sim.wdt_max_gap < WDT_TIMEOUT_S,
+           "WDT not fed for %.1f s" % sim.wdt_max_gap)
+    return failures
+
+def scenario_ota_reboot_confirm_async():
+    return scenario_ota_reboot_confirm("async")
+
+def scenario_midnight_up_to_date(runtime="threads"):
+    """Midnight check with nothing to install: no reset, the WDT keeps being fed."""
+    sim = Simulator(start=BEFORE_MIDNIGHT, overrides={"RUNTIME": runtime})
+    _meters(sim)
+    sim.run(20 * 60)
+
+    failures = []
+    _check(failures, not sim.resets, "unexpected reset at %s" % sim.resets)
+    _check(failures, any("/version.txt" in url for _, url in sim.http.requests),
+           "midnight update check did not run")
+    _check(failures, sim.wdt_max_gap < WDT_TIMEOUT_S,
+           "WDT not fed for %.1f s" % sim.wdt_max_gap)
+    _check(failures, not sim.crashes, "%d thread crash(es)" % len(sim.crashes))
+    return failures
+
+def scenario_midnight_up_to_date_async():
+    return scenario_midnight_up_to_date("async")
+
+def _credit_overshoot(runtime, litres, flow_lps):
+    """Litres past the target after a credit for a meter closed for half an hour."""
+    sim = Simulator(overrides={"RUNTIME": runtime})
+    _meters(sim, flow_lps)
+    address = sim.globals.SLAVE_ADDRESSES[0]
+    sim.command(1800, address, "success", litres=litres)
+    sim.run(1800 + litres / flow_lps + 1800)
+    return sim.litres(address) - 1000 * address - litres
+
+def scenario_credit_after_idle(runtime="threads"):
+    """The idle backoff must not carry a freshly credited meter past its target."""
+    failures = []
+    for litres, flow_lps in ((20, 0.05), (5, 0.2)):
+        overshoot = _credit_overshoot(runtime, litres, flow_lps)
+        _check(failures, overshoot <= MAX_OVERSHOOT_L,
+               "%d L credit at %.2f L/s overshot by %.1f L" % (litres, flow_lps, overshoot))
+    return failures
+
+def scenario_credit_after_idle_async():
+    return scenario_credit_after_idle("async")
+
+def scenario_idle_with_credit(runtime="threads"):
+    """Idle meters holding credit back off like any idle meter and every reading gets reported."""
+    sim = Simulator(overrides={"RUNTIME": runtime})
+    _meters(sim, 0.0)
+    addresses = sim.globals.SLAVE_ADDRESSES
+    for address in addresses:
+        sim.command(60, address, "success", litres=30)
+    hours = 2
+    sim.run(hours * 3600)
+
+    failures = []
+    # Without backoff every meter is read once per 'timer'
+    baseline = len(addresses) * hours * 3600 // sim.globals.timer
+    reads = sum(sim.meter(a).requests - sim.meter(a).valve_writes for a in addresses)
+    _check(failures, reads <= baseline, "%d meter reads, baseline %d" % (reads, baseline))
+    last = {}
+    for _, msg in sim.broker.messages("device_report"):
+        if "cumulative_flow_L" in msg:
+            last[msg["device"]] = msg
+    stale = [a for a in addresses if a not in last or last[a]["target_flow"] != 1000 * a + 30]
+    _check(failures, not stale, "credited target never reported for %s" % stale)
+    skipped = [line for line in sim.console if "Publish budget spent" in line]
+    _check(failures, not skipped, "%d reports skipped by the publish budget" % len(skipped))
+    _check(failures, not sim.crashes, "%d thread crash(es)" % len(sim.crashes))
+    return failures
+
+def scenario_idle_with_credit_async():
+    return scenario_idle_with_credit("async")
+
+def scenario_credit_queue_full(runtime="threads"):
+    """A burst of loads beyond the command queue: each is applied or reported as rejected."""
+    sim = Simulator(overrides={"RUNTIME": runtime, "CMD_QUEUE_SIZE": 2})
+    _meters(sim, 0.0)
+    addresses = sim.globals.SLAVE_ADDRESSES
+    for address in addresses[:2]:
+        sim.command(300, address, "valve_close")
+    for address in addresses:
+        sim.command(300, address, "success", litres=5)
+    sim.run(600)
+
+    failures = []
+    answered = [msg["device"] for _, msg in sim.broker.messages("device_report")
+                if msg.get("status") in ("load_success", "load_rejected")]
+    _check(failures, len(answered) == len(addresses),
+           "%d of %d loads acked or rejected" % (len(answered), len(addresses)))
+    _check(failures, not sim.crashes, "%d thread crash(es)" % len(sim.crashes))
+    return failures
+
+def scenario_credit_queue_full_async():
+    return scenario_credit_queue_full("async")
+
+SCENARIOS = [
+    ("ota_reboot_confirm", scenario_ota_reboot_confirm),
+    ("ota_reboot_confirm_async", scenario_ota_reboot_confirm_async),
+    ("midnight_up_to_date", scenario_midnight_up_to_date),
+    ("midnight_up_to_date_async", scenario_midnight_up_to_date_async),
+    ("credit_after_idle", scenario_credit_after_idle),
+    ("credit_after_idle_async", scenario_credit_after_idle_async),
+    ("idle_with_credit", scenario_idle_with_credit),
+    ("idle_with_credit_async", scenario_idle_with_credit_async),
+    ("credit_queue_full", scenario_credit_queue_full),
+    ("credit_queue_full_async", scenario_credit_queue_full_async),
+]
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m sim.scenarios")
+    parser.add_argument("match", nargs="?", default="")
+    args = parser.parse_args()
+
+    failed = 0
+    for name, func in SCENARIOS:
+        if args.match not in name:
+            continue
+        failures = func()
+        print("%-32s %s" % (name, "ok" if not failures else "FAILED"))
+        for message in failures:
+            print("    " + message)
+        failed += bool(failures)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+Cross-compiles the gateway to .mpy bytecode and lays out an OTA payload.
+
+    python tools/build_mpy.py                            # -> build/mpy/
+    python tools/build_mpy.py --mpy-cross ~/lobo/mpy-cross/mpy-cross
+
+mpy-cross must be built from the same MicroPython tree as the firmware:
+the .mpy format is versioned and the device refuses any other version
+(ota_loader then falls back to the bundled sources). Publish the output
+directory as UPDATE_URL; it has its own version.txt and manifest.json.
+
+Payload:
+    boot.py, ota_boot.py, ota_loader.py    source (boot path and recovery)
+    main.py                                stub: ota_loader.start("main_app")
+    main_app.mpy                           main.py, compiled
+    X.mpy, X.py.src                        every other module and its source
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import make_manifest
+
+REPO_ROOT = make_manifest.REPO_ROOT
+OUTPUT = os.path.join(REPO_ROOT, "build", "mpy")
+# Run before anything can fail to load, so they stay source
+KEEP_SOURCE = ("boot.py", "ota_boot.py", "ota_loader.py")
+# MicroPython only executes main.py from source; the application moves to
+# main_app and main.py becomes this stub
+APP_MODULE = "main_app"
+MAIN_STUB = (
+    "# Generated by tools/build_mpy.py: the gateway is %s.mpy\n"
+    "import ota_loader\n"
+    "ota_loader.start(\"%s\")\n" % (APP_MODULE, APP_MODULE))
+SRC_SUFFIX = ".src"
+
+def compile_module(mpy_cross, src, dst, name, extra=()):
+    cmd = [mpy_cross, "-o", dst, "-s", name] + list(extra) + [src]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise SystemExit("mpy-cross failed on %s:\n%s" % (name, result.stdout))
+
+def mpy_version(path):
+    with open(path, "rb") as f:
+        header = f.read(2)
+    if header[:1] != b"M":
+        raise SystemExit("%s is not a .mpy file" % path)
+    return header[1]
+
+def build(mpy_cross, output, extra=()):
+    """Writes the payload to 'output'. Returns [(name, source_bytes, payload_bytes)]."""
+    if os.path.isdir(output):
+        shutil.rmtree(output)
+    os.makedirs(output)
+    shutil.copy(os.path.join(REPO_ROOT, "version.txt"), output)
+
+    report = []
+    for name in make_manifest.files_to_update():
+        src = os.path.join(REPO_ROOT, name)
+        size = os.path.getsize(src)
+        if name in KEEP_SOURCE:
+            shutil.copy(src, output)
+            report.append((name, size, size))
+            continue
+        module = APP_MODULE if name == "main.py" else name[:-3]
+        dst = os.path.join(output, module + ".mpy")
+        compile_module(mpy_cross, src, dst, module + ".py", extra)
+        shutil.copy(src, os.path.join(output, module + ".py" + SRC_SUFFIX))
+        report.append((module + ".mpy", size, os.path.getsize(dst)))
+        if name == "main.py":
+            with open(os.path.join(output, "main.py"), "w") as f:
+                f.write(MAIN_STUB)
+
+    names = sorted(n for n in os.listdir(output) if n not in ("version.txt", "manifest.json"))
+    with open(os.path.join(output, "manifest.json"), "w") as f:
+        f.write(make_manifest.dumps(make_manifest.build(output, names)))
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(prog="build_mpy.py")
+    parser.add_argument("--mpy-cross", default="mpy-cross",
+                        help="mpy-cross built for the firmware (default: from PATH)")
+    parser.add_argument("--output", default=OUTPUT)
+    parser.add_argument("--mpy-arg", action="append", default=[],
+                        help="extra mpy-cross option, e.g. --mpy-arg=-mcache-lookup-bc")
+    args = parser.parse_args()
+
+    if shutil.which(args.mpy_cross) is None:
+        print("mpy-cross not found (%s); build it from the firmware tree" % args.mpy_cross)
+        return 1
+
+    report = build(args.mpy_cross, args.output, args.mpy_arg)
+    compiled = [r for r in report if r[0].endswith(".mpy")]
+    print("%-22s %8s %8s" % ("module", "source", "payload"))
+    for name, size, out in report:
+        print("%-22s %8d %8d" % (name, size, out))
+    print("%-22s %8d %8d" % ("compiled total", sum(r[1] for r in compiled), sum(r[2] for r in compiled)))
+    print(".mpy format version %d, payload in %s" % (
+        mpy_version(os.path.join(args.output, compiled[0][0])), args.output))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
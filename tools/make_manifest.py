@@ -0,0 +1,79 @@
+"""
+Builds manifest.json for delta OTA from the files in ota_update.FILES_TO_UPDATE.
+
+    python tools/make_manifest.py            # write manifest.json at the repo root
+    python tools/make_manifest.py --check    # exit 1 if manifest.json is stale
+
+Run it (and commit the result) whenever version.txt is bumped. Devices
+fetch the manifest, compare it with the copy they keep on flash and
+download only the files whose size or sha256 changed.
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MANIFEST = os.path.join(REPO_ROOT, "manifest.json")
+
+def files_to_update(root=REPO_ROOT):
+    """FILES_TO_UPDATE from ota_update.py, read without importing it (it needs curl)."""
+    with open(os.path.join(root, "ota_update.py")) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+                getattr(t, "id", None) == "FILES_TO_UPDATE" for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise SystemExit("FILES_TO_UPDATE not found in ota_update.py")
+
+def file_entry(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    return {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+
+def build(root=REPO_ROOT, names=None):
+    with open(os.path.join(root, "version.txt")) as f:
+        version = f.read().strip()
+    files = {}
+    for name in names if names is not None else files_to_update(root):
+        path = os.path.join(root, name)
+        if not os.path.isfile(path):
+            print("warning: %s is in FILES_TO_UPDATE but missing, skipped" % name)
+            continue
+        files[name] = file_entry(path)
+    return {"version": version, "files": files}
+
+def dumps(manifest):
+    return json.dumps(manifest, indent=1, sort_keys=True) + "\n"
+
+def main():
+    parser = argparse.ArgumentParser(prog="make_manifest.py")
+    parser.add_argument("--output", default=MANIFEST)
+    parser.add_argument("--check", action="store_true", help="compare instead of writing")
+    args = parser.parse_args()
+
+    text = dumps(build())
+    if args.check:
+        try:
+            with open(args.output) as f:
+                current = f.read()
+        except IOError:
+            current = ""
+        if current != text:
+            print("%s is out of date" % args.output)
+            return 1
+        print("%s is up to date" % args.output)
+        return 0
+
+    with open(args.output, "w") as f:
+        f.write(text)
+    manifest = json.loads(text)
+    print("%s: version %s, %d files, %d bytes" % (
+        args.output, manifest["version"], len(manifest["files"]),
+        sum(e["size"] for e in manifest["files"].values())))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())